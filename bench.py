@@ -0,0 +1,278 @@
+"""Бенчмарк отрисовки без терминала
+
+Замеряет раскладку, сборку плоского списка строк, отрисовку и навигацию
+на синтетической истории из 100/1k/10k/100k сообщений. Окна curses заменены
+заглушками, поэтому запускается где угодно, в том числе без TTY:
+
+    python bench.py
+    python bench.py --sizes 100,1000 --compare bench-results/abc1234.json
+
+Результаты сохраняются в bench-results/<ревизия>.json.
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import subprocess
+import statistics
+import configparser
+import time
+import curses
+from datetime import datetime, timedelta
+
+from messages import MessageRecord, MediaRef
+from view import TelegramView, MessageLayoutCache
+from thumbs import ThumbCache
+from viewmodel import TelegramViewModel
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+RESULTS_DIR = 'bench-results'
+
+WORDS = ['привет', 'как', 'дела', 'ok', 'завтра', 'встреча', 'сервер', 'упал', 'the', 'build', 'is', 'green']
+CJK = ['日本語', '中文字符', '한국어', 'テスト']
+EMOJI = ['🙂', '👍', '🔥', '👨‍👩‍👧', '🏳️‍🌈', '✅']
+LINKS = ['https://example.com/some/really/long/path?with=query&and=more&params=1234567890']
+
+
+class StubWindow:
+    """Заглушка окна curses: принимает вызовы отрисовки и считает их"""
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.calls = 0
+
+    def addstr(self, *args):
+        self.calls += 1
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def erase(self): pass
+    def clear(self): pass
+    def noutrefresh(self): pass
+    def refresh(self): pass
+    def move(self, *args): pass
+    def clrtoeol(self): pass
+    def attron(self, *args): pass
+    def attroff(self, *args): pass
+
+
+class StubDialog:
+    def __init__(self):
+        self.title = "Bench"
+        self.entity = None
+
+
+class BenchModel:
+    """Модель без сети: файлы сообщений считаются незагруженными"""
+    def __init__(self, history_pages):
+        self.config = configparser.ConfigParser()
+        self.config['Settings'] = {'HistoryPages': str(history_pages), 'PrefetchDialogs': '0'}
+        self.outbox_file = None
+        self.thumbs = ThumbCache(None)
+
+    @staticmethod
+    def get_dialog_id(dialog):
+        return None
+
+    async def download_media(self, media, chat_title, message_id, force_download=False, progress_callback=None):
+        return f"downloads/{chat_title}/{message_id}{media.ext}"
+
+
+def make_view(width, height):
+    """TelegramView поверх заглушек окон, без инициализации curses"""
+    curses.color_pair = lambda n: 0
+    view = TelegramView.__new__(TelegramView)
+    view.stdscr = StubWindow(height, width)
+    view.height, view.width = height, width
+    view.chat_win_width = max(1, int(width * 0.3))
+    view.msg_win_width = max(1, width - view.chat_win_width - 2)
+    view.chat_win_height = height
+    view.msg_win_height = max(1, height - 2)
+    view.chat_win = StubWindow(view.chat_win_height, view.chat_win_width)
+    view.msg_win = StubWindow(view.msg_win_height, view.msg_win_width)
+    view.progress_win = None
+    view.is_showing_progress = False
+    view.preview_pairs = {}
+    view.pair_frames = {}
+    view.frame = 0
+    return view
+
+
+def synthetic_text(rng):
+    """Текст сообщения: короткие реплики, длинные абзацы, CJK, эмодзи, ссылки, переносы строк"""
+    kind = rng.random()
+    if kind < 0.4:
+        return ' '.join(rng.choices(WORDS, k=rng.randint(1, 6)))
+    if kind < 0.6:
+        return ' '.join(rng.choices(WORDS, k=rng.randint(30, 120)))
+    if kind < 0.75:
+        return ' '.join(rng.choices(CJK + WORDS, k=rng.randint(3, 30)))
+    if kind < 0.85:
+        return ' '.join(rng.choices(EMOJI + WORDS, k=rng.randint(2, 20)))
+    if kind < 0.92:
+        return f"{rng.choice(WORDS)} {rng.choice(LINKS)}"
+    return '\n'.join(' '.join(rng.choices(WORDS, k=rng.randint(1, 8))) for _ in range(rng.randint(2, 6)))
+
+
+def synthetic_messages(count, seed=0):
+    """Детерминированная история: входящие и исходящие, файлы, смена дат"""
+    rng = random.Random(seed)
+    date = datetime(2024, 1, 1, 9, 0)
+    messages = []
+    for msg_id in range(1, count + 1):
+        date += timedelta(minutes=rng.randint(1, 90))
+        media = None
+        if rng.random() < 0.1:
+            media = MediaRef('photo', ext='.jpg') if rng.random() < 0.5 else MediaRef('document', 'report.pdf', 'application/pdf', 123456, '.pdf')
+        out = rng.random() < 0.3
+        messages.append(MessageRecord(
+            msg_id, 1, date,
+            sender_id=0 if out else rng.randint(1, 5),
+            sender_name=None if out else rng.choice(['Аня', 'Bob', '山田', 'Команда 🚀']),
+            text=synthetic_text(rng),
+            media=media,
+            out=out
+        ))
+    return messages
+
+
+def measure(func, repeat):
+    """Медиана и минимум времени выполнения func в миллисекундах"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': round(statistics.median(samples), 3), 'min_ms': round(min(samples), 3)}
+
+
+async def measure_async(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': round(statistics.median(samples), 3), 'min_ms': round(min(samples), 3)}
+
+
+async def bench_size(count, width, height, moves):
+    """Все замеры для истории из count сообщений"""
+    messages = synthetic_messages(count)
+    view = make_view(width, height)
+    model = BenchModel(history_pages=count // 20 + 2)
+    max_width = view.msg_win_width
+    repeat = max(1, min(5, 10000 // count))
+    results = {}
+
+    async def layout_cold():
+        await view.prepare_message_blocks(messages, max_width, model, "Bench", cache=MessageLayoutCache())
+    results['layout_cold'] = await measure_async(layout_cold, repeat)
+
+    cache = MessageLayoutCache()
+    blocks = await view.prepare_message_blocks(messages, max_width, model, "Bench", cache=cache)
+
+    async def layout_warm():
+        await view.prepare_message_blocks(messages, max_width, model, "Bench", cache=cache)
+    results['layout_warm'] = await measure_async(layout_warm, repeat)
+
+    results['flatten'] = measure(lambda: view.flatten_blocks(blocks), repeat)
+    flat_lines = view.flatten_blocks(blocks)
+    lines, line_map = flat_lines
+
+    # Отрисовка: кадры в разных местах истории
+    offsets = [int(i * max(0, len(lines) - view.msg_win_height) / 19) for i in range(20)]
+
+    def paint():
+        for offset in offsets:
+            view.draw_message_lines(flat_lines, offset, line_map)
+    paint_result = measure(paint, repeat)
+    results['paint_frame'] = {key: round(value / len(offsets), 3) for key, value in paint_result.items()}
+
+    # Навигация через модель представления, как при нажатиях j/k
+    vm = TelegramViewModel(model, view)
+    vm.chat_list = [StubDialog()]
+    vm.selected_chat = 0
+    await vm.display_messages(list(messages))
+
+    results['ensure_cursor_visible'] = measure(vm.ensure_cursor_visible, repeat)
+
+    async def navigate():
+        for _ in range(moves):
+            await vm.move_cursor_up()
+        for _ in range(moves):
+            await vm.move_cursor_down()
+    nav_result = await measure_async(navigate, 1)
+    results['cursor_move'] = {key: round(value / (2 * moves), 3) for key, value in nav_result.items()}
+
+    results['lines'] = len(lines)
+    return results
+
+
+def current_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+
+def print_results(results, baseline=None):
+    metrics_order = ['layout_cold', 'layout_warm', 'flatten', 'paint_frame', 'ensure_cursor_visible', 'cursor_move']
+    for size, size_results in results['sizes'].items():
+        print(f"\n{size} сообщений ({size_results['lines']} строк)")
+        base = (baseline or {}).get('sizes', {}).get(size, {})
+        for name in metrics_order:
+            value = size_results[name]['median_ms']
+            line = f"  {name:<24}{value:>12.3f} мс"
+            if name in base and base[name]['median_ms']:
+                ratio = value / base[name]['median_ms']
+                line += f"   x{ratio:.2f} к {baseline['revision']}"
+            print(line)
+
+
+async def run(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = {
+        'revision': current_revision(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'terminal': [args.width, args.height],
+        'sizes': {}
+    }
+    for size in sizes:
+        results['sizes'][str(size)] = await bench_size(size, args.width, args.height, args.moves)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк отрисовки сообщений без терминала")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help="размеры истории через запятую")
+    parser.add_argument('--width', type=int, default=160, help="ширина терминала")
+    parser.add_argument('--height', type=int, default=50, help="высота терминала")
+    parser.add_argument('--moves', type=int, default=20, help="сколько раз двигать курсор в каждую сторону")
+    parser.add_argument('--output', help="куда сохранить результаты (по умолчанию bench-results/<ревизия>.json)")
+    parser.add_argument('--compare', help="файл с результатами другой ревизии для сравнения")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['revision']}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Загрузка всех файлов открытого чата
+
+Клавиша D в окне сообщений загружает фото, видео, документы и голосовые чата
+в ту же папку, куда их кладет экспорт с файлами: exports/<чат>_files. Ход
+загрузки показывается в заголовке. Какие типы загружать и сколько файлов
+одновременно, задают DownloadKinds и DownloadWorkers в конфиге.
+"""
+import os
+import glob
+import time
+import shutil
+import asyncio
+
+from messages import MediaRef, format_size
+from export import EXPORT_DIR, retrying
+from scheduler import priority, NORMAL
+from tracing import tracer
+
+# Какие вложения загружать по умолчанию (ключи MEDIA_FILTERS модели)
+DOWNLOAD_KINDS = ('photo', 'video', 'document', 'voice')
+# Сколько файлов загружать одновременно
+DOWNLOAD_WORKERS = 3
+# Сколько файлов может ждать загрузки: пока очередь полна, список с сервера не запрашивается
+DOWNLOAD_QUEUE = 20
+# Сколько сообщений с файлами запрашивать за раз
+SEARCH_PAGE_SIZE = 100
+
+
+def is_complete(path, size):
+    """Лежит ли на диске файл целиком (заглушки из папки загрузок короче)"""
+    return os.path.exists(path) and (size is None or os.path.getsize(path) == size)
+
+
+class BulkDownload:
+    """Загрузка всех файлов чата
+
+    Список файлов запрашивается серверными фильтрами по типу вложения, поэтому
+    сообщения без файлов не передаются вовсе. Файлы, которые уже лежат на диске
+    целиком, пропускаются, загруженные раньше через Enter копируются из папки
+    загрузок. Остальные загружаются несколькими задачами из очереди ограниченного
+    размера в ту же папку, что и при экспорте с файлами: exports/<чат>_files.
+    """
+    def __init__(self, model, entity, title, kinds=DOWNLOAD_KINDS, workers=DOWNLOAD_WORKERS):
+        self.model = model
+        self.entity = entity
+        self.title = title
+        self.kinds = kinds
+        self.workers = workers
+        safe_title = model.safe_file_name(title)
+        self.directory = os.path.join(EXPORT_DIR, safe_title + '_files')
+        self.downloads_directory = os.path.join(model.downloads_dir, safe_title)
+        # id уже просмотренных сообщений: один файл может подойти под два фильтра
+        self.seen = set()
+        self.listing = True
+        self.found = 0
+        self.existing = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.total_bytes = 0
+        self.finished_bytes = 0
+        # Сколько байт уже принято по файлам, которые загружаются сейчас
+        self.progress = {}
+        self.done = False
+        self.error = None
+        self.started = time.monotonic()
+        self.finished_at = None
+
+    async def run(self):
+        """Загружает файлы; ошибка не выбрасывается, а остается в error"""
+        with tracer.cause('bulk_download'), priority(NORMAL):
+            queue = asyncio.Queue(DOWNLOAD_QUEUE)
+            workers = [asyncio.create_task(self.worker(queue)) for _ in range(self.workers)]
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                for kind in self.kinds:
+                    await self.list_kind(kind, queue)
+                self.listing = False
+                await queue.join()
+                self.done = True
+            except Exception as e:
+                self.error = str(e) or type(e).__name__
+            finally:
+                self.listing = False
+                for worker in workers:
+                    worker.cancel()
+                self.finished_at = time.monotonic()
+
+    async def list_kind(self, kind, queue):
+        """Ставит в очередь файлы одного типа, страницами от новых к старым"""
+        offset_id = 0
+        while True:
+            page = await retrying(lambda: self.model.search_media(self.entity, kind, offset_id, SEARCH_PAGE_SIZE))
+            if not page:
+                return
+            for msg in page:
+                media = MediaRef.from_message(msg)
+                if media and msg.id not in self.seen:
+                    self.seen.add(msg.id)
+                    await self.add(msg, media, queue)
+            # Неполная страница - последняя, лишний пустой запрос не нужен
+            if len(page) < SEARCH_PAGE_SIZE:
+                return
+            offset_id = page[-1].id
+
+    async def add(self, msg, media, queue):
+        path = os.path.join(self.directory, f"{msg.id}{media.ext}")
+        if is_complete(path, media.size):
+            self.existing += 1
+            return
+        for downloaded in glob.glob(os.path.join(glob.escape(self.downloads_directory), f"{msg.id}.*")):
+            if is_complete(downloaded, media.size):
+                shutil.copyfile(downloaded, path)
+                self.existing += 1
+                return
+        self.found += 1
+        self.total_bytes += media.size or 0
+        await queue.put((msg, path))
+
+    async def worker(self, queue):
+        while True:
+            msg, path = await queue.get()
+
+            def progress(current, total):
+                self.progress[path] = current
+
+            try:
+                size = await retrying(lambda: self.model.download_message_file(msg, path, progress_callback=progress))
+                self.finished_bytes += size
+                self.downloaded += 1
+            except Exception:
+                self.failed += 1
+            finally:
+                self.progress.pop(path, None)
+                queue.task_done()
+
+    def status(self):
+        """Строка для заголовка: сколько файлов и байт загружено и скорость"""
+        if self.error:
+            return f"загрузка файлов не удалась: {self.error}"
+        received = self.finished_bytes + sum(self.progress.values())
+        more = '+' if self.listing else ''
+        if self.done:
+            status = f"файлы загружены: {self.downloaded}, {format_size(received)}"
+        else:
+            speed = received / max(time.monotonic() - self.started, 1e-3) / (1024 * 1024)
+            status = (f"файлы {self.title}: {self.downloaded}/{self.found}{more}, "
+                      f"{format_size(received)} из {format_size(self.total_bytes)}{more}, {speed:.1f} МБ/с")
+        if self.existing:
+            status += f", уже были {self.existing}"
+        if self.failed:
+            status += f", не загружено {self.failed}"
+        return status
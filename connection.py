@@ -0,0 +1,115 @@
+import time
+import asyncio
+
+# Пауза между попытками переподключения: от RECONNECT_DELAY, удваивается до RECONNECT_MAX_DELAY секунд
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# Состояния соединения
+CONNECTING = 'connecting'
+ONLINE = 'online'
+RECONNECTING = 'reconnecting'
+
+
+class ConnectionMonitor:
+    """Следит за соединением и переподключается, догружая пропущенные обновления
+
+    Обрыв замечается по разрыву соединения клиента или по ConnectionError
+    в любом запросе. После переподключения catch_up запрашивает у сервера
+    только разницу с последней известной позицией, и пропущенные сообщения,
+    правки и удаления приходят через обычные обработчики событий.
+    """
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.scheduler.on_connection_error = self.lost
+        self.state = CONNECTING
+        self.lost_event = asyncio.Event()
+        self.closing = False
+        self.reconnects = 0
+        self.last_error = None
+        self.offline_since = None
+        self.last_outage = None
+        # Функции (состояние), вызываемые при каждой смене состояния
+        self.listeners = []
+
+    def lost(self, error=None):
+        """Сообщает о потере соединения, замеченной в запросе"""
+        if error is not None:
+            self.last_error = str(error)
+        if self.state == ONLINE:
+            self.set_state(RECONNECTING)
+        self.lost_event.set()
+
+    def set_state(self, state):
+        self.state = state
+        # Пока переподключаемся, запросы сразу получают ConnectionError, а не висят в очереди
+        self.scheduler.set_offline(state == RECONNECTING)
+        if state == RECONNECTING and self.offline_since is None:
+            self.offline_since = time.monotonic()
+        elif state == ONLINE and self.offline_since is not None:
+            self.last_outage = time.monotonic() - self.offline_since
+            self.offline_since = None
+        for listener in self.listeners:
+            listener(state)
+
+    async def watch(self):
+        """Ждет обрывов и восстанавливает соединение, пока клиент не отключат явно"""
+        self.set_state(ONLINE)
+        while not self.closing:
+            lost = asyncio.ensure_future(self.lost_event.wait())
+            disconnected = asyncio.ensure_future(self.client.disconnected)
+            try:
+                await asyncio.wait({lost, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                lost.cancel()
+                disconnected.cancel()
+            if self.closing:
+                return
+            await self.reconnect()
+
+    async def retry(self, attempt, on_error=None):
+        """Повторяет attempt() с нарастающей паузой, пока он не пройдет без ошибки
+
+        Args:
+            attempt: Функция без аргументов, возвращающая корутину
+            on_error: Функция (ошибка), вызывается после каждой неудачной попытки
+
+        Returns:
+            True, если попытка удалась, False, если клиент отключили раньше
+        """
+        delay = RECONNECT_DELAY
+        while not self.closing:
+            try:
+                await attempt()
+                return True
+            except Exception as e:
+                self.last_error = str(e)
+                if on_error:
+                    on_error(e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+
+    async def restore(self):
+        if not self.client.is_connected():
+            await self.client.connect()
+        await self.client.catch_up()
+
+    async def reconnect(self):
+        """Переподключается с нарастающей паузой и запрашивает пропущенные обновления"""
+        self.set_state(RECONNECTING)
+        await self.retry(self.restore)
+        self.lost_event.clear()
+        if not self.closing:
+            self.reconnects += 1
+            self.set_state(ONLINE)
+
+    def status(self):
+        """Состояние соединения для метрик"""
+        return {
+            'state': self.state,
+            'reconnects': self.reconnects,
+            'last_error': self.last_error,
+            'last_outage_s': round(self.last_outage, 2) if self.last_outage is not None else None
+        }
@@ -0,0 +1,407 @@
+"""Экспорт истории чата в JSONL, Markdown или HTML
+
+Из интерфейса экспорт открытого чата запускается клавишей e, из командной строки:
+
+    python export.py <чат> [--format jsonl|md|html] [--output путь] [--media] [--takeout]
+
+Чат задается id, @username или, с --fake, названием поддельного чата.
+"""
+import os
+import sys
+import json
+import html
+import time
+import asyncio
+import argparse
+from datetime import datetime
+
+from telethon import utils
+from telethon.tl import types
+from telethon.errors import FloodWaitError, TakeoutInitDelayError
+
+from messages import MessageRecord, format_size
+from outbox import is_retryable, RETRY_DELAY, RETRY_MAX_DELAY
+from scheduler import priority, NORMAL
+from tracing import tracer
+
+# Куда сохранять экспорт, если путь не задан
+EXPORT_DIR = 'exports'
+# Сколько сообщений запрашивать за одну страницу (больше сервер не отдает)
+EXPORT_PAGE_SIZE = 100
+# Позиция сохраняется раз в столько сообщений, после загрузки всех их файлов
+CHECKPOINT_EVERY = 1000
+CHECKPOINT_VERSION = 1
+# Сколько файлов загружать одновременно и сколько сообщений с файлами может ждать загрузки:
+# если загрузка отстает, чтение истории приостанавливается, и память не растет
+MEDIA_WORKERS = 3
+MEDIA_QUEUE = 20
+
+
+def message_data(record, media_file=None):
+    """Запись сообщения в виде словаря для экспорта
+
+    Args:
+        record: MessageRecord
+        media_file: Путь к загруженному файлу сообщения относительно файла экспорта
+    """
+    data = {
+        'id': record.id,
+        'date': record.date.isoformat() if record.date else None,
+        'sender_id': record.sender_id,
+        'sender': record.sender_name,
+        'out': record.out,
+        'text': record.text
+    }
+    if record.reply_to:
+        data['reply_to'] = record.reply_to
+    if record.edit_date:
+        data['edited'] = record.edit_date.isoformat()
+    if record.media:
+        media = record.media
+        data['media'] = {'kind': media.kind, 'name': media.name, 'mime_type': media.mime_type, 'size': media.size}
+        if media_file:
+            data['media']['file'] = media_file
+    return data
+
+
+async def retrying(call):
+    """Повторяет запрос (корутину без аргументов) при временных ошибках: обрыв, FloodWait, сбой сервера"""
+    delay = RETRY_DELAY
+    while True:
+        try:
+            return await call()
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            await asyncio.sleep(e.seconds if isinstance(e, FloodWaitError) else delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+def display_date(value):
+    """Дата из ISO-строки в местном времени для чтения человеком"""
+    if not value:
+        return ''
+    return datetime.fromisoformat(value).astimezone().strftime('%Y-%m-%d %H:%M')
+
+
+def sender_label(data):
+    return data['sender'] or (str(data['sender_id']) if data['sender_id'] else '?')
+
+
+class JsonlWriter:
+    """Одно сообщение - одна строка JSON"""
+    extension = '.jsonl'
+
+    def header(self, title):
+        return ''
+
+    def message(self, data):
+        return json.dumps(data, ensure_ascii=False) + '\n'
+
+    def footer(self):
+        return ''
+
+
+class MarkdownWriter:
+    """Сообщения абзацами: отправитель и дата, ответ цитатой, файл ссылкой"""
+    extension = '.md'
+
+    def header(self, title):
+        return f"# {title}\n\n"
+
+    def message(self, data):
+        meta = f"**{sender_label(data)}** · {display_date(data['date'])} · #{data['id']}"
+        if 'edited' in data:
+            meta += " · изменено"
+        parts = [meta]
+        if 'reply_to' in data:
+            parts.append(f"> в ответ на #{data['reply_to']}")
+        if data['text']:
+            parts.append(data['text'])
+        media = data.get('media')
+        if media:
+            name = media['name'] or media['kind']
+            size = format_size(media['size'])
+            parts.append(f"[{name}]({media['file']}) ({size})" if 'file' in media else f"{name} ({size})")
+        return '\n\n'.join(parts) + '\n\n'
+
+    def footer(self):
+        return ''
+
+
+class HtmlWriter:
+    """Страница со стилями прямо в файле; у каждого сообщения якорь #m<id>"""
+    extension = '.html'
+
+    def header(self, title):
+        title = html.escape(title)
+        return (
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            f'<title>{title}</title>\n<style>\n'
+            'body { font-family: sans-serif; max-width: 50em; margin: auto; }\n'
+            '.message { margin: 1em 0; }\n'
+            '.meta { color: #777; font-size: 90%; }\n'
+            '.reply { border-left: 3px solid #ccc; padding-left: .5em; }\n'
+            '.text { white-space: pre-wrap; }\n'
+            f'</style></head><body>\n<h1>{title}</h1>\n'
+        )
+
+    def message(self, data):
+        msg_id = data['id']
+        meta = f"<b>{html.escape(sender_label(data))}</b> {display_date(data['date'])} <a href=\"#m{msg_id}\">#{msg_id}</a>"
+        if 'edited' in data:
+            meta += " изменено"
+        parts = [f'<div class="message" id="m{msg_id}">', f'<div class="meta">{meta}</div>']
+        if 'reply_to' in data:
+            parts.append(f"<div class=\"reply\"><a href=\"#m{data['reply_to']}\">в ответ на #{data['reply_to']}</a></div>")
+        if data['text']:
+            parts.append(f"<div class=\"text\">{html.escape(data['text'])}</div>")
+        media = data.get('media')
+        if media:
+            name = html.escape(media['name'] or media['kind'])
+            size = format_size(media['size'])
+            link = f"<a href=\"{html.escape(media['file'])}\">{name}</a>" if 'file' in media else name
+            parts.append(f'<div class="media">{link} ({size})</div>')
+        parts.append('</div>')
+        return '\n'.join(parts) + '\n'
+
+    def footer(self):
+        return '</body></html>\n'
+
+
+WRITERS = {'jsonl': JsonlWriter, 'md': MarkdownWriter, 'html': HtmlWriter}
+
+
+class ChatExport:
+    """Экспорт всей истории чата в файл с постоянным расходом памяти
+
+    История читается страницами от старых сообщений к новым, каждая страница сразу
+    дописывается в файл и забывается. Файлы сообщений загружает небольшой пул задач
+    из очереди ограниченного размера. Рядом с файлом экспорта хранится позиция
+    (<файл>.checkpoint.json): прерванный экспорт продолжается с нее, а повторный
+    дописывает только новые сообщения.
+
+    Args:
+        model: TelegramModel
+        entity: Чат Telethon
+        title: Название чата
+        path: Файл экспорта; по умолчанию exports/<название>.<формат>
+        fmt: Формат: jsonl, md или html
+        media: Загружать файлы сообщений в папку <файл>_files рядом с экспортом
+        takeout: Читать историю через сессию экспорта Telegram с более мягкими
+            ограничениями частоты; первый раз ее нужно подтвердить в другом приложении
+    """
+    def __init__(self, model, entity, title, path=None, fmt='jsonl', media=False, takeout=False):
+        if fmt not in WRITERS:
+            raise ValueError(f"Неизвестный формат {fmt}, доступны: {', '.join(WRITERS)}")
+        self.model = model
+        self.entity = entity
+        self.title = title
+        self.format = fmt
+        self.writer = WRITERS[fmt]()
+        self.path = path or os.path.join(EXPORT_DIR, model.safe_file_name(title) + self.writer.extension)
+        self.checkpoint_path = self.path + '.checkpoint.json'
+        self.files_dir = os.path.splitext(self.path)[0] + '_files'
+        self.chat_id = utils.get_peer_id(entity)
+        self.media = media
+        self.takeout = takeout
+        self.last_id = 0
+        self.exported = 0
+        self.resumed_from = 0
+        self.files_queued = 0
+        self.files_done = 0
+        self.files_existing = 0
+        self.files_failed = 0
+        self.files_bytes = 0
+        self.done = False
+        self.error = None
+        self.started = time.monotonic()
+        self.finished_at = None
+
+    def load_checkpoint(self):
+        """Позиция прошлого экспорта этого чата в этот же файл или None"""
+        if not os.path.exists(self.path) or not os.path.exists(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if (data.get('version') != CHECKPOINT_VERSION or data['chat_id'] != self.chat_id
+                    or data['format'] != self.format or os.path.getsize(self.path) < data['offset']):
+                return None
+            return data
+        except Exception:
+            # Поврежденная позиция - экспортируем заново
+            return None
+
+    def save_checkpoint(self, f):
+        """Запоминает, до какого сообщения и до какого байта файл экспорта уже записан"""
+        f.flush()
+        os.fsync(f.fileno())
+        data = {
+            'version': CHECKPOINT_VERSION,
+            'chat_id': self.chat_id,
+            'format': self.format,
+            'last_id': self.last_id,
+            'count': self.exported,
+            'offset': f.tell()
+        }
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            json.dump(data, out, separators=(',', ':'))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def forget_checkpoint(self):
+        """Следующий запуск экспортирует историю с начала"""
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    async def run(self):
+        """Экспортирует историю; ошибка не выбрасывается, а остается в error"""
+        with tracer.cause('export'), priority(NORMAL):
+            try:
+                if self.takeout:
+                    async with self.model.client.takeout(
+                        finalize=True, users=True, chats=True, megagroups=True, channels=True, files=self.media or None
+                    ) as takeout:
+                        await self.export(takeout)
+                else:
+                    await self.export(None)
+                self.done = True
+            except TakeoutInitDelayError as e:
+                self.error = f"подтвердите экспорт в другом приложении Telegram и повторите через {e.seconds} с"
+            except Exception as e:
+                self.error = str(e) or type(e).__name__
+            finally:
+                self.finished_at = time.monotonic()
+
+    async def export(self, takeout):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            # Все, что записано после сохраненной позиции (в том числе конец HTML), пишется заново
+            f = open(self.path, 'r+b')
+            f.truncate(checkpoint['offset'])
+            f.seek(checkpoint['offset'])
+            self.last_id = checkpoint['last_id']
+            self.exported = self.resumed_from = checkpoint['count']
+        else:
+            f = open(self.path, 'wb')
+            f.write(self.writer.header(self.title).encode())
+
+        queue = asyncio.Queue(MEDIA_QUEUE)
+        workers = [asyncio.create_task(self.media_worker(queue, takeout)) for _ in range(MEDIA_WORKERS)] if self.media else []
+        try:
+            with f:
+                since_checkpoint = 0
+                while True:
+                    page = await retrying(lambda: self.model.export_page(self.entity, self.last_id, EXPORT_PAGE_SIZE, takeout))
+                    if not page:
+                        break
+                    for msg in page:
+                        record = MessageRecord.from_message(msg)
+                        media_file = None
+                        if self.media and record.media and not isinstance(msg.media, types.MessageMediaWebPage):
+                            media_file = await self.queue_file(queue, msg, record.media)
+                        f.write(self.writer.message(message_data(record, media_file)).encode())
+                        self.last_id = msg.id
+                        self.exported += 1
+                    since_checkpoint += len(page)
+                    if since_checkpoint >= CHECKPOINT_EVERY:
+                        # Позиция не должна обогнать незагруженные файлы
+                        await queue.join()
+                        self.save_checkpoint(f)
+                        since_checkpoint = 0
+                await queue.join()
+                self.save_checkpoint(f)
+                f.write(self.writer.footer().encode())
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def queue_file(self, queue, msg, media):
+        """Ставит файл сообщения в очередь загрузки, если его еще нет на диске
+
+        Returns:
+            Путь к файлу относительно файла экспорта
+        """
+        name = f"{msg.id}{media.ext}"
+        path = os.path.join(self.files_dir, name)
+        if os.path.exists(path):
+            self.files_existing += 1
+        else:
+            os.makedirs(self.files_dir, exist_ok=True)
+            self.files_queued += 1
+            await queue.put((msg, path))
+        return os.path.join(os.path.basename(self.files_dir), name)
+
+    async def media_worker(self, queue, takeout):
+        while True:
+            msg, path = await queue.get()
+            try:
+                size = await retrying(lambda: self.model.download_message_file(msg, path, takeout))
+                self.files_bytes += size
+                self.files_done += 1
+            except Exception:
+                # Недостающий файл загрузится при повторном экспорте с начала
+                self.files_failed += 1
+            finally:
+                queue.task_done()
+
+    def status(self):
+        """Строка для заголовка: сколько сообщений и файлов экспортировано"""
+        if self.error:
+            return f"экспорт не удался: {self.error}"
+        if self.done:
+            status = f"экспорт готов: {self.path}, {self.exported - self.resumed_from} новых сообщений"
+        else:
+            status = f"экспорт {self.title}: {self.exported} сообщений"
+        if self.media:
+            status += f", файлы {self.files_done}/{self.files_queued} ({format_size(self.files_bytes)})"
+            if self.files_failed:
+                status += f", не загружено {self.files_failed}"
+        return status
+
+
+async def export_from_command_line(args):
+    from main import create_model
+    model = create_model()
+    await model.connect()
+    try:
+        if not await model.is_user_authorized():
+            print("Сначала войдите в аккаунт: python main.py")
+            return 1
+        chat = int(args.chat) if args.chat.lstrip('-').isdigit() else args.chat
+        entity = await model.client.get_entity(chat)
+        export = ChatExport(model, entity, utils.get_display_name(entity) or args.chat,
+                            args.output, args.format, args.media, args.takeout)
+        if args.restart:
+            export.forget_checkpoint()
+
+        task = asyncio.create_task(export.run())
+        while not task.done():
+            print('\r' + export.status() + '\033[K', end='', flush=True)
+            await asyncio.wait({task}, timeout=0.5)
+        print('\r' + export.status() + '\033[K')
+        return 1 if export.error else 0
+    finally:
+        await model.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Экспорт истории чата")
+    parser.add_argument('chat', help="id чата или @username")
+    parser.add_argument('--format', choices=list(WRITERS), default='jsonl', help="формат файла")
+    parser.add_argument('--output', help=f"файл экспорта, по умолчанию {EXPORT_DIR}/<чат>.<формат>")
+    parser.add_argument('--media', action='store_true', help="загрузить файлы сообщений")
+    parser.add_argument('--takeout', action='store_true', help="сессия экспорта Telegram с более мягкими ограничениями")
+    parser.add_argument('--restart', action='store_true', help="начать с начала, а не с сохраненной позиции")
+    parser.add_argument('--fake', action='store_true', help="поддельный бэкенд без сети")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(export_from_command_line(args)))
+
+
+if __name__ == '__main__':
+    main()
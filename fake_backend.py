@@ -0,0 +1,659 @@
+"""Локальный поддельный бэкенд Telegram для нагрузочного тестирования без сети
+
+Отдельного интерфейса бэкенда нет: им служит сам объект клиента. TelegramModel
+обращается только к части API TelegramClient - подключение и поток обновлений
+(connect, disconnect, disconnected, is_connected, catch_up, add_event_handler,
+session), диалоги и история (iter_dialogs, get_dialogs, get_messages, get_entity,
+send_read_acknowledge), файлы (download_media, download_file, iter_download,
+send_file, takeout) и сырые запросы через вызов клиента. FakeTelegramClient
+повторяет именно эту часть и отдает синтетические диалоги, страницы истории и
+файлы. Запрос, которого он не знает, завершается NotImplementedError, а не
+выдуманным ответом. Умеет добавлять задержку, FloodWait, обрывы соединения и
+поток новых сообщений с заданной частотой:
+
+    model = fake_model(FakeTelegramClient(latency=0.2))
+
+Запуск как скрипта измеряет пропускную способность обработчиков и задержку
+интерфейса под нагрузкой:
+
+    python fake_backend.py --rate 200 --duration 10
+
+С --check-flood скрипт проверяет, что короткий FloodWait, который Telethon по
+умолчанию пережидает сам, доходит до планировщика модели.
+"""
+import os
+import random
+import tempfile
+import asyncio
+import contextlib
+import argparse
+import types as pytypes
+from datetime import datetime, timedelta, timezone
+
+from telethon import events
+from telethon.errors import FloodWaitError, RandomIdDuplicateError
+from telethon.tl import types, functions
+from telethon.tl.custom.file import File
+
+from thumbs import huffman_table
+
+WORDS = ['привет', 'как', 'дела', 'ok', 'завтра', 'встреча', 'сервер', 'упал', '日本語', '🙂', 'the', 'build']
+
+# Стандартная таблица Хаффмана для DC-коэффициентов (JPEG, приложение K)
+DC_COUNTS = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)
+DC_CODES = {symbol: (length, code) for (length, code), symbol in huffman_table(DC_COUNTS, range(12)).items()}
+
+
+def fake_file_bytes(media_id, offset, length):
+    """Содержимое файла поддельного бэкенда: байт на смещении i равен (i + id) % 251"""
+    start = (offset + media_id) % 251
+    pattern = bytes(range(251))
+    repeated = pattern[start:] + pattern * (length // 251 + 1)
+    return repeated[:length]
+
+
+def fake_jpeg(width, height, seed):
+    """Baseline JPEG из одноцветных блоков 8x8 (только DC-коэффициенты) - миниатюра без настоящей картинки"""
+    out = bytearray()
+    acc = bits = 0
+
+    def put(value, length):
+        nonlocal acc, bits
+        acc = (acc << length) | value
+        bits += length
+        while bits >= 8:
+            bits -= 8
+            byte = (acc >> bits) & 0xFF
+            out.append(byte)
+            if byte == 0xFF:
+                out.append(0)
+
+    blocks_x, blocks_y = (width + 7) // 8, (height + 7) // 8
+    predictors = [0, 0, 0]
+    for block_y in range(blocks_y):
+        for block_x in range(blocks_x):
+            # Плавный градиент, свой для каждого seed
+            r = (seed * 37 + block_x * 255 // blocks_x) % 256
+            g = (seed * 91 + block_y * 255 // blocks_y) % 256
+            b = (seed * 53 + (block_x + block_y) * 128 // (blocks_x + blocks_y)) % 256
+            ycbcr = (
+                0.299 * r + 0.587 * g + 0.114 * b,
+                128 - 0.168736 * r - 0.331264 * g + 0.5 * b,
+                128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+            )
+            for index, value in enumerate(ycbcr):
+                dc = int(round((value - 128) * 8))
+                diff = dc - predictors[index]
+                predictors[index] = dc
+                category = abs(diff).bit_length()
+                length, code = DC_CODES[category]
+                put(code, length)
+                if category:
+                    put(diff if diff > 0 else diff + (1 << category) - 1, category)
+                # Конец блока: в таблице AC единственный символ EOB с кодом "0"
+                put(0, 1)
+    if bits:
+        put((1 << (8 - bits)) - 1, 8 - bits)
+
+    header = bytearray(b'\xff\xd8')
+    header += b'\xff\xdb\x00\x43\x00' + b'\x01' * 64
+    header += bytes([0xFF, 0xC0, 0x00, 0x11, 0x08, height >> 8, height & 0xFF, width >> 8, width & 0xFF, 0x03,
+                     1, 0x11, 0, 2, 0x11, 0, 3, 0x11, 0])
+    header += b'\xff\xc4\x00\x1f\x00' + bytes(DC_COUNTS) + bytes(range(12))
+    header += b'\xff\xc4\x00\x14\x10' + bytes([1] + [0] * 15) + b'\x00'
+    header += b'\xff\xda\x00\x0c\x03\x01\x00\x02\x00\x03\x00\x00\x3f\x00'
+    return bytes(header + out + b'\xff\xd9')
+
+
+class FakeSession:
+    save_entities = False
+
+
+def matches_filter(message, filter):
+    """Подходит ли сообщение под серверный фильтр messages.search"""
+    if filter is types.InputMessagesFilterPhotos:
+        return message.photo is not None
+    if filter is types.InputMessagesFilterVideo:
+        return message.video is not None
+    if filter is types.InputMessagesFilterVoice:
+        return message.voice is not None
+    if filter is types.InputMessagesFilterDocument:
+        return message.document is not None and message.video is None and message.voice is None
+    if filter is types.InputMessagesFilterUrl:
+        return any(isinstance(entity, (types.MessageEntityUrl, types.MessageEntityTextUrl)) for entity in message.entities or ())
+    return False
+
+
+class FakeDialog:
+    """Диалог с полями, которые читает интерфейс"""
+    def __init__(self, entity, title, message=None, unread_count=0, archived=False):
+        self.entity = entity
+        self.id = entity.id
+        self.title = title
+        self.name = title
+        self.message = message
+        self.unread_count = unread_count
+        self.unread_mentions_count = 0
+        self.pinned = False
+        self.archived = archived
+
+
+class FakeDialogIter:
+    """Итератор диалогов, который отдает их страницами по 100, как Telethon"""
+    def __init__(self, client, dialogs):
+        self.client = client
+        self.dialogs = dialogs
+        self.position = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.position >= len(self.dialogs):
+            raise StopAsyncIteration
+        if self.position % 100 == 0:
+            await self.client.request('GetDialogsRequest')
+        dialog = self.dialogs[self.position]
+        self.position += 1
+        return dialog
+
+
+class FakeTelegramClient:
+    """Поддельный клиент: синтетические данные в памяти и настраиваемые сбои
+
+    Args:
+        dialogs: Сколько диалогов создать
+        messages_per_dialog: Сколько сообщений истории в каждом диалоге
+        latency: Задержка каждого запроса в секундах
+        jitter: Случайная добавка к задержке, до jitter секунд
+        flood_rate: Доля запросов, которые завершаются FloodWait
+        flood_seconds: Сколько секунд ожидания сообщает FloodWait; как и Telethon, клиент
+            сам ждет FloodWait не длиннее flood_sleep_threshold и не выбрасывает ошибку
+        disconnect_rate: Доля запросов, на которых соединение обрывается
+        media_rate: Доля сообщений с файлами
+        seed: Зерно генератора данных
+    """
+    def __init__(self, dialogs=200, messages_per_dialog=500, latency=0.05, jitter=0.0,
+                 flood_rate=0.0, flood_seconds=3, disconnect_rate=0.0, media_rate=0.1, seed=0):
+        self.session = FakeSession()
+        self.parse_mode = None
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        # Значение по умолчанию в Telethon
+        self.flood_sleep_threshold = 60
+        self.disconnect_rate = disconnect_rate
+        self.media_rate = media_rate
+        self.rng = random.Random(seed)
+        self.connected = False
+        self.disconnected_future = None
+        # События, случившиеся без соединения: их отдает catch_up после переподключения
+        self.missed = []
+        self.handlers = []
+        # Сколько байт каждого загружаемого файла уже принято
+        self.uploads = {}
+        self.sent_random_ids = set()
+        self.firehose_task = None
+        self.me = types.User(id=1, first_name="Я", is_self=True)
+
+        self.users = {}
+        self.dialogs = []
+        self.history = {}
+        for i in range(dialogs):
+            chat_id = 1000 + i
+            if i % 5 == 4:
+                entity = types.Channel(id=chat_id, title=f"Канал {i}", photo=types.ChatPhotoEmpty(), date=None, broadcast=True, access_hash=chat_id)
+            else:
+                entity = types.User(id=chat_id, first_name=f"Собеседник {i}", access_hash=chat_id)
+                self.users[chat_id] = entity
+            self.history[chat_id] = [self.make_message(chat_id, msg_id) for msg_id in range(1, messages_per_dialog + 1)]
+            title = getattr(entity, 'title', None) or entity.first_name
+            last = self.history[chat_id][-1] if self.history[chat_id] else None
+            self.dialogs.append(FakeDialog(entity, title, last, unread_count=i % 3, archived=i % 10 == 9))
+
+    def make_message(self, chat_id, msg_id, text=None, out=None, date=None):
+        """Сообщение Telethon с синтетическим текстом и, иногда, файлом"""
+        rng = self.rng
+        if out is None:
+            out = rng.random() < 0.3
+        sender = self.me if out else self.users.get(chat_id)
+        media = None
+        if rng.random() < self.media_rate / 2:
+            # Фото с миниатюрой 90x60 и большой версией, как их отдает сервер
+            media = types.MessageMediaPhoto(photo=types.Photo(
+                id=chat_id * 100_000 + msg_id, access_hash=0, file_reference=b'', date=None, dc_id=1,
+                sizes=[types.PhotoSize('s', 90, 60, 600), types.PhotoSize('y', 1280, 853, 200_000)]
+            ))
+        elif rng.random() < self.media_rate:
+            size = rng.randint(10_000, 5_000_000)
+            if msg_id % 3:
+                mime_type, attributes = 'application/pdf', [types.DocumentAttributeFilename(f"file_{msg_id}.pdf")]
+            else:
+                # Каждый третий файл - видео, его можно смотреть потоком
+                mime_type, attributes = 'video/mp4', [
+                    types.DocumentAttributeVideo(duration=60, w=640, h=360),
+                    types.DocumentAttributeFilename(f"video_{msg_id}.mp4")
+                ]
+            media = types.MessageMediaDocument(document=types.Document(
+                id=chat_id * 100_000 + msg_id, access_hash=0, file_reference=b'', date=None,
+                mime_type=mime_type, size=size, dc_id=1, attributes=attributes
+            ))
+        message_text = text if text is not None else ' '.join(rng.choices(WORDS, k=rng.randint(1, 40)))
+        entities = None
+        if text is None and msg_id % 11 == 0:
+            # Каждое одиннадцатое сообщение со ссылкой; смещения в Telegram считаются в UTF-16
+            url = f"https://example.com/{chat_id}/{msg_id}"
+            entities = [types.MessageEntityUrl(offset=len(message_text.encode('utf-16-le')) // 2 + 1, length=len(url))]
+            message_text += ' ' + url
+        peer = types.PeerChannel(chat_id) if chat_id not in self.users else types.PeerUser(chat_id)
+        message = types.Message(
+            id=msg_id,
+            peer_id=peer,
+            date=date or datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=msg_id * 7),
+            message=message_text,
+            out=out,
+            from_id=types.PeerUser(sender.id) if sender else None,
+            media=media,
+            entities=entities
+        )
+        message._sender = sender
+        return message
+
+    async def request(self, name):
+        """Имитирует поход на сервер: задержка, FloodWait и обрывы"""
+        if not self.connected:
+            raise ConnectionError("Not connected")
+        await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+        if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+            self.drop_connection()
+            raise ConnectionError(f"Connection lost during {name}")
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            if self.flood_seconds > self.flood_sleep_threshold:
+                raise FloodWaitError(request=None, capture=self.flood_seconds)
+            await asyncio.sleep(self.flood_seconds)
+
+    # API TelegramClient, которым пользуется TelegramModel
+
+    async def connect(self):
+        await asyncio.sleep(self.latency)
+        self.connected = True
+
+    async def disconnect(self):
+        self.drop_connection()
+        if self.firehose_task and not self.firehose_task.done():
+            self.firehose_task.cancel()
+
+    def drop_connection(self):
+        """Обрывает соединение: события до переподключения копятся в missed"""
+        self.connected = False
+        if self.disconnected_future and not self.disconnected_future.done():
+            self.disconnected_future.set_result(None)
+
+    def is_connected(self):
+        return self.connected
+
+    @property
+    def disconnected(self):
+        """Future, которое завершается при обрыве соединения, как в Telethon"""
+        if self.disconnected_future is None or (self.connected and self.disconnected_future.done()):
+            self.disconnected_future = asyncio.get_running_loop().create_future()
+        if not self.connected and not self.disconnected_future.done():
+            self.disconnected_future.set_result(None)
+        return asyncio.shield(self.disconnected_future)
+
+    async def catch_up(self):
+        """Отдает обработчикам события, пропущенные без соединения"""
+        await self.request('GetDifferenceRequest')
+        missed, self.missed = self.missed, []
+        for builder, event in missed:
+            self.dispatch(builder, event)
+
+    async def is_user_authorized(self):
+        return True
+
+    async def start(self, phone=None):
+        await self.connect()
+        return self
+
+    def folder_dialogs(self, folder):
+        if folder is None:
+            return list(self.dialogs)
+        return [dialog for dialog in self.dialogs if dialog.archived == (folder == 1)]
+
+    async def get_dialogs(self, limit=100, folder=None):
+        await self.request('GetDialogsRequest')
+        return self.folder_dialogs(folder)[:limit]
+
+    def iter_dialogs(self, folder=None):
+        return FakeDialogIter(self, self.folder_dialogs(folder))
+
+    async def get_messages(self, entity, limit=20, offset_id=0, reverse=False, ids=None, filter=None):
+        await self.request('SearchRequest' if filter else 'GetHistoryRequest')
+        chat_id = entity.entity.id if hasattr(entity, 'entity') else entity.id
+        history = self.history.get(chat_id, [])
+        if filter:
+            history = [message for message in history if matches_filter(message, filter)]
+        if ids is not None:
+            for message in history:
+                if message.id == ids:
+                    return message
+            return None
+        if reverse:
+            return [message for message in history if message.id > offset_id][:limit]
+        if offset_id:
+            history = [message for message in history if message.id < offset_id]
+        return list(reversed(history[-limit:])) if limit else []
+
+    async def send_read_acknowledge(self, entity):
+        await self.request('ReadHistoryRequest')
+        return True
+
+    async def get_entity(self, entity):
+        """Чат по id или названию"""
+        await self.request('ResolveUsernameRequest')
+        for dialog in self.dialogs:
+            if entity in (dialog.entity.id, dialog.title):
+                return dialog.entity
+        raise ValueError(f'Cannot find any entity corresponding to "{entity}"')
+
+    @contextlib.asynccontextmanager
+    async def takeout(self, finalize=True, **kwargs):
+        """Сессия экспорта: запросы те же, что и у обычного клиента"""
+        await self.request('InitTakeoutSessionRequest')
+        yield self
+        await self.request('FinishTakeoutSessionRequest')
+
+    async def download_file(self, location, file=None, dc_id=None):
+        """Миниатюра фото: синтетическая картинка, своя для каждого фото"""
+        await self.request('GetFileRequest')
+        return fake_jpeg(90, 60, location.id % 1000)
+
+    async def iter_download(self, file, offset=0, request_size=512 * 1024, file_size=None):
+        """Части файла по порядку, начиная с offset; содержимое зависит только от id и смещения"""
+        document = getattr(file, 'document', None)
+        size = file_size or getattr(document, 'size', None) or 100_000
+        media_id = getattr(document, 'id', 0)
+        while offset < size:
+            await self.request('GetFileRequest')
+            part = min(request_size, size - offset)
+            yield fake_file_bytes(media_id, offset, part)
+            offset += part
+
+    async def download_media(self, media, file, progress_callback=None):
+        """Пишет на диск файл нужного размера, сообщая прогресс частями"""
+        document = getattr(media, 'document', None)
+        photo = getattr(media, 'photo', None)
+        size = getattr(document, 'size', None) or (File(photo).size if photo else None) or 100_000
+        path = f"{file}.pdf" if not os.path.splitext(file)[1] else file
+        chunk = 512 * 1024
+        written = 0
+        with open(path, 'wb') as f:
+            while written < size:
+                await self.request('GetFileRequest')
+                part = min(chunk, size - written)
+                f.write(b'\0' * part)
+                written += part
+                if progress_callback:
+                    result = progress_callback(written, size)
+                    if asyncio.iscoroutine(result):
+                        await result
+        return path
+
+    async def send_file(self, entity, file, caption='', reply_to=None, force_document=False):
+        """Отправляет файл, загруженный частями через SaveFilePart/SaveBigFilePart"""
+        await self.request('SendMediaRequest')
+        chat_id = entity.id
+        history = self.history.setdefault(chat_id, [])
+        msg_id = history[-1].id + 1 if history else 1
+        sent = self.make_message(chat_id, msg_id, text=caption, out=True, date=datetime.now(timezone.utc))
+        sent.media = types.MessageMediaDocument(document=types.Document(
+            id=file.id, access_hash=0, file_reference=b'', date=None,
+            mime_type='application/octet-stream', size=self.uploads.pop(file.id, 0), dc_id=1,
+            attributes=[types.DocumentAttributeFilename(file.name)]
+        ))
+        history.append(sent)
+        asyncio.get_running_loop().call_soon(self.emit_new_message, sent)
+        return sent
+
+    def send_raw_message(self, request):
+        """messages.SendMessageRequest: сообщение, эхо событием и короткий ответ, как для личного чата"""
+        peer = request.peer
+        chat_id = getattr(peer, 'user_id', None) or getattr(peer, 'channel_id', None) or getattr(peer, 'chat_id', None)
+        history = self.history.setdefault(chat_id, [])
+        # Повтор уже доставленной попытки
+        if request.random_id in self.sent_random_ids:
+            raise RandomIdDuplicateError(request=request)
+        self.sent_random_ids.add(request.random_id)
+        msg_id = history[-1].id + 1 if history else 1
+        sent = self.make_message(chat_id, msg_id, text=request.message, out=True, date=datetime.now(timezone.utc))
+        sent.media = None
+        history.append(sent)
+        asyncio.get_running_loop().call_soon(self.emit_new_message, sent)
+        return types.UpdateShortSentMessage(out=True, id=msg_id, pts=0, pts_count=0, date=sent.date)
+
+    async def __call__(self, request):
+        """Сырые запросы, которые отправляет модель; остальные не поддерживаются"""
+        supported = (functions.upload.SaveFilePartRequest, functions.upload.SaveBigFilePartRequest,
+                     functions.messages.SendMessageRequest, functions.users.GetFullUserRequest)
+        if not isinstance(request, supported):
+            raise NotImplementedError(f"FakeTelegramClient не поддерживает {type(request).__name__}")
+        await self.request(type(request).__name__)
+        if isinstance(request, functions.messages.SendMessageRequest):
+            return self.send_raw_message(request)
+        if isinstance(request, functions.users.GetFullUserRequest):
+            return pytypes.SimpleNamespace(user=pytypes.SimpleNamespace(status=types.UserStatusOnline(expires=None)))
+        # Часть загружаемого файла: считаем принятые байты
+        self.uploads[request.file_id] = self.uploads.get(request.file_id, 0) + len(request.bytes)
+        return True
+
+    def add_event_handler(self, callback, event):
+        builder = event if isinstance(event, type) else type(event)
+        self.handlers.append((callback, builder))
+
+    # Генерация событий
+
+    def dispatch(self, builder, event):
+        if not self.connected:
+            self.missed.append((builder, event))
+            return
+        for callback, handler_builder in self.handlers:
+            if handler_builder is builder:
+                asyncio.ensure_future(callback(event))
+
+    def emit_new_message(self, message):
+        self.dispatch(events.NewMessage, pytypes.SimpleNamespace(message=message))
+
+    def emit_incoming(self, chat_id, text=None):
+        """Новое входящее сообщение в диалог chat_id"""
+        history = self.history.setdefault(chat_id, [])
+        msg_id = history[-1].id + 1 if history else 1
+        message = self.make_message(chat_id, msg_id, text=text, out=False, date=datetime.now(timezone.utc))
+        history.append(message)
+        self.emit_new_message(message)
+        return message
+
+    def emit_edit(self, chat_id, msg_id, text):
+        for message in self.history.get(chat_id, []):
+            if message.id == msg_id:
+                message.message = text
+                message.edit_date = datetime.now(timezone.utc)
+                self.dispatch(events.MessageEdited, pytypes.SimpleNamespace(message=message))
+                return
+
+    def emit_delete(self, chat_id, msg_ids):
+        history = self.history.get(chat_id, [])
+        self.history[chat_id] = [message for message in history if message.id not in msg_ids]
+        marked = -1000000000000 - chat_id if chat_id not in self.users else chat_id
+        self.dispatch(events.MessageDeleted, pytypes.SimpleNamespace(chat_id=marked, deleted_ids=list(msg_ids)))
+
+    def start_firehose(self, rate, duration=None, chat_ids=None):
+        """Запускает поток новых сообщений: rate сообщений в секунду в случайные диалоги"""
+        chat_ids = chat_ids or [dialog.id for dialog in self.dialogs]
+
+        async def firehose():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            sent = 0
+            while duration is None or loop.time() - started < duration:
+                due = int((loop.time() - started) * rate)
+                while sent < due:
+                    self.emit_incoming(self.rng.choice(chat_ids))
+                    sent += 1
+                await asyncio.sleep(0.005)
+            return sent
+
+        self.firehose_task = asyncio.ensure_future(firehose())
+        return self.firehose_task
+
+
+def fake_model(client=None):
+    """TelegramModel с поддельным клиентом
+
+    Данные поддельного бэкенда не сохраняются между запусками: ни снимок интерфейса,
+    ни очередь отправки, ни кэш миниатюр.
+    """
+    from model import TelegramModel
+
+    model = TelegramModel(None, None, None, client=client or FakeTelegramClient())
+    # Данные поддельного бэкенда не должны попасть в снимок настоящего аккаунта
+    model.config['Settings']['SaveSnapshotOnExit'] = '0'
+    model.outbox_file = None
+    model.thumbs.directory = None
+    return model
+
+
+async def run_load(args):
+    """Открывает чат и нагружает интерфейс потоком сообщений, затем печатает метрики"""
+    # Заглушки файлов из открытого чата пишутся во временную папку, а не в рабочую
+    with tempfile.TemporaryDirectory(prefix='televim-load-') as downloads_dir:
+        await load_interface(args, downloads_dir)
+
+
+async def load_interface(args, downloads_dir):
+    from bench import make_view
+    from metrics import metrics
+    from viewmodel import TelegramViewModel
+
+    client = FakeTelegramClient(
+        dialogs=args.dialogs, latency=args.latency, jitter=args.jitter,
+        flood_rate=args.flood_rate, disconnect_rate=args.disconnect_rate
+    )
+    model = fake_model(client)
+    model.downloads_dir = downloads_dir
+    view = make_view(args.width, args.height)
+    view.get_key = lambda: -1
+    view.refresh = lambda: None
+    view.draw_msg_border = lambda: None
+    view.set_dialog_title = lambda title: None
+
+    vm = TelegramViewModel(model, view)
+    await vm.initialize()
+    await vm.open_chat()
+
+    received = []
+    original_handler = vm.new_message_handler
+
+    async def counting_handler(event):
+        received.append(event.message.id)
+        await original_handler(event)
+    client.handlers = [
+        (counting_handler if callback == original_handler else callback, builder)
+        for callback, builder in client.handlers
+    ]
+
+    # Половина сообщений - в открытый чат, чтобы нагрузить и раскладку
+    open_ids = [vm.open_chat_id] * len(client.dialogs) + [dialog.id for dialog in client.dialogs]
+    firehose = client.start_firehose(args.rate, args.duration, open_ids)
+    while not firehose.done():
+        await vm.run()
+    sent = firehose.result()
+    while not vm.update_queue.empty():
+        await vm.run()
+    await asyncio.sleep(0.2)
+    await vm.run()
+
+    snapshot = metrics.snapshot()
+    print(f"отправлено {sent}, принято обработчиком {len(received)} за {args.duration} с "
+          f"({len(received) / args.duration:.0f} в секунду)")
+    for name in ('frame', 'layout', 'event_to_paint'):
+        summary = snapshot['timings'].get(name)
+        if summary:
+            print(f"{name:<16} p50 {summary['p50_ms']:>8.1f} мс  p95 {summary['p95_ms']:>8.1f} мс  max {summary['max_ms']:>8.1f} мс")
+    for method, summary in sorted(snapshot['rpc'].items()):
+        print(f"rpc {method:<20} ×{summary['count']:<5} p50 {summary['p50_ms']:.1f} мс")
+
+
+async def check_flood_wait():
+    """FloodWait короче порога flood_sleep_threshold должен ставить общую паузу в планировщике"""
+    from scheduler import priority, BACKGROUND, RequestDropped
+
+    # Три секунды - меньше порога Telethon по умолчанию: без настройки модели клиент проспал бы их сам
+    client = FakeTelegramClient(dialogs=1, messages_per_dialog=10, latency=0, flood_rate=1.0, flood_seconds=3)
+    model = fake_model(client)
+    await model.connect()
+    entity = client.dialogs[0].entity
+    try:
+        await model.get_messages(entity)
+    except FloodWaitError as e:
+        print(f"FloodWait {e.seconds} с дошел до планировщика, пауза {model.scheduler.blocked_for():.1f} с")
+    else:
+        raise SystemExit("FloodWait не дошел до планировщика")
+    if not model.scheduler.blocked_for():
+        raise SystemExit("планировщик не поставил паузу после FloodWait")
+    try:
+        with priority(BACKGROUND):
+            await model.get_newer_messages(entity)
+    except RequestDropped:
+        print("фоновый запрос во время паузы отброшен")
+    else:
+        raise SystemExit("фоновый запрос во время паузы не отброшен")
+
+
+async def check_send_retry():
+    """Повтор отправки с тем же random_id не должен создавать второе сообщение"""
+    from telethon import helpers
+
+    client = FakeTelegramClient(dialogs=1, messages_per_dialog=10, latency=0)
+    model = fake_model(client)
+    await model.connect()
+    entity = client.dialogs[0].entity
+    peer = model.get_input_peer(entity)
+    history = client.history[entity.id]
+    random_id = helpers.generate_random_long()
+    before = len(history)
+    msg_id, _ = await model.send_message(peer, "проверка", random_id)
+    try:
+        await model.send_message(peer, "проверка", random_id)
+    except RandomIdDuplicateError:
+        print(f"повтор с тем же random_id отклонен, сообщение {msg_id} одно")
+    else:
+        raise SystemExit("повтор с тем же random_id не отклонен")
+    if len(history) != before + 1:
+        raise SystemExit(f"после повтора в чате {len(history) - before} новых сообщений вместо одного")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон интерфейса на поддельном бэкенде")
+    parser.add_argument('--rate', type=float, default=100, help="новых сообщений в секунду")
+    parser.add_argument('--duration', type=float, default=5, help="длительность потока в секундах")
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка запроса в секундах")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="доля запросов с FloodWait")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="доля запросов с обрывом соединения")
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=50)
+    parser.add_argument('--check-flood', action='store_true', help="проверить, что FloodWait доходит до планировщика")
+    parser.add_argument('--check-send', action='store_true', help="проверить, что повтор отправки не создает второе сообщение")
+    args = parser.parse_args()
+    if args.check_flood:
+        asyncio.run(check_flood_wait())
+    elif args.check_send:
+        asyncio.run(check_send_retry())
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+    main()
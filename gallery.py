@@ -0,0 +1,209 @@
+"""Галерея файлов и ссылок открытого чата
+
+Клавиша f в окне сообщений открывает галерею: файлы, фото, видео, ссылки и
+голосовые чата по вкладкам, страницы запрашиваются у сервера по мере прокрутки.
+Enter открывает ссылку или уже загруженный файл, иначе загружает его в фоне,
+g переходит к сообщению в чате. Все файлы чата сразу загружает клавиша D
+в окне сообщений (bulk.py).
+"""
+import os
+import glob
+import asyncio
+import subprocess
+
+from telethon.tl import types
+
+from messages import MediaRef
+from bulk import is_complete
+from export import EXPORT_DIR
+from scheduler import priority, INTERACTIVE, BACKGROUND, RequestDropped
+from tracing import tracer
+
+# Вкладки галереи: ключ серверного фильтра (MEDIA_FILTERS модели) и название
+GALLERY_TABS = (
+    ('document', "Файлы"),
+    ('photo', "Фото"),
+    ('video', "Видео"),
+    ('link', "Ссылки"),
+    ('voice', "Голосовые")
+)
+# Сколько сообщений запрашивать за одну страницу
+GALLERY_PAGE_SIZE = 50
+# Следующая страница запрашивается заранее, когда до конца загруженного остается столько строк
+PREFETCH_MARGIN = 20
+
+
+class GalleryItem:
+    """Строка галереи: только то, что нужно для списка, без объекта Telethon"""
+    __slots__ = ('id', 'date', 'kind', 'name', 'size', 'url')
+
+    def __init__(self, msg_id, date, kind, name, size=None, url=None):
+        self.id = msg_id
+        self.date = date
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.url = url
+
+    @classmethod
+    def from_message(cls, msg, kind):
+        if kind == 'link':
+            url, title = message_link(msg)
+            return cls(msg.id, msg.date, kind, title or msg.message or url or "", url=url)
+        media = MediaRef.from_message(msg)
+        if media is None:
+            return cls(msg.id, msg.date, kind, msg.message or "")
+        return cls(msg.id, msg.date, media.kind, media.name or f"{msg.id}{media.ext}", media.size)
+
+
+def message_link(msg):
+    """Первая ссылка сообщения и ее заголовок: из превью страницы или из разметки текста"""
+    webpage = msg.web_preview
+    if webpage:
+        return webpage.url, webpage.title or webpage.site_name
+    for entity, text in msg.get_entities_text():
+        if isinstance(entity, types.MessageEntityTextUrl):
+            return entity.url, text
+        if isinstance(entity, types.MessageEntityUrl):
+            return text, None
+    return None, None
+
+
+def open_external(target):
+    """Открывает файл или адрес в приложении по умолчанию; адрес из сообщения не проходит через shell"""
+    try:
+        subprocess.Popen(['xdg-open', target], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError:
+        pass
+
+
+class GalleryTab:
+    """Загруженные страницы одного типа вложений"""
+    def __init__(self, kind, title):
+        self.kind = kind
+        self.title = title
+        self.items = []
+        self.selected = 0
+        self.loading = None
+        self.exhausted = False
+        self.error = None
+
+
+class MediaGallery:
+    """Файлы и ссылки открытого чата по типам, от новых к старым
+
+    Каждая вкладка запрашивает у сервера только сообщения своего типа и подгружает
+    следующую страницу заранее, когда курсор подходит к концу загруженного.
+    Открытые вкладки остаются в памяти, пока открыт тот же чат.
+    """
+    def __init__(self, model, dialog, chat_title):
+        self.model = model
+        self.dialog = dialog
+        self.chat_title = chat_title
+        self.chat_id = model.get_dialog_id(dialog)
+        self.tabs = [GalleryTab(kind, title) for kind, title in GALLERY_TABS]
+        self.current = 0
+        safe_title = model.safe_file_name(chat_title)
+        self.directories = (os.path.join(model.downloads_dir, safe_title), os.path.join(EXPORT_DIR, safe_title + '_files'))
+        # Найденные на диске файлы (id сообщения -> путь или None), проверяются один раз за показ
+        self.local_files = {}
+        # Загрузки, начатые из галереи: id сообщения -> принято байт или текст ошибки
+        self.downloads = {}
+        # Сообщения, файлы которых загрузились, пока была открыта галерея
+        self.downloaded_ids = set()
+
+    @property
+    def tab(self):
+        return self.tabs[self.current]
+
+    def switch(self, step):
+        """Переключает вкладку; у каждой вкладки свой курсор"""
+        self.current = (self.current + step) % len(self.tabs)
+
+    def prefetch(self):
+        """Запрашивает следующую страницу вкладки, если курсор близко к концу загруженного"""
+        tab = self.tab
+        if tab.exhausted or tab.loading or tab.error:
+            return
+        if tab.selected + PREFETCH_MARGIN < len(tab.items):
+            return
+        tab.loading = asyncio.create_task(self.load_page(tab))
+
+    async def load_page(self, tab):
+        offset_id = tab.items[-1].id if tab.items else 0
+        # Первая страница нужна сейчас, следующие - заранее и могут подождать
+        level = BACKGROUND if tab.items else INTERACTIVE
+        try:
+            with tracer.cause(f"gallery:{tab.kind}"), priority(level):
+                messages = await self.model.search_media(self.dialog.entity, tab.kind, offset_id, GALLERY_PAGE_SIZE)
+            tab.items.extend(GalleryItem.from_message(msg, tab.kind) for msg in messages)
+            if len(messages) < GALLERY_PAGE_SIZE:
+                tab.exhausted = True
+        except (RequestDropped, ConnectionError):
+            # Повторим при следующем движении курсора
+            pass
+        except Exception as e:
+            tab.error = str(e) or type(e).__name__
+        finally:
+            tab.loading = None
+
+    def reset_local_files(self):
+        self.local_files = {}
+
+    def local_file(self, item):
+        """Полностью загруженный файл сообщения из папки загрузок или экспорта, иначе None"""
+        if item.id not in self.local_files:
+            self.local_files[item.id] = None
+            for directory in self.directories:
+                for path in glob.glob(os.path.join(glob.escape(directory), f"{item.id}.*")):
+                    if is_complete(path, item.size):
+                        self.local_files[item.id] = path
+                        break
+                if self.local_files[item.id]:
+                    break
+        return self.local_files[item.id]
+
+    def state(self, item):
+        """Состояние строки: загружен, идет загрузка (процент) или ошибка"""
+        if item.kind == 'link':
+            return ""
+        progress = self.downloads.get(item.id)
+        if isinstance(progress, str):
+            return f"ошибка: {progress}"
+        if progress is not None:
+            return f"{int(progress * 100 / item.size)}%" if item.size else "загрузка"
+        return "загружен" if self.local_file(item) else ""
+
+    def activate(self, item):
+        """Enter: открывает ссылку или загруженный файл, иначе начинает загрузку"""
+        if item.kind == 'link':
+            if item.url:
+                open_external(item.url)
+            return
+        path = self.local_file(item)
+        if path:
+            open_external(path)
+        elif not isinstance(self.downloads.get(item.id), int):
+            self.downloads[item.id] = 0
+            asyncio.create_task(self.download(item))
+
+    async def download(self, item):
+        def progress(current, total):
+            self.downloads[item.id] = current
+
+        try:
+            with tracer.cause('gallery:download'), priority(INTERACTIVE):
+                # Для загрузки нужен полный объект сообщения
+                full_message = await self.model.get_full_message(self.dialog.entity, item.id)
+                if not full_message or not full_message.media:
+                    raise ValueError("файл не найден")
+                path = await self.model.download_media(
+                    full_message.media, self.chat_title, item.id, force_download=True, progress_callback=progress
+                )
+        except Exception as e:
+            self.downloads[item.id] = str(e) or type(e).__name__
+            return
+        del self.downloads[item.id]
+        self.local_files[item.id] = path
+        self.downloaded_ids.add(item.id)
@@ -1,11 +1,11 @@
 import os
+import sys
 import curses
 import asyncio
 import signal
 from model import TelegramModel
 from view import TelegramView
 from viewmodel import TelegramViewModel
-import credentials
 
 # Флаг для Ctrl+C
 exit_requested = False
@@ -15,6 +15,15 @@ def handle_sigint(signum, frame):
     global exit_requested
     exit_requested = True
 
+def create_model():
+    """Создает модель с настоящим клиентом или, с флагом --fake, с поддельным бэкендом без сети"""
+    if '--fake' in sys.argv:
+        from fake_backend import fake_model
+        return fake_model()
+
+    import credentials
+    return TelegramModel(credentials.name(), credentials.key(), credentials.hash())
+
 async def interactive_auth(model):
     """Выполняет интерактивную авторизацию через консоль"""
     print("Требуется авторизация в Telegram")
@@ -34,7 +43,7 @@ async def main(stdscr):
     global exit_requested
     
     # Инициализация модели
-    model = TelegramModel(credentials.name(), credentials.key(), credentials.hash())
+    model = create_model()
     
     # Инициализация представления
     view = TelegramView(stdscr)
@@ -42,6 +51,10 @@ async def main(stdscr):
     # Инициализация ViewModel
     viewmodel = TelegramViewModel(model, view)
     
+    # Снимок метрик по сигналу: kill -USR1 <pid>
+    if hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, viewmodel.dump_metrics)
+
     # Запуск приложения
     try:
         await viewmodel.initialize()
@@ -63,7 +76,7 @@ async def auth_and_setup():
     os.makedirs("downloads", exist_ok=True)
     
     # Инициализируем модель
-    model = TelegramModel(credentials.name(), credentials.key(), credentials.hash())
+    model = create_model()
     
     # Подключаемся к API
     await model.connect()
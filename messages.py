@@ -0,0 +1,271 @@
+from bisect import bisect_left, insort
+from telethon import utils
+from telethon.tl import types
+
+
+class ThumbRef:
+    """Самая маленькая миниатюра фото или документа: где ее взять без загрузки всего сообщения
+
+    Миниатюры, пришедшие вместе с сообщением (stripped - сжатая JPEG без заголовков,
+    cached - готовая JPEG), сохраняются как есть; остальные загружаются по file_reference.
+    """
+    __slots__ = ('kind', 'id', 'access_hash', 'file_reference', 'dc_id', 'type', 'width', 'height', 'stripped', 'cached')
+
+    def __init__(self, kind, media_id, access_hash, file_reference, dc_id, thumb_type=None,
+                 width=0, height=0, stripped=None, cached=None):
+        self.kind = kind
+        self.id = media_id
+        self.access_hash = access_hash
+        self.file_reference = file_reference
+        self.dc_id = dc_id
+        self.type = thumb_type
+        self.width = width
+        self.height = height
+        self.stripped = stripped
+        self.cached = cached
+
+    @classmethod
+    def from_media(cls, media):
+        """Миниатюра Photo или Document Telethon или None, если ее нет"""
+        if isinstance(media, types.Photo):
+            kind, sizes = 'photo', media.sizes
+        elif isinstance(media, types.Document):
+            kind, sizes = 'document', media.thumbs or []
+        else:
+            return None
+
+        smallest = None
+        stripped = cached = None
+        for size in sizes:
+            if isinstance(size, types.PhotoStrippedSize):
+                stripped = size.bytes
+            elif isinstance(size, types.PhotoCachedSize):
+                cached = size.bytes
+            elif type(size) is types.PhotoSize:
+                # PhotoSizeProgressive пропускаем: прогрессивный JPEG превью не раскодирует
+                if smallest is None or size.w * size.h < smallest.w * smallest.h:
+                    smallest = size
+        if smallest is None and stripped is None and cached is None:
+            return None
+
+        return cls(
+            kind, media.id, media.access_hash, media.file_reference, media.dc_id,
+            smallest.type if smallest else None,
+            smallest.w if smallest else 0,
+            smallest.h if smallest else 0,
+            stripped, cached
+        )
+
+    @property
+    def key(self):
+        """Имя миниатюры в кэше"""
+        return f"{self.kind}_{self.id}_{self.type or 'i'}"
+
+    @property
+    def stripped_width(self):
+        # В stripped-миниатюре второй и третий байты - высота и ширина
+        return self.stripped[2] if self.stripped and len(self.stripped) > 2 else 0
+
+    def location(self):
+        """InputFileLocation для загрузки миниатюры одним запросом"""
+        if self.kind == 'photo':
+            return types.InputPhotoFileLocation(self.id, self.access_hash, self.file_reference, self.type)
+        return types.InputDocumentFileLocation(self.id, self.access_hash, self.file_reference, self.type)
+
+
+class MediaRef:
+    """Описание вложения без медиа-объекта Telethon: хватает для отрисовки и имени файла"""
+    __slots__ = ('kind', 'name', 'mime_type', 'size', 'ext', 'thumb')
+
+    def __init__(self, kind, name=None, mime_type=None, size=None, ext='', thumb=None):
+        self.kind = kind
+        self.name = name
+        self.mime_type = mime_type
+        self.size = size
+        self.ext = ext
+        self.thumb = thumb
+
+    @classmethod
+    def from_message(cls, msg):
+        """Описание вложения сообщения Telethon или None, если файла нет"""
+        file = msg.file
+        if not file:
+            return None
+
+        if msg.photo:
+            kind, default_ext = 'photo', '.jpg'
+        elif msg.voice:
+            kind, default_ext = 'voice', '.ogg'
+        elif msg.video:
+            kind, default_ext = 'video', '.mp4'
+        else:
+            kind, default_ext = 'document', '.bin'
+
+        thumb = ThumbRef.from_media(msg.photo or msg.document)
+        return cls(kind, file.name, file.mime_type, file.size, file.ext or default_ext, thumb)
+
+
+class MessageRecord:
+    """Компактная запись сообщения: только поля, нужные интерфейсу
+
+    Полный объект Telethon не хранится, при загрузке файла он запрашивается заново.
+    """
+    __slots__ = (
+        'id', 'chat_id', 'date', 'sender_id', 'sender_name', 'text',
+        'media', 'out', 'reply_to', 'edit_date', 'mentioned', 'status'
+    )
+
+    def __init__(self, msg_id, chat_id, date, sender_id=None, sender_name=None, text="",
+                 media=None, out=False, reply_to=None, edit_date=None, mentioned=False, status=None):
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.date = date
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.text = text
+        self.media = media
+        self.out = out
+        self.reply_to = reply_to
+        self.edit_date = edit_date
+        self.mentioned = mentioned
+        # None у сообщений с сервера, иначе состояние еще не отправленного (см. outbox.py)
+        self.status = status
+
+    @classmethod
+    def from_message(cls, msg):
+        """Создает запись из сообщения Telethon"""
+        return cls(
+            msg.id,
+            utils.get_peer_id(msg.peer_id, add_mark=False) if msg.peer_id else None,
+            msg.date,
+            msg.sender_id,
+            sender_display_name(msg),
+            msg.text or msg.message or "",
+            MediaRef.from_message(msg),
+            bool(msg.out),
+            msg.reply_to_msg_id,
+            msg.edit_date,
+            bool(msg.mentioned)
+        )
+
+
+def format_size(size):
+    """Размер файла для людей: 512 Б, 12.3 КБ, 4.5 МБ"""
+    if size is None:
+        return "?"
+    if size < 1024:
+        return f"{size} Б"
+    for unit in ("КБ", "МБ", "ГБ"):
+        size /= 1024
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.1f} {unit}"
+
+
+def sender_display_name(msg):
+    """Имя отправителя: имя пользователя, название канала или username"""
+    try:
+        sender = msg.sender
+        if sender:
+            for attr in ('first_name', 'title', 'username'):
+                value = getattr(sender, attr, None)
+                if value:
+                    return value
+    except Exception:
+        pass
+    return None
+
+
+class MessageStore:
+    """Сообщения открытого чата, упорядоченные по id
+
+    Поиск по id - O(1) через словарь, позиция сообщения - O(log n) бинарным
+    поиском по отсортированному списку id. Внутри одного чата id растут со временем,
+    поэтому порядок по id совпадает с хронологическим.
+    """
+
+    def __init__(self, records=()):
+        self._ids = []
+        self._by_id = {}
+        self.add(records)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        by_id = self._by_id
+        return (by_id[msg_id] for msg_id in self._ids)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._by_id
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._by_id[msg_id] for msg_id in self._ids[index]]
+        return self._by_id[self._ids[index]]
+
+    def get(self, msg_id):
+        """Сообщение по id или None"""
+        return self._by_id.get(msg_id)
+
+    def index(self, msg_id):
+        """Позиция сообщения или None, если его нет"""
+        i = bisect_left(self._ids, msg_id)
+        if i < len(self._ids) and self._ids[i] == msg_id:
+            return i
+        return None
+
+    def neighbour(self, msg_id, step):
+        """Id сообщения на step позиций дальше от msg_id или None"""
+        i = self.index(msg_id)
+        if i is None:
+            return None
+        i += step
+        return self._ids[i] if 0 <= i < len(self._ids) else None
+
+    def add(self, records):
+        """Добавляет сообщения, пропуская уже известные
+
+        Returns:
+            Список добавленных записей в порядке добавления
+        """
+        added = []
+        for record in records:
+            if record.id in self._by_id:
+                continue
+            self._by_id[record.id] = record
+            if not self._ids or record.id > self._ids[-1]:
+                self._ids.append(record.id)
+            else:
+                insort(self._ids, record.id)
+            added.append(record)
+        return added
+
+    def replace(self, record):
+        """Заменяет известное сообщение новой версией. Возвращает, было ли оно в списке"""
+        if record.id not in self._by_id:
+            return False
+        self._by_id[record.id] = record
+        return True
+
+    def remove(self, msg_ids):
+        """Удаляет сообщения. Возвращает id реально удаленных"""
+        removed = {msg_id for msg_id in msg_ids if self._by_id.pop(msg_id, None) is not None}
+        if removed:
+            self._ids = [msg_id for msg_id in self._ids if msg_id not in removed]
+        return removed
+
+    def drop_first(self, count):
+        """Выгружает count самых старых сообщений. Возвращает их id"""
+        dropped, self._ids = self._ids[:count], self._ids[count:]
+        for msg_id in dropped:
+            del self._by_id[msg_id]
+        return dropped
+
+    def drop_last(self, count):
+        """Выгружает count самых новых сообщений. Возвращает их id"""
+        if count <= 0:
+            return []
+        dropped, self._ids = self._ids[-count:], self._ids[:-count]
+        for msg_id in dropped:
+            del self._by_id[msg_id]
+        return dropped
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import contextlib
+from collections import deque
+from datetime import datetime
+
+# Сколько последних замеров каждой метрики хранить для перцентилей
+SAMPLE_WINDOW = 512
+
+
+def percentile(samples, q):
+    """Перцентиль q (0-100) по списку замеров"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+def memory_in_use():
+    """Резидентная память процесса в байтах"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Пиковое значение: в Linux в килобайтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return 0
+
+
+class Series:
+    """Скользящее окно замеров длительности в секундах"""
+    def __init__(self):
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        """Сводка в миллисекундах"""
+        samples = list(self.samples)
+        return {
+            'count': self.count,
+            'last_ms': round(samples[-1] * 1000, 2) if samples else 0.0,
+            'p50_ms': round(percentile(samples, 50) * 1000, 2),
+            'p95_ms': round(percentile(samples, 95) * 1000, 2),
+            'p99_ms': round(percentile(samples, 99) * 1000, 2),
+            'max_ms': round(max(samples) * 1000, 2) if samples else 0.0
+        }
+
+
+class Metrics:
+    """Счетчики производительности: кадры, раскладка, задержка событий, запросы к серверу"""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.series = {}
+        self.rpc_series = {}
+        self.rpc_in_flight = {}
+        self.gauges = {}
+        self.gauge_labels = {}
+        self.sections = {}
+        self.event_since = None
+        self.paint_due = None
+
+    def record(self, name, seconds):
+        """Добавляет замер длительности в метрику name"""
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = Series()
+        series.add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Замеряет длительность блока кода"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextlib.asynccontextmanager
+    async def rpc(self, method):
+        """Учитывает запрос к серверу: число выполняющихся и время ответа"""
+        self.rpc_in_flight[method] = self.rpc_in_flight.get(method, 0) + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.rpc_in_flight[method] -= 1
+            series = self.rpc_series.get(method)
+            if series is None:
+                series = self.rpc_series[method] = Series()
+            series.add(time.perf_counter() - start)
+
+    def gauge(self, name, func, label=None):
+        """Регистрирует мгновенное значение, которое вычисляется при снятии метрик"""
+        self.gauges[name] = func
+        self.gauge_labels[name] = label or name
+
+    def section(self, name, func):
+        """Регистрирует дополнительный раздел снимка метрик (например, журнал запросов)"""
+        self.sections[name] = func
+
+    def event_received(self):
+        """Отмечает приход события с сервера (учитывается самое раннее из необработанных)"""
+        if self.event_since is None:
+            self.event_since = time.perf_counter()
+
+    def events_taken(self):
+        """События забраны в обработку: задержку до отрисовки считаем от самого раннего"""
+        if self.event_since is not None and self.paint_due is None:
+            self.paint_due = self.event_since
+        self.event_since = None
+
+    def frame_painted(self, frame_seconds):
+        """Отмечает отрисованный кадр"""
+        self.record('frame', frame_seconds)
+        if self.paint_due is not None:
+            self.record('event_to_paint', time.perf_counter() - self.paint_due)
+            self.paint_due = None
+
+    def snapshot(self, sections=True):
+        """Все счетчики в виде словаря для JSON (sections=False - без дополнительных разделов)"""
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        data = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'memory_bytes': memory_in_use(),
+            'timings': {name: series.summary() for name, series in self.series.items()},
+            'rpc_in_flight': sum(self.rpc_in_flight.values()),
+            'rpc': {
+                method: dict(series.summary(), in_flight=self.rpc_in_flight.get(method, 0))
+                for method, series in self.rpc_series.items()
+            },
+            'gauges': gauges
+        }
+        if sections:
+            for name, func in self.sections.items():
+                data[name] = func()
+        return data
+
+    def dump(self, path=None):
+        """Сохраняет снимок счетчиков в JSON-файл и возвращает путь к нему"""
+        if path is None:
+            path = f"metrics-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        return path
+
+    def overlay_lines(self):
+        """Строки для оверлея поверх окна сообщений"""
+        data = self.snapshot(sections=False)
+        lines = []
+        labels = (('frame', 'кадр'), ('layout', 'раскладка'), ('event_to_paint', 'событие→экран'))
+        for name, label in labels:
+            summary = data['timings'].get(name)
+            if summary:
+                lines.append(f"{label:<14}{summary['last_ms']:>7.1f} мс  p95 {summary['p95_ms']:.1f}")
+        for name, value in data['gauges'].items():
+            lines.append(f"{self.gauge_labels[name]:<14}{value!s:>7}")
+        lines.append(f"{'RPC в работе':<14}{data['rpc_in_flight']:>7}")
+        for method, summary in sorted(data['rpc'].items()):
+            lines.append(f" {method[:20]:<20} p50 {summary['p50_ms']:.0f} p95 {summary['p95_ms']:.0f} мс ×{summary['count']}")
+        lines.append(f"{'память':<14}{data['memory_bytes'] / 2**20:>7.1f} МБ")
+        return lines
+
+
+# Общий экземпляр: пишут модель и модель представления, читают оверлей и дамп
+metrics = Metrics()
+
@@ -2,25 +2,97 @@ import os
 import glob
 from telethon import TelegramClient, events
 from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from telethon.tl import types, functions
 import mimetypes
 import configparser
 import telethon
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
+from telethon.errors import FileReferenceExpiredError
+from messages import MessageRecord, MediaRef
+from tracing import tracer, traced, peer_summary, text_bytes
+from singleflight import single_flight
+from scheduler import RequestScheduler, scheduled
+from upload import upload_file, UPLOAD_WORKERS
+from outbox import OUTBOX_FILE
+from connection import ConnectionMonitor
+from streaming import MediaStream
+from thumbs import ThumbCache, decode_jpeg, inline_thumb_bytes, PREVIEW_COLUMNS
+from metrics import metrics
+
+# Сколько секунд статус пользователя берется из кэша без повторного запроса
+USER_STATUS_TTL = 30
+
+# Серверные фильтры истории по типу вложения: сервер отдает только такие сообщения
+MEDIA_FILTERS = {
+    'photo': types.InputMessagesFilterPhotos,
+    'video': types.InputMessagesFilterVideo,
+    'document': types.InputMessagesFilterDocument,
+    'voice': types.InputMessagesFilterVoice,
+    'link': types.InputMessagesFilterUrl
+}
+
+# Картинки больше этого размера отправляются документом: как фото сервер их не примет
+PHOTO_MAX_SIZE = 10 * 1024 * 1024
+
+# Папка для файлов сообщений, по подпапке на чат
+DOWNLOADS_DIR = 'downloads'
 
 class TelegramModel:
-    def __init__(self, session_name, api_id, api_hash):
-        self.client = TelegramClient(session_name, api_id, api_hash)
+    def __init__(self, session_name, api_id, api_hash, client=None):
+        # Клиент можно подменить, например, на FakeTelegramClient для работы без сети
+        # catch_up: после подключения Telethon догружает обновления с сохраненной в сессии позиции
+        self.client = client if client is not None else TelegramClient(session_name, api_id, api_hash, catch_up=True)
+        # FloodWait любой длины должен дойти до планировщика: иначе Telethon спит внутри
+        # занятого слота, и общая пауза, отброс фоновых запросов и повтор не срабатывают
+        self.client.flood_sleep_threshold = 0
         self.client.session.save_entities = False
-        self.config = self.load_config()
+        # С подмененным клиентом файл настроек только читается: тестовый прогон не оставляет его в рабочей папке
+        self.config = self.load_config(save_default=client is None)
+        # Все запросы к серверу проходят через очередь с приоритетами и паузой после FloodWait
+        self.scheduler = RequestScheduler()
+        metrics.section('scheduler', self.scheduler.status)
+        metrics.gauge('rpc_waiting', lambda: len(self.scheduler.waiting), 'RPC в очереди')
+        self.connection = ConnectionMonitor(self.client, self.scheduler)
+        metrics.section('connection', self.connection.status)
+        # Очередь исходящих сообщений на диске (None - только в памяти)
+        self.outbox_file = OUTBOX_FILE
+        self.downloads_dir = DOWNLOADS_DIR
+        # Миниатюры для превью медиа в чате; directory = None - без кэша на диске
+        self.thumbs = ThumbCache()
+        self.thumbs.enabled = self.config['Settings'].get('Previews', '1') == '1'
+        try:
+            self.thumbs.columns = max(4, int(self.config['Settings'].get('PreviewWidth', str(PREVIEW_COLUMNS))))
+        except ValueError:
+            pass
+        metrics.section('thumbs', self.thumbs.status)
         
-    def load_config(self):
-        """Загружает настройки из конфигурационного файла"""
+    def load_config(self, save_default=True):
+        """Загружает настройки из конфигурационного файла
+
+        Args:
+            save_default: Записать настройки по умолчанию в файл, если его еще нет
+        """
         config = configparser.ConfigParser()
         config_file = os.path.join(os.getcwd(), '.config')
         
         # Настройки по умолчанию
         default_config = {
-            'RemoveDownloadsOnExit': '1'
+            'RemoveDownloadsOnExit': '1',
+            'SaveSnapshotOnExit': '1',
+            'DialogFolder': '',
+            'PrefetchDialogs': '5',
+            'HistoryPages': '10',
+            'UploadWorkers': str(UPLOAD_WORKERS),
+            'Previews': '1',
+            'PreviewWidth': str(PREVIEW_COLUMNS),
+            'StreamMedia': '1',
+            'Player': '',
+            'ExportFormat': 'jsonl',
+            'ExportMedia': '0',
+            'ExportTakeout': '0',
+            'DownloadKinds': 'photo,video,document,voice',
+            'DownloadWorkers': '3'
         }
         
         # Проверяем существование файла конфигурации
@@ -30,12 +102,19 @@ class TelegramModel:
                 config['Settings'] = default_config
         else:
             config['Settings'] = default_config
-            with open(config_file, 'w') as f:
-                config.write(f)
+            if save_default:
+                with open(config_file, 'w') as f:
+                    config.write(f)
                 
         return config
         
     async def connect(self):
+        """Подключается к серверу
+
+        Позицию в потоке обновлений Telethon хранит в сессии и записывает при отключении,
+        поэтому сервер пришлет только пропущенное с прошлого запуска. Обработчики событий
+        должны быть зарегистрированы до подключения
+        """
         await self.client.connect()
         
     async def is_user_authorized(self):
@@ -51,47 +130,243 @@ class TelegramModel:
         return await self.client.start(phone=phone)
         
     async def disconnect(self):
+        self.connection.closing = True
         await self.client.disconnect()
         
-    async def get_dialogs(self, limit=100):
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, limit=100, folder=None: f"limit={limit} folder={folder}")
+    async def get_dialogs(self, limit=100, folder=None):
         """Получает список диалогов"""
-        return await self.client.get_dialogs(limit=limit)
+        return await self.client.get_dialogs(limit=limit, folder=folder)
+
+    def iter_dialogs(self, folder=None):
+        """Возвращает итератор по диалогам, который подгружает их с сервера страницами
+
+        Args:
+            folder: None - все диалоги, 0 - без архива, 1 - только архив
+        """
+        return self.client.iter_dialogs(folder=folder)
+
+    async def next_dialogs(self, dialog_iter, count):
+        """Забирает из итератора до count диалогов
+
+        Returns:
+            Кортеж (список диалогов, закончился ли итератор)
+        """
+        dialogs = []
+        async with self.scheduler.slot('iter_dialogs'), tracer.call('iter_dialogs', f"count={count}"):
+            try:
+                while len(dialogs) < count:
+                    dialogs.append(await dialog_iter.__anext__())
+            except StopAsyncIteration:
+                return dialogs, True
+        return dialogs, False
         
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, entity, limit=20, offset_id=0: f"peer={peer_summary(entity)} limit={limit} offset_id={offset_id}", size=text_bytes)
     async def get_messages(self, entity, limit=20, offset_id=0):
+        """Получает сообщения до offset_id в виде компактных записей, от старых к новым"""
         messages = await self.client.get_messages(entity, limit=limit, offset_id=offset_id)
-        messages.reverse()
-        return messages
+        return [MessageRecord.from_message(msg) for msg in reversed(messages)]
+
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, entity, limit=20, min_id=0: f"peer={peer_summary(entity)} limit={limit} min_id={min_id}", size=text_bytes)
+    async def get_newer_messages(self, entity, limit=20, min_id=0):
+        """Получает сообщения, следующие сразу за min_id, от старых к новым"""
+        messages = await self.client.get_messages(entity, limit=limit, offset_id=min_id, reverse=True)
+        return [MessageRecord.from_message(msg) for msg in messages]
+
+    async def export_page(self, entity, offset_id, limit=100, takeout=None):
+        """Страница истории для экспорта: полные сообщения Telethon после offset_id, от старых к новым
+
+        Args:
+            takeout: Клиент сессии экспорта (client.takeout()): у его запросов свои,
+                более мягкие ограничения частоты
+        """
+        method = 'takeout_page' if takeout else 'export_page'
+        async with self.scheduler.slot(method), tracer.call(method, f"peer={peer_summary(entity)} limit={limit} offset_id={offset_id}") as record:
+            messages = await (takeout or self.client).get_messages(entity, limit=limit, offset_id=offset_id, reverse=True)
+            record.bytes = text_bytes(list(messages))
+        return list(messages)
+
+    @scheduled()
+    @traced(lambda self, entity, kind, offset_id=0, limit=100: f"peer={peer_summary(entity)} filter={kind} limit={limit} offset_id={offset_id}", size=text_bytes)
+    async def search_media(self, entity, kind, offset_id=0, limit=100):
+        """Сообщения с вложениями одного типа (см. MEDIA_FILTERS) до offset_id, от новых к старым
+
+        Остальные сообщения отсеивает сервер, поэтому их текст не передается.
+        Возвращаются полные сообщения Telethon: по ним можно сразу загрузить файл.
+        """
+        return list(await self.client.get_messages(entity, limit=limit, offset_id=offset_id, filter=MEDIA_FILTERS[kind]))
+
+    async def download_message_file(self, message, path, takeout=None, progress_callback=None):
+        """Загружает файл сообщения ровно в path; до окончания файл лежит рядом как скрытый .part
+
+        Args:
+            progress_callback: Функция (загружено байт, всего байт)
+
+        Returns:
+            Размер загруженного файла в байтах
+        """
+        part_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+        try:
+            async with self.scheduler.slot('download_media'), tracer.call('download_message_file', f"id={message.id}") as record:
+                await (takeout or self.client).download_media(message, part_path, progress_callback=progress_callback)
+                record.bytes = os.path.getsize(part_path)
+            os.replace(part_path, path)
+            return record.bytes
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, entity, message_id: f"peer={peer_summary(entity)} id={message_id}", size=text_bytes)
+    async def get_full_message(self, entity, message_id):
+        """Запрашивает полный объект сообщения Telethon (нужен для загрузки медиа)"""
+        return await self.client.get_messages(entity, ids=message_id)
         
-    async def send_message(self, entity, text, reply_to=None):
-        """Отправляет сообщение указанному пользователю или в чат"""
+    @scheduled()
+    @traced(lambda self, peer, text, random_id, reply_to=None: f"peer={peer_summary(peer)} chars={len(text)} reply_to={reply_to}")
+    async def send_message(self, peer, text, random_id, reply_to=None):
+        """Отправляет текстовое сообщение
+
+        Повтор с тем же random_id сервер не превратит во второе сообщение,
+        поэтому отправку можно безопасно повторять после обрыва.
+
+        Args:
+            peer: Чат или его InputPeer
+            text: Текст сообщения (в разметке клиента, по умолчанию markdown)
+            random_id: Идентификатор попытки отправки, один на все повторы
+            reply_to: ID сообщения, на которое отвечаем
+
+        Returns:
+            Кортеж (id, дата) отправленного сообщения
+        """
+        entities = None
+        if self.client.parse_mode:
+            text, entities = self.client.parse_mode.parse(text)
+        result = await self.client(functions.messages.SendMessageRequest(
+            peer=peer,
+            message=text,
+            random_id=random_id,
+            reply_to=types.InputReplyToMessage(reply_to) if reply_to else None,
+            entities=entities or None
+        ))
+        return self.sent_message_id(result, random_id)
+
+    @staticmethod
+    def sent_message_id(result, random_id):
+        """Достает id и дату отправленного сообщения из ответа сервера"""
+        if isinstance(result, types.UpdateShortSentMessage):
+            return result.id, result.date
+
+        msg_id = None
+        updates = getattr(result, 'updates', [])
+        for update in updates:
+            if isinstance(update, types.UpdateMessageID) and update.random_id == random_id:
+                msg_id = update.id
+        for update in updates:
+            message = getattr(update, 'message', None)
+            if isinstance(message, types.Message) and message.id == msg_id:
+                return msg_id, message.date
+        return msg_id, datetime.now(timezone.utc)
+
+    @staticmethod
+    def get_input_peer(entity):
+        """InputPeer чата: его можно сохранить и отправлять в чат без повторного поиска сущности"""
+        return telethon.utils.get_input_peer(entity)
+
+    async def send_file(self, entity, path, caption='', reply_to=None, progress_callback=None):
+        """Загружает файл параллельными частями и отправляет его в чат
+
+        Args:
+            entity: Чат, куда отправить файл
+            path: Путь к файлу
+            caption: Подпись к файлу
+            reply_to: ID сообщения, на которое отвечаем
+            progress_callback: Функция (загружено байт, всего байт) для отображения прогресса
+
+        Returns:
+            MessageRecord отправленного сообщения
+        """
         try:
-            # Проверяем, можно ли отправить сообщение в этот чат
-            can_send = True
-            if hasattr(entity, 'broadcast') and getattr(entity, 'broadcast', False):
-                # Канал - нужны права админа
-                if not (hasattr(entity, 'admin_rights') or hasattr(entity, 'creator')):
-                    can_send = False
-            elif hasattr(entity, 'restricted') and getattr(entity, 'restricted', False):
-                # Ограниченный чат
-                can_send = False
-                
-            if not can_send:
-                return None
-                
-            # Отправляем сообщение и проверяем результат
-            message = await self.client.send_message(entity=entity, message=text, reply_to=reply_to)
-            if message and hasattr(message, 'id'):
-                return message
-            return None
-        except Exception as e:
-            print(f"Ошибка при отправке сообщения: {e}")
-            return None
+            workers = max(1, int(self.config['Settings'].get('UploadWorkers', str(UPLOAD_WORKERS))))
+        except ValueError:
+            workers = UPLOAD_WORKERS
+
+        size = os.path.getsize(path)
+        async with self.scheduler.slot('upload_file'), tracer.call('upload_file', f"peer={peer_summary(entity)} size={size} workers={workers}") as record:
+            input_file = await upload_file(self.client, path, workers, progress_callback)
+            record.bytes = size
+
+        message = await self.send_uploaded_file(entity, input_file, caption, reply_to, force_document=size > PHOTO_MAX_SIZE)
+        return MessageRecord.from_message(message)
+
+    @scheduled()
+    @traced(lambda self, entity, input_file, caption='', reply_to=None, force_document=False: f"peer={peer_summary(entity)} parts={input_file.parts}")
+    async def send_uploaded_file(self, entity, input_file, caption='', reply_to=None, force_document=False):
+        """Отправляет уже загруженный на сервер файл"""
+        return await self.client.send_file(entity, input_file, caption=caption, reply_to=reply_to, force_document=force_document)
+
+    @staticmethod
+    def safe_file_name(title):
+        """Название чата, пригодное для имени файла или папки"""
+        return "".join(c if c.isalnum() or c in ['-', '_'] else '_' for c in title)
+
+    def media_file_prefix(self, chat_title, message_id):
+        """Путь к файлу сообщения без расширения; папка чата создается, если ее нет"""
+        # Создаем безопасное имя для папки чата
+        safe_chat_title = self.safe_file_name(chat_title)
+        
+        # Создаем папку для чата, если её нет
+        chat_folder = f"{self.downloads_dir}/{safe_chat_title}"
+        os.makedirs(chat_folder, exist_ok=True)
         
+        return f"{chat_folder}/{message_id}"
+
+    async def stream_media(self, media, chat_title, message_id, size, progress_callback=None):
+        """Начинает последовательную загрузку файла с раздачей плееру по http
+
+        Args:
+            media: Медиа-объект сообщения Telethon
+            chat_title: Название чата для именования файла
+            message_id: ID сообщения для именования файла
+            size: Размер файла в байтах
+            progress_callback: Функция (загружено байт, всего байт)
+
+        Returns:
+            MediaStream с адресом для плеера (url) и задачей загрузки (task)
+        """
+        prefix = self.media_file_prefix(chat_title, message_id)
+        path = prefix + (telethon.utils.get_extension(media) or '.bin')
+        stream = MediaStream(self.client, media, path, size)
+        await stream.start()
+
+        async def download():
+            try:
+                async with self.scheduler.slot('download_media'), tracer.call('stream_media', f"chat={os.path.basename(os.path.dirname(prefix))} id={message_id}") as record:
+                    await stream.download(progress_callback)
+                    record.bytes = stream.available
+                # Заглушки с другим расширением больше не нужны
+                for existing in glob.glob(f"{prefix}.*"):
+                    if existing != path and os.path.splitext(existing)[0] == prefix:
+                        os.remove(existing)
+            finally:
+                if not stream.done and os.path.exists(stream.part_path):
+                    os.remove(stream.part_path)
+
+        stream.task = asyncio.create_task(download())
+        return stream
+
     async def download_media(self, media, chat_title, message_id, force_download=False, progress_callback=None):
         """Загружает медиа-файл с заданным именем или создает пустой файл-заглушку
         
         Args:
-            media: Медиа-объект для загрузки
+            media: Медиа-объект для загрузки (или MediaRef, если нужна только заглушка)
             chat_title: Название чата для именования файла
             message_id: ID сообщения для именования файла
             force_download: True для принудительной загрузки, False для создания заглушки
@@ -100,15 +375,8 @@ class TelegramModel:
         Returns:
             Путь к файлу
         """
-        # Создаем безопасное имя для папки чата
-        safe_chat_title = "".join(c if c.isalnum() or c in ['-', '_'] else '_' for c in chat_title)
-        
-        # Создаем папку для чата, если её нет
-        chat_folder = f"downloads/{safe_chat_title}"
-        os.makedirs(chat_folder, exist_ok=True)
-        
-        # Путь для сохранения файла
-        file_path = f"{chat_folder}/{message_id}"
+        file_path = self.media_file_prefix(chat_title, message_id)
+        safe_chat_title = os.path.basename(os.path.dirname(file_path))
         
         # Проверяем, существует ли уже файл
         existing_files = glob.glob(f"{file_path}*")
@@ -132,14 +400,17 @@ class TelegramModel:
                 callback = None
                 
             # Загружаем файл с отображением прогресса
-            path = await self.client.download_media(media, file_path, progress_callback=callback)
+            async with self.scheduler.slot('download_media'), tracer.call('download_media', f"chat={safe_chat_title} id={message_id}") as record:
+                path = await self.client.download_media(media, file_path, progress_callback=callback)
+                if path and os.path.exists(path):
+                    record.bytes = os.path.getsize(path)
             return path
         else:
             # Пытаемся определить расширение файла для создания правильной заглушки
             mime_type = getattr(media, 'mime_type', None)
-            file_ext = ""
+            file_ext = media.ext if isinstance(media, MediaRef) else ""
             
-            if mime_type:
+            if mime_type and not file_ext:
                 ext = mimetypes.guess_extension(mime_type)
                 if ext:
                     file_ext = ext
@@ -177,6 +448,59 @@ class TelegramModel:
             
             return empty_file_path
         
+    async def load_thumb(self, entity, message_id, thumb):
+        """Раскодированная миниатюра медиа для превью
+
+        Миниатюра из самого сообщения используется, если ее хватает на ширину превью;
+        иначе загружается самая маленькая миниатюра с сервера (несколько КБ) и сохраняется
+        на диск. Раскодирование идет в отдельном потоке по одной картинке, чтобы не
+        останавливать интерфейс.
+
+        Args:
+            entity: Чат сообщения (для обновления устаревшего file_reference)
+            message_id: ID сообщения
+            thumb: ThumbRef
+
+        Returns:
+            JpegImage
+        """
+        image = self.thumbs.image(thumb)
+        if image is not None:
+            return image
+
+        data = None
+        if thumb.cached or thumb.type is None or thumb.stripped_width >= self.thumbs.columns:
+            data = inline_thumb_bytes(thumb)
+        if data is None:
+            data = self.thumbs.read(thumb.key)
+        if data is None:
+            try:
+                data = await self.download_thumb(thumb)
+            except FileReferenceExpiredError:
+                # Ссылка на файл живет несколько часов - берем свежую из сообщения
+                message = await self.get_full_message(entity, message_id)
+                media = MediaRef.from_message(message) if message else None
+                if media is None or media.thumb is None:
+                    raise
+                thumb.file_reference = media.thumb.file_reference
+                data = await self.download_thumb(thumb)
+            self.thumbs.fetched_bytes += len(data)
+            self.thumbs.write(thumb.key, data)
+
+        image = await asyncio.get_running_loop().run_in_executor(self.thumbs.decoder, decode_jpeg, data)
+        self.thumbs.put_image(thumb, image)
+        return image
+
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, thumb: f"{thumb.kind}={thumb.id} size={thumb.type}", size=len)
+    async def download_thumb(self, thumb):
+        """Загружает миниатюру одним запросом по ее расположению, без запроса сообщения"""
+        return await self.client.download_file(thumb.location(), bytes, dc_id=thumb.dc_id)
+
+    @single_flight()
+    @scheduled()
+    @traced(lambda self, entity: f"peer={peer_summary(entity)}")
     async def send_read_acknowledge(self, entity):
         return await self.client.send_read_acknowledge(entity)
         
@@ -189,6 +513,11 @@ class TelegramModel:
             return dialog.entity.id
         return None
     
+    @staticmethod
+    def unmark_peer_id(peer_id):
+        """Переводит помеченный id чата из событий (-100... для каналов) в id сущности"""
+        return telethon.utils.resolve_id(peer_id)[0]
+
     @staticmethod
     def get_message_peer_id(message):
         peer = message.to_id
@@ -224,13 +553,15 @@ class TelegramModel:
                         except Exception:
                             pass
 
+    @single_flight(ttl=USER_STATUS_TTL)
     async def get_user_status(self, entity):
         """Получает статус пользователя (онлайн/оффлайн)"""
         try:
             # Проверяем, что это пользователь, а не чат или канал
             if hasattr(entity, 'user_id'):
                 # Получаем полную информацию о пользователе
-                full_user = await self.client(telethon.functions.users.GetFullUserRequest(entity))
+                async with self.scheduler.slot('GetFullUserRequest'), tracer.call('GetFullUserRequest', f"peer={peer_summary(entity)}"):
+                    full_user = await self.client(telethon.functions.users.GetFullUserRequest(entity))
                 if not full_user or not hasattr(full_user, 'user'):
                     return {'status': '', 'color': 0}
                     
@@ -268,11 +599,6 @@ class TelegramModel:
             # Игнорируем ошибки, просто возвращаем пустой статус
             return {'status': '', 'color': 0}
 
-    async def get_messages(self, dialog, limit=20, offset_id=0):
-        messages = await self.client.get_messages(dialog, limit=limit, offset_id=offset_id)
-        messages.reverse()
-        return messages
-
     async def check_can_send_messages(self, entity):
         """Проверяет, можно ли отправлять сообщения в указанную сущность, используя прямой API запрос"""
         try:
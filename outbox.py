@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+from telethon import helpers
+from telethon.tl import types
+from telethon.errors import RPCError, FloodWaitError, RandomIdDuplicateError
+
+from messages import MessageRecord
+from scheduler import RequestDropped
+
+OUTBOX_FILE = '.outbox.json'
+OUTBOX_VERSION = 1
+
+# Неотправленным сообщениям выдаются id больше любых настоящих,
+# поэтому в MessageStore они всегда оказываются в конце чата
+PENDING_ID_BASE = 1 << 62
+
+# Пауза перед повтором: от RETRY_DELAY, удваивается до RETRY_MAX_DELAY секунд
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+# Состояния исходящего сообщения (MessageRecord.status)
+PENDING = 'pending'
+RETRYING = 'retrying'
+FAILED = 'failed'
+
+
+def peer_to_dict(peer):
+    """InputPeer в виде словаря для JSON"""
+    if isinstance(peer, types.InputPeerUser):
+        return {'type': 'user', 'id': peer.user_id, 'access_hash': peer.access_hash}
+    if isinstance(peer, types.InputPeerChannel):
+        return {'type': 'channel', 'id': peer.channel_id, 'access_hash': peer.access_hash}
+    if isinstance(peer, types.InputPeerChat):
+        return {'type': 'chat', 'id': peer.chat_id}
+    if isinstance(peer, types.InputPeerSelf):
+        return {'type': 'self'}
+    raise ValueError(f"Нельзя сохранить получателя {type(peer).__name__}")
+
+
+def peer_from_dict(data):
+    kind = data['type']
+    if kind == 'user':
+        return types.InputPeerUser(data['id'], data['access_hash'])
+    if kind == 'channel':
+        return types.InputPeerChannel(data['id'], data['access_hash'])
+    if kind == 'chat':
+        return types.InputPeerChat(data['id'])
+    return types.InputPeerSelf()
+
+
+def is_retryable(error):
+    """Временная ли ошибка: обрыв, FloodWait, сбой сервера. Остальные ошибки сервера окончательные"""
+    if isinstance(error, (ConnectionError, OSError, asyncio.TimeoutError, FloodWaitError, RequestDropped)):
+        return True
+    if isinstance(error, RPCError):
+        return error.code is None or error.code >= 500
+    return False
+
+
+class OutboxEntry:
+    """Сообщение, которое еще не подтвердил сервер"""
+    __slots__ = (
+        'local_id', 'chat_id', 'peer', 'text', 'reply_to', 'random_id',
+        'created', 'attempts', 'next_attempt', 'error', 'failed', 'echoed'
+    )
+
+    def __init__(self, local_id, chat_id, peer, text, reply_to=None, random_id=None, created=None,
+                 attempts=0, next_attempt=0.0, error=None, failed=False):
+        self.local_id = local_id
+        self.chat_id = chat_id
+        self.peer = peer
+        self.text = text
+        self.reply_to = reply_to
+        # Один random_id на все попытки: сервер не создаст второе сообщение, если первая дошла
+        self.random_id = random_id if random_id is not None else helpers.generate_random_long()
+        self.created = created if created is not None else time.time()
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.error = error
+        self.failed = failed
+        # Эхо уже пришло событием, черновик в чате заменен настоящим сообщением
+        self.echoed = False
+
+    @property
+    def status(self):
+        if self.failed:
+            return FAILED
+        return RETRYING if self.attempts else PENDING
+
+    def to_dict(self):
+        return {
+            'chat_id': self.chat_id,
+            'peer': peer_to_dict(self.peer),
+            'text': self.text,
+            'reply_to': self.reply_to,
+            'random_id': self.random_id,
+            'created': self.created,
+            'attempts': self.attempts,
+            'error': self.error,
+            'failed': self.failed
+        }
+
+
+class Outbox:
+    """Очередь исходящих сообщений на диске
+
+    Сообщение попадает в очередь до первого запроса к серверу и удаляется из нее
+    только после подтверждения, поэтому переживает обрывы связи и перезапуски.
+    Отправка идет строго по порядку, временные ошибки повторяются с нарастающей паузой.
+    """
+    def __init__(self, path=OUTBOX_FILE):
+        self.path = path
+        self.entries = []
+        self.sequence = itertools.count()
+        self.wake = asyncio.Event()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != OUTBOX_VERSION:
+                return
+            for item in data['entries']:
+                self.entries.append(OutboxEntry(
+                    self.next_local_id(), item['chat_id'], peer_from_dict(item['peer']), item['text'],
+                    item.get('reply_to'), item['random_id'], item['created'],
+                    item.get('attempts', 0), 0.0, item.get('error'), item.get('failed', False)
+                ))
+        except Exception:
+            # Поврежденный файл не должен мешать запуску
+            self.entries = []
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'version': OUTBOX_VERSION, 'entries': [entry.to_dict() for entry in self.entries]}
+        # Пишем во временный файл, чтобы не потерять очередь при падении
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def next_local_id(self):
+        return PENDING_ID_BASE + next(self.sequence)
+
+    def add(self, chat_id, peer, text, reply_to=None):
+        """Ставит сообщение в очередь и сразу сохраняет ее на диск"""
+        entry = OutboxEntry(self.next_local_id(), chat_id, peer, text, reply_to)
+        self.entries.append(entry)
+        self.save()
+        self.wake.set()
+        return entry
+
+    def remove(self, entry):
+        if entry in self.entries:
+            self.entries.remove(entry)
+            self.save()
+
+    def retry(self, entry):
+        """Снова отправляет сообщение, даже если оно помечено неотправленным"""
+        entry.failed = False
+        entry.next_attempt = 0.0
+        self.save()
+        self.wake.set()
+
+    def get(self, local_id):
+        for entry in self.entries:
+            if entry.local_id == local_id:
+                return entry
+        return None
+
+    def for_chat(self, chat_id):
+        return [entry for entry in self.entries if entry.chat_id == chat_id]
+
+    def match_echo(self, chat_id, text):
+        """Неподтвержденное сообщение, эхо которого, видимо, пришло событием раньше ответа сервера"""
+        for entry in self.entries:
+            if entry.chat_id == chat_id and not entry.failed and not entry.echoed and entry.text == text:
+                entry.echoed = True
+                return entry
+        return None
+
+    @staticmethod
+    def record(entry, sender_name=None):
+        """Запись для отрисовки в чате на месте еще не отправленного сообщения"""
+        return MessageRecord(
+            entry.local_id, entry.chat_id, datetime.fromtimestamp(entry.created, tz=timezone.utc),
+            sender_name=sender_name, text=entry.text, out=True, reply_to=entry.reply_to, status=entry.status
+        )
+
+    async def run(self, send, on_sent, on_changed):
+        """Отправляет сообщения очереди, пока задачу не отменят
+
+        Args:
+            send: Корутина (entry) -> (id, дата) отправленного сообщения
+            on_sent: Корутина (entry, id, дата) после подтверждения; id None, если сервер
+                сообщил, что сообщение уже было доставлено раньше
+            on_changed: Корутина (entry) после неудачной попытки
+        """
+        while True:
+            entry = next((entry for entry in self.entries if not entry.failed), None)
+            if entry is None:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+
+            delay = entry.next_attempt - time.time()
+            if delay > 0:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                msg_id, date = await send(entry)
+            except RandomIdDuplicateError:
+                # Предыдущая попытка дошла, а ответ потерялся
+                self.remove(entry)
+                await on_sent(entry, None, None)
+                continue
+            except Exception as e:
+                entry.error = str(e) or type(e).__name__
+                entry.attempts += 1
+                if is_retryable(e):
+                    entry.next_attempt = time.time() + min(RETRY_DELAY * 2 ** (entry.attempts - 1), RETRY_MAX_DELAY)
+                else:
+                    entry.failed = True
+                self.save()
+                await on_changed(entry)
+                continue
+
+            self.remove(entry)
+            await on_sent(entry, msg_id, date)
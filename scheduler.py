@@ -0,0 +1,218 @@
+import time
+import asyncio
+import functools
+import itertools
+import contextlib
+import contextvars
+
+from telethon.errors import FloodWaitError
+
+# Классы приоритета: чем меньше число, тем раньше выполняется запрос
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# Сколько запросов к серверу может выполняться одновременно
+MAX_IN_FLIGHT = 6
+# Больше стольких фоновых запросов в очереди не держим - новые отбрасываются
+MAX_BACKGROUND_QUEUE = 20
+# Интерактивный запрос повторяется после FloodWait, если ждать не дольше этого, секунд
+MAX_FLOOD_RETRY_WAIT = 10
+FLOOD_RETRIES = 2
+
+# Ограничения частоты по методам: (запросов в секунду, запас для всплеска)
+RATE_LIMITS = {
+    'get_dialogs': (1, 3),
+    'iter_dialogs': (1, 3),
+    'get_messages': (5, 10),
+    'get_newer_messages': (5, 10),
+    'get_full_message': (5, 10),
+    'send_message': (2, 5),
+    'send_read_acknowledge': (2, 5),
+    'GetFullUserRequest': (1, 3),
+    'download_media': (2, 4),
+    'download_thumb': (5, 10),
+    'export_page': (1, 3),
+    'takeout_page': (5, 10),
+    'search_media': (2, 5),
+    'upload_file': (1, 3),
+    'send_uploaded_file': (2, 5)
+}
+
+# Приоритет запросов, запущенных в текущем контексте
+current_priority = contextvars.ContextVar('request_priority', default=NORMAL)
+
+
+class RequestDropped(Exception):
+    """Фоновый запрос отброшен, чтобы не мешать интерактивным при ограничениях сервера"""
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Задает приоритет запросов внутри блока и в запущенных из него задачах"""
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду с запасом burst"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Через сколько секунд появится свободный токен"""
+        self.refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """Очередь запросов к серверу с приоритетами, ограничением частоты и паузой после FloodWait
+
+    Запрос получает слот, когда нет паузы, есть свободное место среди выполняющихся,
+    у его метода есть токен и среди готовых к запуску нет запроса важнее.
+    """
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, rate_limits=RATE_LIMITS):
+        self.max_in_flight = max_in_flight
+        self.buckets = {method: TokenBucket(rate, burst) for method, (rate, burst) in rate_limits.items()}
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.blocked_until = 0.0
+        self.changed = asyncio.Event()
+        self.dropped = 0
+        self.offline = False
+        # Вызывается с ошибкой, когда запрос оборвался из-за потери соединения
+        self.on_connection_error = None
+
+    def blocked_for(self):
+        """Сколько еще секунд длится пауза после FloodWait"""
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def block(self, seconds):
+        """Приостанавливает все запросы на seconds секунд"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.notify()
+
+    def set_offline(self, offline):
+        """Без соединения новые запросы сразу завершаются ConnectionError"""
+        self.offline = offline
+        self.notify()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def wait_time(self, ticket):
+        """0, если запрос можно запускать, иначе сколько ждать (None - до следующего изменения очереди)"""
+        blocked = self.blocked_for()
+        if blocked:
+            return blocked
+        if self.in_flight >= self.max_in_flight:
+            return None
+        for other in sorted(self.waiting):
+            bucket = self.buckets.get(other[2])
+            delay = bucket.delay() if bucket else 0.0
+            if other is ticket:
+                return delay
+            if not delay:
+                # Впереди есть более важный запрос, готовый к запуску
+                return None
+        return None
+
+    async def acquire(self, method, level):
+        if self.offline:
+            raise ConnectionError("Нет соединения с сервером")
+        background = sum(1 for ticket in self.waiting if ticket[0] == BACKGROUND)
+        if level == BACKGROUND and (self.blocked_for() or background >= MAX_BACKGROUND_QUEUE):
+            self.dropped += 1
+            raise RequestDropped(method)
+
+        ticket = (level, next(self.sequence), method)
+        self.waiting.append(ticket)
+        try:
+            while True:
+                wait = self.wait_time(ticket)
+                if wait == 0:
+                    break
+                changed = self.changed
+                try:
+                    await asyncio.wait_for(changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if self.offline:
+                    raise ConnectionError("Нет соединения с сервером")
+        finally:
+            self.waiting.remove(ticket)
+
+        bucket = self.buckets.get(method)
+        if bucket:
+            bucket.take()
+        self.in_flight += 1
+        # Следующий в очереди мог стать готовым к запуску
+        self.notify()
+
+    def release(self):
+        self.in_flight -= 1
+        self.notify()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, method, level=None):
+        """Ждет своей очереди на запрос; FloodWait внутри блока ставит паузу для всех"""
+        await self.acquire(method, current_priority.get() if level is None else level)
+        try:
+            yield
+        except FloodWaitError as e:
+            self.block(e.seconds)
+            raise
+        except ConnectionError as e:
+            if self.on_connection_error:
+                self.on_connection_error(e)
+            raise
+        finally:
+            self.release()
+
+    def status(self):
+        """Состояние очереди для метрик"""
+        return {
+            'in_flight': self.in_flight,
+            'waiting': len(self.waiting),
+            'blocked_for_s': round(self.blocked_for(), 1),
+            'dropped': self.dropped
+        }
+
+
+def scheduled(method=None):
+    """Декоратор для методов модели: запрос выполняется через планировщик модели
+
+    Интерактивные запросы после короткого FloodWait повторяются, когда пауза закончится;
+    остальные получают ошибку сразу.
+    """
+    def decorator(func):
+        name = method or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            level = current_priority.get()
+            for attempt in range(FLOOD_RETRIES + 1):
+                try:
+                    async with self.scheduler.slot(name, level):
+                        return await func(self, *args, **kwargs)
+                except FloodWaitError as e:
+                    if level != INTERACTIVE or e.seconds > MAX_FLOOD_RETRY_WAIT or attempt == FLOOD_RETRIES:
+                        raise
+        return wrapper
+    return decorator
@@ -0,0 +1,89 @@
+import time
+import asyncio
+import inspect
+import functools
+from collections import Counter
+
+from metrics import metrics
+from scheduler import current_priority
+
+# Сколько запросов обслужено без обращения к серверу: присоединились к выполняющемуся или взяты из TTL-кэша
+stats = Counter()
+metrics.gauge('rpc_deduplicated', lambda: stats['joined'] + stats['cached'], 'RPC без повтора')
+
+
+def request_key_part(value):
+    """Значение аргумента для ключа запроса: чаты и диалоги сравниваются по id"""
+    entity = getattr(value, 'entity', value)
+    entity_id = getattr(entity, 'id', None)
+    if entity_id is not None and not isinstance(value, (int, str)):
+        return ('peer', entity_id)
+    try:
+        hash(value)
+    except TypeError:
+        return ('object', id(value))
+    return value
+
+
+def single_flight(ttl=0.0):
+    """Декоратор для методов модели: одинаковые одновременные запросы выполняются один раз
+
+    Все, кто вызвал метод с теми же аргументами, пока запрос выполняется, получают
+    его результат. С ttl > 0 результат еще ttl секунд отдается без запроса к серверу.
+    Запрос выполняется отдельной задачей, поэтому отмена одного из ожидающих
+    не прерывает его для остальных.
+
+    Задача наследует приоритет того, кто ее запустил. Поэтому к запросу
+    присоединяются только вызовы с тем же или более низким приоритетом:
+    интерактивный вызов не ждет фоновый запрос в общей очереди и не получает
+    RequestDropped вместо него, а запускает свой.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__name__,) + tuple(
+                request_key_part(value) for name, value in bound.arguments.items() if name != 'self'
+            )
+
+            state = self.__dict__.setdefault('_single_flight', {'inflight': {}, 'results': {}})
+            cached = state['results'].get(key)
+            if cached is not None:
+                expires, result = cached
+                if time.monotonic() < expires:
+                    stats['cached'] += 1
+                    return result[:] if isinstance(result, list) else result
+                del state['results'][key]
+
+            level = current_priority.get()
+            inflight = state['inflight'].get(key)
+            if inflight is None or inflight[1] > level:
+                task = asyncio.ensure_future(func(self, *args, **kwargs))
+                # Следующие вызовы присоединяются к самому важному из запущенных запросов
+                state['inflight'][key] = (task, level)
+
+                def finished(done_task):
+                    if state['inflight'].get(key, (None,))[0] is done_task:
+                        del state['inflight'][key]
+                    # exception() заодно помечает ошибку полученной, даже если все ожидающие отменены
+                    if done_task.cancelled() or done_task.exception() is not None:
+                        return
+                    if ttl:
+                        now = time.monotonic()
+                        results = state['results']
+                        for stale_key in [k for k, (expires, _) in results.items() if expires <= now]:
+                            del results[stale_key]
+                        results[key] = (now + ttl, done_task.result())
+                task.add_done_callback(finished)
+            else:
+                task = inflight[0]
+                stats['joined'] += 1
+
+            result = await asyncio.shield(task)
+            # Каждому вызывающему - своя копия списка, чтобы изменения одного не задели других
+            return result[:] if isinstance(result, list) else result
+        return wrapper
+    return decorator
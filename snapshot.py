@@ -0,0 +1,87 @@
+import os
+import json
+from datetime import datetime
+from messages import MessageRecord
+
+SNAPSHOT_FILE = '.snapshot.json'
+SNAPSHOT_VERSION = 1
+
+# Сколько последних сообщений открытого чата сохраняем
+SNAPSHOT_TAIL_SIZE = 20
+
+
+class SnapshotEntity:
+    """Заглушка сущности диалога из снимка (только идентификатор)"""
+    def __init__(self, entity_id):
+        self.id = entity_id
+
+
+class SnapshotDialog:
+    """Диалог, восстановленный из снимка до подключения к серверу"""
+    def __init__(self, dialog_id, title, unread_count=0, unread_mentions_count=0):
+        self.entity = SnapshotEntity(dialog_id)
+        self.title = title
+        self.unread_count = unread_count
+        self.unread_mentions_count = unread_mentions_count
+
+
+def save_snapshot(dialogs, get_dialog_id, open_chat_id=None, messages=None, path=SNAPSHOT_FILE):
+    """Сохраняет компактный снимок списка диалогов и хвоста открытого чата"""
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'dialogs': [],
+        'open_chat_id': open_chat_id,
+        'tail': []
+    }
+
+    for dialog in dialogs:
+        dialog_id = get_dialog_id(dialog)
+        if dialog_id is None:
+            continue
+        data['dialogs'].append([
+            dialog_id,
+            dialog.title or "",
+            getattr(dialog, 'unread_count', 0) or 0,
+            getattr(dialog, 'unread_mentions_count', 0) or 0
+        ])
+
+    if open_chat_id is not None and messages:
+        for msg in messages[-SNAPSHOT_TAIL_SIZE:]:
+            # Неотправленные сообщения восстанавливаются из очереди исходящих, а не из снимка
+            if getattr(msg, 'date', None) is None or msg.status:
+                continue
+            data['tail'].append([
+                msg.id,
+                msg.date.isoformat(),
+                msg.sender_name,
+                msg.text or "",
+                msg.out
+            ])
+
+    # Пишем во временный файл, чтобы не оставить битый снимок при падении
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """Загружает снимок. Возвращает (диалоги, id открытого чата, хвост сообщений) или None"""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != SNAPSHOT_VERSION:
+            return None
+
+        dialogs = [SnapshotDialog(*entry) for entry in data['dialogs']]
+        tail = [
+            MessageRecord(msg_id, data.get('open_chat_id'), datetime.fromisoformat(date), sender_name=sender, text=text, out=out)
+            for msg_id, date, sender, text, out in data['tail']
+        ]
+        return dialogs, data.get('open_chat_id'), tail
+    except Exception:
+        # Повреждённый снимок просто игнорируем
+        return None
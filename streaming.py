@@ -0,0 +1,203 @@
+import os
+import time
+import shlex
+import shutil
+import asyncio
+import mimetypes
+
+from tracing import tracer
+
+# Размер одного запроса части файла к серверу
+PART_SIZE = 512 * 1024
+# Сколько байт за раз отдавать плееру из уже загруженного
+SEND_CHUNK = 256 * 1024
+# Если плеер просит данные дальше загруженного больше чем на столько, они запрашиваются
+# с сервера напрямую, не дожидаясь последовательной загрузки (например, индекс mp4 в конце файла)
+FAR_AHEAD = 2 * 1024 * 1024
+# Видео и аудио меньше этого размера проще скачать целиком
+STREAM_MIN_SIZE = 1024 * 1024
+# Плееры, которые умеют открывать http-адрес и перематывать по Range, в порядке предпочтения
+PLAYERS = ('mpv', 'vlc', 'ffplay', 'mplayer')
+
+
+def player_command(setting=''):
+    """Команда запуска плеера: из настройки Player или первый найденный из PLAYERS; None, если плеера нет"""
+    if setting.strip():
+        return shlex.split(setting)
+    for name in PLAYERS:
+        path = shutil.which(name)
+        if path:
+            return [path]
+    return None
+
+
+def is_streamable(media):
+    """Стоит ли показывать медиа потоком: видео или аудио заметного размера"""
+    mime_type = media.mime_type or ''
+    playable = media.kind in ('video', 'voice') or mime_type.startswith(('video/', 'audio/'))
+    return playable and (media.size or 0) >= STREAM_MIN_SIZE
+
+
+def parse_range(header, size):
+    """Границы запроса Range: bytes=начало-конец (включительно); None, если заголовка нет или он не разобран"""
+    if not header or not header.startswith('bytes='):
+        return None
+    first = header[len('bytes='):].split(',')[0].strip()
+    start, _, end = first.partition('-')
+    try:
+        if not start:
+            # bytes=-N: последние N байт
+            return max(0, size - int(end)), size - 1
+        return int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+
+
+class MediaStream:
+    """Загружает файл по порядку и одновременно раздает его плееру по http с localhost
+
+    Загруженное пишется во временный файл рядом с итоговым и после окончания становится
+    обычным загруженным файлом, поэтому повторное открытие не требует сети. Запросы
+    плеера далеко впереди загруженного обслуживаются отдельной загрузкой с нужного места.
+    """
+    def __init__(self, client, media, path, size, name=None):
+        self.client = client
+        self.media = media
+        self.path = path
+        self.part_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.part")
+        self.size = size
+        self.name = name or os.path.basename(path)
+        self.mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.available = 0
+        self.done = False
+        self.error = None
+        self.started = time.monotonic()
+        self.finished_at = None
+        self.server = None
+        self.url = None
+        # Задача последовательной загрузки, ее создает модель
+        self.task = None
+        self.changed = asyncio.Event()
+
+    async def start(self):
+        """Открывает http-сервер на свободном порту localhost"""
+        open(self.part_path, 'wb').close()
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/{os.path.basename(self.path)}"
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def download(self, progress_callback=None):
+        """Последовательно загружает весь файл; по окончании переносит его на итоговое место"""
+        try:
+            with open(self.part_path, 'r+b') as f:
+                async for chunk in self.client.iter_download(self.media, request_size=PART_SIZE, file_size=self.size):
+                    f.write(chunk)
+                    f.flush()
+                    self.available += len(chunk)
+                    self.notify()
+                    if progress_callback:
+                        progress_callback(self.available, self.size)
+            os.replace(self.part_path, self.path)
+            self.done = True
+        except BaseException as e:
+            self.error = str(e) or type(e).__name__
+            raise
+        finally:
+            self.finished_at = time.monotonic()
+            self.notify()
+
+    def file_for_reading(self):
+        return self.path if self.done else self.part_path
+
+    async def handle(self, reader, writer):
+        """Один http-запрос плеера: GET или HEAD, с Range или без"""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            method = lines[0].split(' ')[0]
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if method not in ('GET', 'HEAD'):
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+
+            requested = parse_range(headers.get('range'), self.size)
+            if requested and requested[0] >= self.size:
+                writer.write(f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{self.size}\r\n"
+                             f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode())
+                return
+            start, end = requested or (0, self.size - 1)
+            status = '206 Partial Content' if requested else '200 OK'
+            response = [
+                f"HTTP/1.1 {status}",
+                f"Content-Type: {self.mime_type}",
+                f"Content-Length: {end - start + 1}",
+                "Accept-Ranges: bytes",
+                "Connection: close"
+            ]
+            if requested:
+                response.append(f"Content-Range: bytes {start}-{end}/{self.size}")
+            writer.write(('\r\n'.join(response) + '\r\n\r\n').encode())
+            if method == 'GET':
+                await self.send_range(writer, start, end)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            # Плеер закрыл соединение, например при перемотке
+            pass
+        finally:
+            writer.close()
+
+    async def send_range(self, writer, start, end):
+        position = start
+        with open(self.file_for_reading(), 'rb') as f:
+            while position <= end:
+                if position < self.available or self.done:
+                    f.seek(position)
+                    data = f.read(min(SEND_CHUNK, self.size - position, end + 1 - position))
+                    if not data:
+                        return
+                    writer.write(data)
+                    await writer.drain()
+                    position += len(data)
+                elif self.error:
+                    return
+                elif position - self.available > FAR_AHEAD:
+                    position = await self.send_direct(writer, position, end)
+                else:
+                    await self.changed.wait()
+
+    async def send_direct(self, writer, position, end):
+        """Отдает диапазон, загружая его с сервера с нужного места, пока до него не дошла последовательная загрузка"""
+        aligned = position - position % PART_SIZE
+        async with tracer.call('stream_range', f"offset={aligned}") as record:
+            async for chunk in self.client.iter_download(self.media, offset=aligned, request_size=PART_SIZE, file_size=self.size):
+                record.bytes = (record.bytes or 0) + len(chunk)
+                data = bytes(chunk[position - aligned:end + 1 - aligned])
+                aligned += len(chunk)
+                if data:
+                    writer.write(data)
+                    await writer.drain()
+                    position += len(data)
+                if position > end or position < self.available:
+                    break
+        return position
+
+    def status(self):
+        """Строка для заголовка: сколько загружено и скорость"""
+        if self.error:
+            return f"не удалось загрузить {self.name}: {self.error}"
+        percent = int(self.available * 100 / self.size) if self.size else 0
+        speed = self.available / max(time.monotonic() - self.started, 1e-3) / (1024 * 1024)
+        return f"поток {self.name}: {percent}%, {speed:.1f} МБ/с"
@@ -0,0 +1,237 @@
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+from wcwidth import wcwidth, wcswidth
+
+# Размеры кэшей: ширины отдельных символов и префиксные массивы строк
+CHAR_CACHE_SIZE = 4096
+PREFIX_CACHE_SIZE = 2048
+
+BORDER_RUNS = re.compile('([╭╮╰╯─│]+)')
+WRAP_TOKENS = re.compile(r'\S+|\s+')
+ZWJ = '\u200d'
+# Символы, с которыми несколько кодовых точек рисуются одним знаком: ZWJ, VS16,
+# региональные индикаторы флагов, модификаторы цвета кожи и теги флагов регионов
+CLUSTER_MARKS = re.compile('[\u200d\ufe0f\U0001F1E6-\U0001F1FF\U0001F3FB-\U0001F3FF\U000E0020-\U000E007F]')
+
+
+@lru_cache(maxsize=CHAR_CACHE_SIZE)
+def _cached_char_width(ch):
+    width = wcwidth(ch)
+    # Управляющие символы wcwidth помечает как -1, на экране они места не занимают
+    return width if width > 0 else 0
+
+
+def char_width(ch):
+    """Ширина символа в колонках терминала"""
+    if ' ' <= ch <= '~':
+        return 1
+    return _cached_char_width(ch)
+
+
+def is_regional(ch):
+    return '\U0001F1E6' <= ch <= '\U0001F1FF'
+
+
+@lru_cache(maxsize=CHAR_CACHE_SIZE)
+def _cluster_width(cluster):
+    # Ширину последовательности считаем так же, как wcswidth: знак целиком, а не сумма символов
+    width = wcswidth(cluster)
+    return width if width >= 0 else sum(map(char_width, cluster))
+
+
+def _cluster_widths(text):
+    """Ширины символов, где вся последовательность (основа с ZWJ, VS16, модификаторами
+    или пара индикаторов флага) записана на первый символ, а остальные - нулевой ширины"""
+    widths = []
+    i, n = 0, len(text)
+    while i < n:
+        start = i
+        i += 1
+        if is_regional(text[start]) and i < n and is_regional(text[i]):
+            i += 1
+        while i < n:
+            if text[i] == ZWJ:
+                # Соединитель присоединяет следующий знак к той же последовательности
+                i = min(n, i + 2)
+            elif char_width(text[i]) == 0 and text[i] >= ' ':
+                i += 1
+            else:
+                break
+        widths.append(_cluster_width(text[start:i]) if i - start > 1 else char_width(text[start]))
+        widths.extend([0] * (i - start - 1))
+    return widths
+
+
+def char_widths(text):
+    """Ширины символов строки; последовательность эмодзи занимает место один раз, на первом символе"""
+    if CLUSTER_MARKS.search(text):
+        return _cluster_widths(text)
+    return map(char_width, text)
+
+
+def is_plain(text):
+    """Строка из печатных ASCII-символов: ширина равна длине"""
+    return text.isascii() and text.isprintable()
+
+
+@lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def prefix_widths(text):
+    """Префиксные ширины: prefix[i] - ширина первых i символов строки"""
+    return (0, *accumulate(char_widths(text)))
+
+
+def text_width(text):
+    """Ширина строки в колонках терминала"""
+    if is_plain(text):
+        return len(text)
+    return prefix_widths(text)[-1]
+
+
+def cut_index(text, max_width):
+    """Число символов строки, которое помещается в max_width колонок"""
+    if max_width <= 0:
+        return 0
+    if is_plain(text):
+        return min(len(text), max_width)
+    prefix = prefix_widths(text)
+    if prefix[-1] <= max_width:
+        return len(text)
+    # Последний префикс, не превышающий ширину; символы нулевой ширины и хвосты
+    # последовательностей эмодзи остаются со своей основой
+    return bisect_right(prefix, max_width) - 1
+
+
+def slice_to_width(text, max_width):
+    """Обрезает строку так, чтобы она занимала не больше max_width колонок"""
+    return text[:cut_index(text, max_width)]
+
+
+def pad_to_width(text, width):
+    """Дополняет строку пробелами до ширины width"""
+    current_width = text_width(text)
+    if current_width < width:
+        return text + " " * (width - current_width)
+    return text
+
+
+def fit_to_width(text, width):
+    """Обрезает и дополняет строку ровно до width колонок за один проход"""
+    if is_plain(text):
+        return text[:width].ljust(width)
+    prefix = prefix_widths(text)
+    cut = len(text) if prefix[-1] <= width else bisect_right(prefix, width) - 1
+    return text[:cut] + " " * (width - prefix[cut])
+
+
+def measure(text):
+    """Ширина строки без кэширования префиксов (для одноразовых строк)"""
+    if is_plain(text):
+        return len(text)
+    return sum(char_widths(text))
+
+
+def wrap(text, width):
+    """Переносит абзац по ширине в колонках терминала за один проход
+
+    Переносит по пробелам, а слова длиннее строки (например, ссылки) режет по колонкам.
+
+    Returns:
+        Список кортежей (строка, ширина строки)
+    """
+    width = max(1, width)
+    if '\t' in text:
+        text = text.expandtabs()
+    if is_plain(text) and len(text) <= width:
+        return [(text, len(text))]
+
+    lines = []
+    parts = []
+    line_width = 0
+
+    def flush():
+        nonlocal parts, line_width
+        # Пробелы в конце строки не расширяют рамку
+        if parts and parts[-1][0].isspace():
+            line_width -= measure(parts.pop())
+        lines.append((''.join(parts), line_width))
+        parts = []
+        line_width = 0
+
+    for token in WRAP_TOKENS.findall(text):
+        token_width = measure(token)
+
+        if line_width + token_width <= width:
+            parts.append(token)
+            line_width += token_width
+            continue
+
+        if token[0].isspace():
+            # Пробелы на месте переноса отбрасываем
+            if parts:
+                flush()
+            continue
+
+        if parts:
+            flush()
+
+        if token_width <= width:
+            parts.append(token)
+            line_width = token_width
+            continue
+
+        # Длинное слово режем по префиксным ширинам, без повторных измерений. Хвосты
+        # последовательностей эмодзи нулевой ширины, поэтому разрыв попадает между знаками
+        prefix = (0, *accumulate(char_widths(token)))
+        start = 0
+        while prefix[-1] - prefix[start] > width:
+            cut = bisect_right(prefix, prefix[start] + width, start) - 1
+            if cut == start:
+                # Первый знак шире строки: он занимает строку целиком, вместе со своим хвостом
+                cut = start + 1
+                while cut < len(token) and prefix[cut + 1] == prefix[cut]:
+                    cut += 1
+            lines.append((token[start:cut], prefix[cut] - prefix[start]))
+            start = cut
+        if start < len(token):
+            parts.append(token[start:])
+            line_width = prefix[-1] - prefix[start]
+
+    if parts or not lines:
+        flush()
+    return lines
+
+
+def split_border(text):
+    """Делит строку на отрезки: (текст, является ли отрезок рамкой)"""
+    for i, segment in enumerate(BORDER_RUNS.split(text)):
+        if segment:
+            yield segment, i % 2 == 1
+
+
+# Строки для самопроверки: семья через ZWJ, флаг с VS16 и ZWJ, флаг из индикаторов,
+# цвет кожи, эмодзи с VS16 и профессия с цветом кожи
+CHECK_SAMPLES = ('👨\u200d👩\u200d👧', '🏳\ufe0f\u200d🌈', '🇷🇺', '👍🏽', '❤\ufe0f', '👩🏽\u200d💻')
+
+
+def check():
+    """Самопроверка: ширина последовательностей эмодзи совпадает с wcswidth, перенос их не разрывает"""
+    for sample in CHECK_SAMPLES:
+        for text in (sample, sample * 3, f"a {sample} b"):
+            assert text_width(text) == wcswidth(text), (text, text_width(text), wcswidth(text))
+            assert measure(text) == wcswidth(text), text
+            assert text_width(fit_to_width(text, 5)) == 5, text
+        # Слово из нескольких знаков подряд: переносы только между целыми знаками
+        word = sample * 3
+        for width in range(1, 5):
+            lines = [line for line, _ in wrap(word, width)]
+            assert ''.join(lines) == word, (word, width, lines)
+            for line in lines:
+                assert line.replace(sample, '') == '', (word, width, lines)
+                assert text_width(line) <= max(width, text_width(sample)), (word, width, lines)
+    print("textwidth: ok")
+
+
+if __name__ == '__main__':
+    check()
@@ -0,0 +1,458 @@
+import os
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telethon import utils
+
+THUMBS_DIR = '.thumbs'
+# Сколько миниатюр держать на диске; при запуске лишние, самые старые, удаляются
+THUMBS_DISK_LIMIT = 2000
+# Сколько раскодированных миниатюр держать в памяти
+THUMBS_MEMORY_LIMIT = 200
+# Ширина превью в колонках по умолчанию
+PREVIEW_COLUMNS = 24
+# Картинки больше стольких пикселей не раскодируются: декодер на чистом Python держит GIL,
+# а для превью в пару десятков колонок хватает миниатюры 320x320
+MAX_DECODE_PIXELS = 320 * 320
+# Каждый канал цвета превью округляется до одного из шести уровней палитры 256 цветов:
+# соседние ячейки чаще совпадают, и на экран выводится меньше отрезков
+PALETTE_LEVELS = (0, 95, 135, 175, 215, 255)
+# Верхняя половина ячейки - цвет символа, нижняя - цвет фона
+HALF_BLOCK = '▀'
+
+ZIGZAG = (
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63
+)
+# IDCT_TABLE[x][u] = C(u) / 2 * cos((2x + 1) * u * pi / 16)
+IDCT_TABLE = tuple(
+    tuple((math.sqrt(0.5) if u == 0 else 1.0) / 2 * math.cos((2 * x + 1) * u * math.pi / 16) for u in range(8))
+    for x in range(8)
+)
+
+
+class JpegImage:
+    """Раскодированная картинка: RGB по три байта на пиксель, построчно"""
+    __slots__ = ('width', 'height', 'pixels')
+
+    def __init__(self, width, height, pixels):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+
+
+class BitReader:
+    """Чтение энтропийных данных JPEG по битам с учетом байтов-заполнителей 0xFF00"""
+    def __init__(self, data, pos):
+        self.data = data
+        self.pos = pos
+        self.acc = 0
+        self.bits = 0
+
+    def bit(self):
+        if not self.bits:
+            byte = self.data[self.pos] if self.pos < len(self.data) else 0
+            self.pos += 1
+            if byte == 0xFF:
+                marker = self.data[self.pos] if self.pos < len(self.data) else 0
+                if marker == 0:
+                    self.pos += 1
+                elif 0xD0 <= marker <= 0xD7 or marker == 0xD9:
+                    # Маркер посреди данных: дальше нули, его обработает restart()
+                    self.pos -= 1
+                    byte = 0
+            self.acc = byte
+            self.bits = 8
+        self.bits -= 1
+        return (self.acc >> self.bits) & 1
+
+    def receive(self, length):
+        value = 0
+        for _ in range(length):
+            value = (value << 1) | self.bit()
+        return value
+
+    def decode(self, table):
+        code = 0
+        for length in range(1, 17):
+            code = (code << 1) | self.bit()
+            value = table.get((length, code))
+            if value is not None:
+                return value
+        raise ValueError("Повреждены данные JPEG")
+
+    def restart(self):
+        """Пропускает маркер RSTn и начинает чтение с нового байта"""
+        self.bits = 0
+        while self.pos + 1 < len(self.data) and not (self.data[self.pos] == 0xFF and 0xD0 <= self.data[self.pos + 1] <= 0xD7):
+            self.pos += 1
+        self.pos += 2
+
+
+def extend(value, length):
+    """Знаковое значение коэффициента из length бит"""
+    return value - (1 << length) + 1 if length and value < 1 << (length - 1) else value
+
+
+def huffman_table(counts, symbols):
+    table = {}
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            table[(length, code)] = symbols[k]
+            code += 1
+            k += 1
+        code <<= 1
+    return table
+
+
+def idct_block(coeffs):
+    """Обратное DCT блока 8x8 (по строкам, затем по столбцам) со сдвигом уровня и ограничением 0..255"""
+    if not any(coeffs[1:]):
+        # Частый в миниатюрах случай: блок одного цвета
+        value = min(255, max(0, int(round(coeffs[0] / 8 + 128))))
+        return [value] * 64
+
+    table = IDCT_TABLE
+    temp = [0.0] * 64
+    for v in range(8):
+        row = coeffs[v * 8:v * 8 + 8]
+        if not any(row):
+            continue
+        for x in range(8):
+            t = table[x]
+            temp[v * 8 + x] = sum(t[u] * row[u] for u in range(8) if row[u])
+    out = [0] * 64
+    for x in range(8):
+        column = [temp[v * 8 + x] for v in range(8)]
+        for y in range(8):
+            t = table[y]
+            value = int(round(sum(t[v] * column[v] for v in range(8)) + 128))
+            out[y * 8 + x] = 255 if value > 255 else (0 if value < 0 else value)
+    return out
+
+
+def decode_jpeg(data):
+    """Раскодирует baseline JPEG (так сжаты миниатюры Telegram)
+
+    Прогрессивные и арифметически сжатые картинки и картинки больше
+    MAX_DECODE_PIXELS не поддерживаются.
+
+    Returns:
+        JpegImage
+
+    Raises:
+        ValueError: Картинка повреждена или в неподдерживаемом формате
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("Не JPEG")
+
+    quant = {}
+    dc_tables = {}
+    ac_tables = {}
+    components = []
+    width = height = 0
+    restart_interval = 0
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("Повреждены данные JPEG")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        segment = data[pos + 4:pos + 2 + length]
+
+        if marker == 0xDB:
+            i = 0
+            while i < len(segment):
+                precision, table_id = segment[i] >> 4, segment[i] & 15
+                if precision:
+                    quant[table_id] = [(segment[i + 1 + 2 * k] << 8) | segment[i + 2 + 2 * k] for k in range(64)]
+                    i += 129
+                else:
+                    quant[table_id] = list(segment[i + 1:i + 65])
+                    i += 65
+        elif marker in (0xC0, 0xC1):
+            height = (segment[1] << 8) | segment[2]
+            width = (segment[3] << 8) | segment[4]
+            if width * height > MAX_DECODE_PIXELS:
+                raise ValueError(f"Слишком большая картинка для превью: {width}x{height}")
+            for k in range(segment[5]):
+                component_id, sampling, table_id = segment[6 + 3 * k:9 + 3 * k]
+                components.append({'id': component_id, 'h': sampling >> 4, 'v': sampling & 15, 'quant': table_id})
+        elif 0xC2 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            raise ValueError("Неподдерживаемый JPEG (прогрессивный или арифметический)")
+        elif marker == 0xC4:
+            i = 0
+            while i < len(segment):
+                table_class, table_id = segment[i] >> 4, segment[i] & 15
+                counts = segment[i + 1:i + 17]
+                total = sum(counts)
+                table = huffman_table(counts, segment[i + 17:i + 17 + total])
+                (ac_tables if table_class else dc_tables)[table_id] = table
+                i += 17 + total
+        elif marker == 0xDD:
+            restart_interval = (segment[0] << 8) | segment[1]
+        elif marker == 0xDA:
+            if segment[0] != len(components):
+                raise ValueError("Неподдерживаемый JPEG (каналы в отдельных сканах)")
+            by_id = {component['id']: component for component in components}
+            for k in range(segment[0]):
+                component = by_id[segment[1 + 2 * k]]
+                component['dc'] = segment[2 + 2 * k] >> 4
+                component['ac'] = segment[2 + 2 * k] & 15
+            return decode_scan(data, pos + 2 + length, width, height, components, quant, dc_tables, ac_tables, restart_interval)
+        elif marker == 0xD9:
+            break
+        pos += 2 + length
+    raise ValueError("В JPEG нет данных изображения")
+
+
+def decode_scan(data, pos, width, height, components, quant, dc_tables, ac_tables, restart_interval):
+    if not width or not height or len(components) not in (1, 3):
+        raise ValueError("Неподдерживаемый JPEG")
+
+    h_max = max(component['h'] for component in components)
+    v_max = max(component['v'] for component in components)
+    mcu_cols = (width + 8 * h_max - 1) // (8 * h_max)
+    mcu_rows = (height + 8 * v_max - 1) // (8 * v_max)
+    if len(components) == 1:
+        # В скане из одного канала блоки идут без группировки в MCU
+        component = components[0]
+        component['h'] = component['v'] = h_max = v_max = 1
+        mcu_cols = (width + 7) // 8
+        mcu_rows = (height + 7) // 8
+
+    planes = []
+    for component in components:
+        plane_width = mcu_cols * component['h'] * 8
+        planes.append((plane_width, bytearray(plane_width * mcu_rows * component['v'] * 8)))
+
+    reader = BitReader(data, pos)
+    predictors = [0] * len(components)
+    for mcu in range(mcu_cols * mcu_rows):
+        if restart_interval and mcu and mcu % restart_interval == 0:
+            reader.restart()
+            predictors = [0] * len(components)
+        mcu_y, mcu_x = divmod(mcu, mcu_cols)
+        for index, component in enumerate(components):
+            table = quant[component['quant']]
+            dc_table = dc_tables[component['dc']]
+            ac_table = ac_tables[component['ac']]
+            plane_width, plane = planes[index]
+            for block_y in range(component['v']):
+                for block_x in range(component['h']):
+                    coeffs = [0] * 64
+                    length = reader.decode(dc_table)
+                    predictors[index] += extend(reader.receive(length), length)
+                    coeffs[0] = predictors[index] * table[0]
+                    k = 1
+                    while k < 64:
+                        symbol = reader.decode(ac_table)
+                        run, length = symbol >> 4, symbol & 15
+                        if not length:
+                            if run != 15:
+                                break
+                            k += 16
+                            continue
+                        k += run
+                        if k > 63:
+                            break
+                        coeffs[ZIGZAG[k]] = extend(reader.receive(length), length) * table[k]
+                        k += 1
+
+                    samples = idct_block(coeffs)
+                    x0 = (mcu_x * component['h'] + block_x) * 8
+                    y0 = (mcu_y * component['v'] + block_y) * 8
+                    for row in range(8):
+                        start = (y0 + row) * plane_width + x0
+                        plane[start:start + 8] = bytes(samples[row * 8:row * 8 + 8])
+
+    pixels = bytearray(width * height * 3)
+    if len(components) == 1:
+        plane_width, plane = planes[0]
+        for y in range(height):
+            row = plane[y * plane_width:y * plane_width + width]
+            for channel in range(3):
+                pixels[y * width * 3 + channel:(y + 1) * width * 3:3] = row
+        return JpegImage(width, height, pixels)
+
+    (y_width, y_plane), (cb_width, cb_plane), (cr_width, cr_plane) = planes
+    cb_h, cb_v = components[1]['h'], components[1]['v']
+    cr_h, cr_v = components[2]['h'], components[2]['v']
+    y_h, y_v = components[0]['h'], components[0]['v']
+    i = 0
+    for y in range(height):
+        y_row = (y * y_v // v_max) * y_width
+        cb_row = (y * cb_v // v_max) * cb_width
+        cr_row = (y * cr_v // v_max) * cr_width
+        for x in range(width):
+            luma = y_plane[y_row + x * y_h // h_max]
+            cb = cb_plane[cb_row + x * cb_h // h_max] - 128
+            cr = cr_plane[cr_row + x * cr_h // h_max] - 128
+            r = int(luma + 1.402 * cr)
+            g = int(luma - 0.344136 * cb - 0.714136 * cr)
+            b = int(luma + 1.772 * cb)
+            pixels[i] = 255 if r > 255 else (0 if r < 0 else r)
+            pixels[i + 1] = 255 if g > 255 else (0 if g < 0 else g)
+            pixels[i + 2] = 255 if b > 255 else (0 if b < 0 else b)
+            i += 3
+    return JpegImage(width, height, pixels)
+
+
+def palette_level(value):
+    """Ближайший уровень палитры для канала цвета"""
+    return min(PALETTE_LEVELS, key=lambda level: abs(level - value))
+
+
+def preview_size(image, columns):
+    """Размер превью в ячейках: ширина не больше columns, пропорции как у картинки
+
+    Ячейка терминала примерно вдвое выше своей ширины, а в ней две точки по вертикали,
+    поэтому точки превью получаются почти квадратными.
+    """
+    columns = max(1, min(columns, image.width))
+    rows = max(1, round(columns * image.height / image.width / 2))
+    return columns, rows
+
+
+def preview_cells(image, columns):
+    """Уменьшает картинку до превью из полублоков
+
+    Returns:
+        Список строк; строка - список ячеек ((r, g, b) верхней точки, (r, g, b) нижней)
+    """
+    columns, rows = preview_size(image, columns)
+    width, height, pixels = image.width, image.height, image.pixels
+
+    def box(x0, x1, y0, y1):
+        # Среднее по прямоугольнику исходных пикселей
+        r = g = b = 0
+        for y in range(y0, y1):
+            start = (y * width + x0) * 3
+            row = pixels[start:(y * width + x1) * 3]
+            r += sum(row[0::3])
+            g += sum(row[1::3])
+            b += sum(row[2::3])
+        count = (x1 - x0) * (y1 - y0)
+        return palette_level(r // count), palette_level(g // count), palette_level(b // count)
+
+    dots = rows * 2
+    x_edges = [column * width // columns for column in range(columns + 1)]
+    y_edges = [dot * height // dots for dot in range(dots + 1)]
+    result = []
+    for row in range(rows):
+        cells = []
+        top = (y_edges[row * 2], max(y_edges[row * 2 + 1], y_edges[row * 2] + 1))
+        bottom = (y_edges[row * 2 + 1], max(y_edges[row * 2 + 2], y_edges[row * 2 + 1] + 1))
+        for column in range(columns):
+            x0, x1 = x_edges[column], max(x_edges[column + 1], x_edges[column] + 1)
+            cells.append((box(x0, x1, min(top[0], height - 1), min(top[1], height)),
+                          box(x0, x1, min(bottom[0], height - 1), min(bottom[1], height))))
+        result.append(cells)
+    return result
+
+
+def preview_lines(image, columns):
+    """Строки превью для рамки сообщения: текст из полублоков и отрезки цвета (начало, конец, (верх, низ))"""
+    lines = []
+    for cells in preview_cells(image, columns):
+        ranges = []
+        for column, colors in enumerate(cells):
+            if ranges and ranges[-1][2] == colors:
+                ranges[-1] = (ranges[-1][0], column + 1, colors)
+            else:
+                ranges.append((column, column + 1, colors))
+        lines.append((HALF_BLOCK * len(cells), ranges))
+    return lines
+
+
+def terminal_color(rgb, colors):
+    """Номер цвета терминала для цвета превью: из палитры 256 цветов или ближайший из восьми основных"""
+    if colors >= 256:
+        r, g, b = (PALETTE_LEVELS.index(value) for value in rgb)
+        return 16 + 36 * r + 6 * g + b
+    # В curses биты номеров основных цветов: 1 - красный, 2 - зеленый, 4 - синий
+    r, g, b = rgb
+    return (r > 127) | (g > 127) << 1 | (b > 127) << 2
+
+
+def inline_thumb_bytes(thumb):
+    """JPEG миниатюры, пришедшей вместе с сообщением, или None"""
+    if thumb.stripped:
+        return utils.stripped_photo_to_jpg(thumb.stripped)
+    return thumb.cached
+
+
+class ThumbCache:
+    """Миниатюры медиа: файлы на диске и раскодированные картинки в памяти"""
+    def __init__(self, directory=THUMBS_DIR):
+        self.directory = directory
+        self.images = OrderedDict()
+        self.enabled = True
+        self.columns = PREVIEW_COLUMNS
+        self.fetched_bytes = 0
+        # Раскодирование по одной картинке: несколько потоков с декодером на Python
+        # делили бы GIL между собой и с циклом событий, и интерфейс подтормаживал бы
+        self.decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbs')
+        self.prune()
+
+    def prune(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        if len(paths) <= THUMBS_DISK_LIMIT:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - THUMBS_DISK_LIMIT]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def read(self, key):
+        """JPEG из кэша на диске или None"""
+        if not self.directory:
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write(self, key, data):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+
+    def image(self, thumb):
+        """Уже раскодированная миниатюра или None"""
+        key = (thumb.kind, thumb.id)
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+        return image
+
+    def put_image(self, thumb, image):
+        key = (thumb.kind, thumb.id)
+        self.images[key] = image
+        self.images.move_to_end(key)
+        while len(self.images) > THUMBS_MEMORY_LIMIT:
+            self.images.popitem(last=False)
+
+    def status(self):
+        """Состояние кэша для метрик"""
+        return {'in_memory': len(self.images), 'fetched_bytes': self.fetched_bytes}
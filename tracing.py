@@ -0,0 +1,195 @@
+import json
+import time
+import functools
+import contextlib
+import contextvars
+from collections import deque, Counter
+from datetime import datetime
+
+from metrics import metrics
+
+# Сколько последних вызовов хранить в кольцевом буфере
+TRACE_BUFFER_SIZE = 1000
+# Границы корзин гистограммы времени ответа, мс (последняя корзина - все, что дольше)
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# За сколько последних минут хранить поминутные счетчики вызовов
+MINUTES_KEPT = 15
+
+# Причина текущих запросов: нажатая клавиша, пачка обновлений, фоновая задача
+current_cause = contextvars.ContextVar('trace_cause', default=None)
+
+
+class CallRecord:
+    """Один запрос к серверу"""
+    __slots__ = ('method', 'args', 'cause', 'started', 'latency', 'bytes', 'error')
+
+    def __init__(self, method, args, cause):
+        self.method = method
+        self.args = args
+        self.cause = cause
+        self.started = time.time()
+        self.latency = None
+        self.bytes = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'method': self.method,
+            'args': self.args,
+            'cause': self.cause,
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='milliseconds'),
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+            'bytes': self.bytes,
+            'error': self.error
+        }
+
+
+class Tracer:
+    """Журнал запросов к серверу: кольцевой буфер, гистограммы и поминутные счетчики"""
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.calls = deque(maxlen=size)
+        self.histograms = {}
+        self.errors = Counter()
+        self.minutes = deque()
+        self.cause_counts = Counter()
+        self.cause_calls = Counter()
+
+    @contextlib.contextmanager
+    def cause(self, name):
+        """Помечает все запросы внутри блока (и запущенных в нем задач) причиной name"""
+        self.cause_counts[name] += 1
+        token = current_cause.set(name)
+        try:
+            yield
+        finally:
+            current_cause.reset(token)
+
+    @contextlib.asynccontextmanager
+    async def call(self, method, args=None):
+        """Записывает запрос: время ответа, ошибку и размер данных (record.bytes задает вызывающий)"""
+        record = CallRecord(method, args, current_cause.get())
+        start = time.perf_counter()
+        try:
+            async with metrics.rpc(method):
+                yield record
+        except BaseException as e:
+            record.error = type(e).__name__
+            raise
+        finally:
+            record.latency = time.perf_counter() - start
+            self.finish(record)
+
+    def finish(self, record):
+        self.calls.append(record)
+
+        histogram = self.histograms.get(record.method)
+        if histogram is None:
+            histogram = self.histograms[record.method] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        latency_ms = record.latency * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-1] += 1
+
+        if record.error:
+            self.errors[(record.method, record.error)] += 1
+        if record.cause:
+            self.cause_calls[record.cause] += 1
+
+        minute = int(record.started // 60)
+        if not self.minutes or self.minutes[-1][0] != minute:
+            self.minutes.append((minute, Counter()))
+            while len(self.minutes) > MINUTES_KEPT:
+                self.minutes.popleft()
+        self.minutes[-1][1][record.method] += 1
+
+    def calls_last_minute(self):
+        """Число запросов за последние 60 секунд"""
+        since = time.time() - 60
+        count = 0
+        for record in reversed(self.calls):
+            if record.started < since:
+                break
+            count += 1
+        return count
+
+    def snapshot(self):
+        """Журнал и сводки в виде словаря для JSON"""
+        bucket_names = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            'calls_last_minute': self.calls_last_minute(),
+            'per_minute': [
+                {
+                    'minute': datetime.fromtimestamp(minute * 60).isoformat(timespec='minutes'),
+                    'calls': sum(counts.values()),
+                    'methods': dict(counts)
+                }
+                for minute, counts in self.minutes
+            ],
+            'histograms': {
+                method: dict(zip(bucket_names, counts)) for method, counts in self.histograms.items()
+            },
+            'errors': [
+                {'method': method, 'error': error, 'count': count}
+                for (method, error), count in self.errors.items()
+            ],
+            # Сколько запросов в среднем стоит одна клавиша, пачка обновлений и т.д.
+            'per_cause': {
+                cause: {
+                    'occurrences': count,
+                    'calls': self.cause_calls[cause],
+                    'calls_per_occurrence': round(self.cause_calls[cause] / count, 2)
+                }
+                for cause, count in self.cause_counts.items()
+            },
+            'recent': [record.to_dict() for record in self.calls]
+        }
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        return path
+
+
+tracer = Tracer()
+metrics.section('trace', tracer.snapshot)
+metrics.gauge('rpc_per_minute', tracer.calls_last_minute, 'RPC за минуту')
+
+
+def peer_summary(entity):
+    """Короткое описание чата для журнала: его id"""
+    entity = getattr(entity, 'entity', entity)
+    for attr in ('id', 'user_id', 'channel_id', 'chat_id'):
+        value = getattr(entity, attr, None)
+        if value is not None:
+            return value
+    return None
+
+
+def text_bytes(messages):
+    """Объем текста сообщений в байтах"""
+    if not isinstance(messages, list):
+        messages = [messages]
+    return sum(len((getattr(msg, 'text', None) or '').encode()) for msg in messages if msg is not None)
+
+
+def traced(describe=None, size=None):
+    """Декоратор для методов модели, которые обращаются к серверу
+
+    Args:
+        describe: Функция с той же сигнатурой, возвращающая краткое описание аргументов
+        size: Функция, оценивающая объем полученных данных по результату, в байтах
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            summary = describe(*args, **kwargs) if describe else None
+            async with tracer.call(func.__name__, summary) as record:
+                result = await func(*args, **kwargs)
+                if size and result is not None:
+                    record.bytes = size(result)
+                return result
+        return wrapper
+    return decorator
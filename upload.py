@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import hashlib
+
+from telethon import helpers
+from telethon.errors import FloodWaitError
+from telethon.tl import types, functions
+
+# Размер части: 512 КБ - максимум, который принимает сервер
+PART_SIZE = 512 * 1024
+# Файлы больше 10 МБ загружаются как "большие" (SaveBigFilePart)
+BIG_FILE_SIZE = 10 * 1024 * 1024
+# Больше 4000 частей (2 ГБ) сервер не принимает
+MAX_PARTS = 4000
+# Сколько частей держать в полете одновременно
+UPLOAD_WORKERS = 4
+# Как часто, в секундах, сообщать о прогрессе
+PROGRESS_INTERVAL = 0.2
+# FloodWait не дольше этого, в секундах, пережидается, и часть отправляется снова;
+# после более долгого загрузка прерывается
+MAX_PART_FLOOD_WAIT = 60
+
+
+class ThrottledProgress:
+    """Передает прогресс в callback не чаще раза в PROGRESS_INTERVAL секунд"""
+    def __init__(self, callback, total, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.current = 0
+        self.reported = 0.0
+
+    def advance(self, amount):
+        self.current += amount
+        now = time.monotonic()
+        if self.callback and now - self.reported >= self.interval:
+            self.reported = now
+            self.callback(self.current, self.total)
+
+    def finish(self):
+        if self.callback:
+            self.callback(self.current, self.total)
+
+
+def read_part(f, index):
+    f.seek(index * PART_SIZE)
+    return f.read(PART_SIZE)
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(PART_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+async def send_part(client, request):
+    """Отправляет часть файла; короткий FloodWait пережидает сам
+
+    Клиент модели не ждет FloodWait внутри запроса, а начинать большой файл
+    заново из-за одной части дорого.
+    """
+    while True:
+        try:
+            return await client(request)
+        except FloodWaitError as e:
+            if e.seconds > MAX_PART_FLOOD_WAIT:
+                raise
+            await asyncio.sleep(e.seconds)
+
+
+async def upload_file(client, path, workers=UPLOAD_WORKERS, progress_callback=None):
+    """Загружает файл на сервер частями, держа в полете до workers частей одновременно
+
+    Чтение с диска идет в пуле потоков, поэтому даже большой файл не останавливает
+    интерфейс, а в памяти одновременно не больше workers частей.
+
+    Args:
+        client: TelegramClient
+        path: Путь к файлу
+        workers: Сколько частей загружать параллельно
+        progress_callback: Функция (загружено байт, всего байт), вызывается не чаще PROGRESS_INTERVAL
+
+    Returns:
+        InputFile или InputFileBig для client.send_file
+    """
+    size = os.path.getsize(path)
+    name = os.path.basename(path)
+    if not size:
+        raise ValueError(f"Файл {name} пуст")
+    part_count = (size + PART_SIZE - 1) // PART_SIZE
+    if part_count > MAX_PARTS:
+        raise ValueError(f"Файл {name} больше 2 ГБ")
+
+    is_big = size > BIG_FILE_SIZE
+    file_id = helpers.generate_random_long()
+    loop = asyncio.get_running_loop()
+    progress = ThrottledProgress(progress_callback, size)
+    # Общий итератор: каждую часть забирает ровно один загрузчик
+    parts = iter(range(part_count))
+
+    async def worker():
+        with open(path, 'rb') as f:
+            for index in parts:
+                data = await loop.run_in_executor(None, read_part, f, index)
+                if is_big:
+                    request = functions.upload.SaveBigFilePartRequest(file_id, index, part_count, data)
+                else:
+                    request = functions.upload.SaveFilePartRequest(file_id, index, data)
+                if not await send_part(client, request):
+                    raise ValueError(f"Сервер не принял часть {index} файла {name}")
+                progress.advance(len(data))
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(min(workers, part_count))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    progress.finish()
+
+    if is_big:
+        return types.InputFileBig(file_id, part_count, name)
+    return types.InputFile(file_id, part_count, name, await loop.run_in_executor(None, file_md5, path))
@@ -1,28 +1,44 @@
 import curses
-import textwrap
+import functools
 from curses import textpad
-from wcwidth import wcswidth
+import textwidth
+from textwidth import text_width
+import thumbs
+from messages import format_size
 import os
 import asyncio
 import time
 
+# Подписи к еще не отправленным сообщениям (MessageRecord.status)
+OUTGOING_STATUS_LABELS = {
+    'pending': "отправляется...",
+    'retrying': "не отправлено, повтор...",
+    'failed': "не отправлено: Enter - повторить, d - удалить"
+}
+
+# Пары цветов для превью медиа выделяются начиная с этого номера
+PREVIEW_PAIR_BASE = 16
+
+def color_distance(first, second):
+    """Насколько различаются две пары цветов превью (символ, фон) в RGB"""
+    return sum((a - b) ** 2 for rgb_a, rgb_b in zip(first, second) for a, b in zip(rgb_a, rgb_b))
+
+
 class TelegramView:
     def __init__(self, stdscr):
         self.stdscr = stdscr
         self.setup_colors()
         self.setup_screen()
-
-        self.height, self.width = self.stdscr.getmaxyx()
-        self.chat_win_width = int(self.width * 0.3)
-        self.msg_win_width = self.width - self.chat_win_width - 2
-        self.chat_win_height = self.height
-        self.msg_win_height = self.height - 2
-
-        self.chat_win = curses.newwin(self.chat_win_height, self.chat_win_width, 0, 0)
-        self.msg_win = curses.newwin(self.msg_win_height, self.msg_win_width, 2, self.chat_win_width + 1)
+        self.setup_windows()
 
         self.progress_win = None
         self.is_showing_progress = False
+        # Пары цветов превью: (цвет символа, цвет фона) -> номер пары curses
+        self.preview_pairs = {}
+        # Номер пары -> последний кадр, где она использовалась. Переопределять можно только
+        # пары, которых нет в текущем кадре: curses перекрасит все ячейки с переопределенной парой
+        self.pair_frames = {}
+        self.frame = 0
 
     def setup_colors(self):
         curses.start_color()
@@ -40,32 +56,66 @@ class TelegramView:
         self.stdscr.nodelay(True)
         self.stdscr.erase()
 
+    def setup_windows(self):
+        """Вычисляет размеры окон по текущему размеру терминала и создает окна"""
+        self.height, self.width = self.stdscr.getmaxyx()
+        self.chat_win_width = max(1, int(self.width * 0.3))
+        self.msg_win_width = max(1, self.width - self.chat_win_width - 2)
+        self.chat_win_height = max(1, self.height)
+        self.msg_win_height = max(1, self.height - 2)
+
+        self.chat_win = curses.newwin(self.chat_win_height, self.chat_win_width, 0, 0)
+        self.msg_win = curses.newwin(self.msg_win_height, self.msg_win_width, 2, self.chat_win_width + 1)
+
+    def resize(self):
+        """Пересоздает окна после изменения размера терминала"""
+        curses.update_lines_cols()
+        self.hide_progress_bar()
+        self.stdscr.clear()
+        self.setup_windows()
+
     def draw_chat_window(self, chat_list, selected, offset):
         self.chat_win.erase()
         for i in range(self.chat_win_height):
             index = i + offset
             if index >= len(chat_list):
                 break
-            title = chat_list[index].title if chat_list[index].title else "No Title"
-            
-            # Вычисляем общую длину строки
-            line = self.pad_to_width(self.slice_by_width(title, self.chat_win_width), self.chat_win_width)
-            
-            # Добавляем метку непрочитанных сообщений
-            if hasattr(chat_list[index], 'unread_count') and chat_list[index].unread_count and chat_list[index].unread_count > 0:
-                line = line[:-1] + '+'
-                
+            chat = chat_list[index]
+            title = chat.title if chat.title else "No Title"
+
+            # Счетчики непрочитанных и упоминаний выравниваем по правому краю
+            mentions, unread, badge_width = self.unread_badge(
+                getattr(chat, 'unread_count', 0) or 0,
+                getattr(chat, 'unread_mentions_count', 0) or 0
+            )
+            line = textwidth.fit_to_width(title, max(0, self.chat_win_width - badge_width))
+            attr = curses.A_REVERSE if index == selected else curses.A_NORMAL
+
             try:
-                if index == selected:
-                    self.chat_win.addstr(i, 0, line, curses.A_REVERSE)
-                else:
-                    self.chat_win.addstr(i, 0, line)
+                self.chat_win.addstr(i, 0, line, attr)
+                column = self.chat_win_width - badge_width
+                if mentions:
+                    self.chat_win.addstr(i, column, mentions, attr | curses.A_BOLD | curses.color_pair(2))
+                    column += len(mentions)
+                if unread:
+                    self.chat_win.addstr(i, column, unread, attr | curses.A_BOLD)
             except curses.error:
                 pass
         self.chat_win.noutrefresh()
 
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def unread_badge(unread, mentions):
+        """Текст счетчиков для строки чата: (упоминания, непрочитанные, общая ширина)"""
+        mentions_text = f" @{mentions}" if mentions > 0 else ""
+        unread_text = ""
+        if unread > 0:
+            unread_text = f" {unread if unread < 1000 else '999+'}"
+        return mentions_text, unread_text, len(mentions_text) + len(unread_text)
+
     def draw_message_lines(self, lines_with_style, line_offset, message_map=None):
         self.msg_win.erase()
+        self.frame += 1
         lines, _ = lines_with_style if isinstance(lines_with_style, tuple) else (lines_with_style, {})
 
         max_lines = min(self.msg_win_height, len(lines) - line_offset)
@@ -99,37 +149,79 @@ class TelegramView:
             else:
                 text, border_style, color_ranges = line, 1, []
 
-            display_line = self.pad_to_width(self.slice_by_width(text, self.msg_win_width), self.msg_win_width)
+            display_line = textwidth.fit_to_width(text, self.msg_win_width)
             current_pos = 0
+            column = 0
 
             if color_ranges:
                 for start, end, color in color_ranges:
                     if current_pos < start:
                         segment = display_line[current_pos:start]
-                        self._add_str_with_border(i, current_pos, segment, border_style)
+                        column = self._add_str_with_border(i, column, segment, border_style)
                         current_pos += len(segment)
                     segment = display_line[start:end]
                     try:
-                        self.msg_win.addstr(i, current_pos, segment, curses.color_pair(color))
+                        self.msg_win.addstr(i, column, segment, self.color_attr(color))
                     except curses.error:
                         pass
                     current_pos += len(segment)
+                    column += text_width(segment)
                 segment = display_line[current_pos:]
-                self._add_str_with_border(i, current_pos, segment, border_style)
+                self._add_str_with_border(i, column, segment, border_style)
             else:
                 self._add_str_with_border(i, 0, display_line, border_style)
 
         self.msg_win.noutrefresh()
 
+    def color_attr(self, color):
+        """Атрибут curses для отрезка строки: номер пары или, для превью, цвета RGB (символ, фон)"""
+        if isinstance(color, int):
+            return curses.color_pair(color)
+
+        pair = self.preview_pairs.get(color)
+        if pair is None:
+            pair = self.allocate_pair(color)
+            if pair is None:
+                return curses.A_NORMAL
+        self.pair_frames[pair] = self.frame
+        return curses.color_pair(pair)
+
+    def allocate_pair(self, color):
+        """Номер пары для цветов превью; None, если пару задать нельзя"""
+        available = getattr(curses, 'COLOR_PAIRS', 0) - PREVIEW_PAIR_BASE
+        if available <= 0:
+            return None
+        if len(self.preview_pairs) < available:
+            pair = PREVIEW_PAIR_BASE + len(self.preview_pairs)
+        else:
+            # Пары кончились: занимаем пару, которой нет в этом кадре
+            stale = next((other for other, other_pair in self.preview_pairs.items()
+                          if self.pair_frames.get(other_pair) != self.frame), None)
+            if stale is None:
+                # Все пары уже на экране - берем ближайшие цвета, не перекрашивая нарисованное
+                return self.preview_pairs[min(self.preview_pairs, key=lambda other: color_distance(other, color))]
+            pair = self.preview_pairs.pop(stale)
+        colors = getattr(curses, 'COLORS', 0)
+        try:
+            curses.init_pair(pair, thumbs.terminal_color(color[0], colors), thumbs.terminal_color(color[1], colors))
+        except (curses.error, ValueError):
+            return None
+        self.preview_pairs[color] = pair
+        return pair
+
     def _add_str_with_border(self, y, x, text, border_style):
-        for j, ch in enumerate(text):
+        """Выводит строку отрезками: символы рамки цветом рамки, остальное как есть.
+        Возвращает колонку, следующую за выведенным текстом"""
+        for segment, is_border in textwidth.split_border(text):
             try:
-                if ch in ['╭', '╮', '╰', '╯', '─', '│']:
-                    self.msg_win.addstr(y, x + j, ch, curses.color_pair(border_style))
+                if is_border:
+                    self.msg_win.addstr(y, x, segment, curses.color_pair(border_style))
                 else:
-                    self.msg_win.addstr(y, x + j, ch)
+                    self.msg_win.addstr(y, x, segment)
             except curses.error:
                 pass
+            x += text_width(segment)
+        return x
 
     def draw_msg_border(self):
         try:
@@ -139,6 +231,20 @@ class TelegramView:
         except curses.error:
             pass
 
+    def draw_metrics_overlay(self, lines):
+        """Рисует панель метрик в правом верхнем углу окна сообщений"""
+        if not lines:
+            return
+        width = min(self.msg_win_width, max(text_width(line) for line in lines) + 2)
+        height = min(self.msg_win_height, len(lines))
+        x = self.msg_win_width - width
+        for y, line in enumerate(lines[:height]):
+            try:
+                self.msg_win.addstr(y, x, self.pad_to_width(" " + self.slice_by_width(line, width - 2), width - 1), curses.color_pair(5))
+            except curses.error:
+                pass
+        self.msg_win.noutrefresh()
+
     def set_dialog_title(self, title):
         """Отображает заголовок чата"""
         try:
@@ -363,22 +469,11 @@ class TelegramView:
 
     @staticmethod
     def slice_by_width(text, max_width):
-        current_width = 0
-        result = ""
-        for ch in text:
-            ch_width = wcswidth(ch)
-            if current_width + ch_width > max_width:
-                break
-            result += ch
-            current_width += ch_width
-        return result
+        return textwidth.slice_to_width(text, max_width)
 
     @staticmethod
     def pad_to_width(text, width):
-        current_width = wcswidth(text)
-        if current_width < width:
-            return text + " " * (width - current_width)
-        return text
+        return textwidth.pad_to_width(text, width)
 
     def get_key(self):
         return self.stdscr.getch()
@@ -539,7 +634,7 @@ class TelegramView:
 
         async def get_message_text(msg):
             text = msg.text if msg.text else ""
-            if msg.file:
+            if msg.media:
                 path = await model.download_media(
                     msg.media,
                     chat_title,
@@ -560,17 +655,7 @@ class TelegramView:
                                len(text) - len(file_path) - 1, 
                                status_color)]
 
-            sender = ""
-            try:
-                if msg.sender:
-                    if msg.sender.first_name:
-                        sender = msg.sender.first_name
-                    elif msg.sender.title:
-                        sender = msg.sender.title
-                    elif msg.sender.username:
-                        sender = msg.sender.username
-            except:
-                pass
+            sender = msg.sender_name or ""
             time_str = msg.date.strftime('%H:%M')
             full_text = f"[{time_str}]"
             if sender:
@@ -805,6 +890,115 @@ class TelegramView:
             draw_input_field()
             curses.doupdate()
 
+    async def media_gallery_window(self, gallery):
+        """Окно с файлами и ссылками открытого чата, по вкладкам типов (gallery.MediaGallery)
+
+        Returns:
+            id сообщения, к которому перейти в чате (клавиша g), или None
+        """
+        height = max(5, curses.LINES - 4)
+        width = max(20, curses.COLS - 4)
+        rows = height - 2
+        win = curses.newwin(height, width, 2, 2)
+        win.keypad(1)
+        win.nodelay(True)
+        # Файлы могли загрузиться, пока окно было закрыто
+        gallery.reset_local_files()
+
+        def draw():
+            tab = gallery.tab
+            win.erase()
+            win.box()
+
+            x = 2
+            for i, other in enumerate(gallery.tabs):
+                label = f" {other.title} "
+                if x + text_width(label) >= width - 1:
+                    break
+                win.addstr(0, x, label, curses.A_REVERSE if i == gallery.current else curses.A_NORMAL)
+                x += text_width(label) + 1
+
+            start = max(0, min(tab.selected - rows // 2, len(tab.items) - rows))
+            for row, item in enumerate(tab.items[start:start + rows]):
+                selected = start + row == tab.selected
+                date = item.date.astimezone().strftime('%d.%m.%y') if item.date else ""
+                left = f" {date}  "
+                state = ""
+                if item.kind == 'link':
+                    right = f"  {self.slice_by_width(item.url or '', (width - 2) // 2)} "
+                else:
+                    state = gallery.state(item)
+                    right = f"  {format_size(item.size)}  {self.pad_to_width(state, 9)} "
+                name_width = max(1, width - 2 - text_width(left) - text_width(right))
+                name = self.pad_to_width(self.slice_by_width(item.name.replace('\n', ' '), name_width), name_width)
+                attr = curses.A_REVERSE if selected else curses.A_NORMAL
+                if state == "загружен":
+                    right_attr = attr | curses.color_pair(3)
+                elif state.startswith("ошибка"):
+                    right_attr = attr | curses.color_pair(4)
+                else:
+                    right_attr = attr
+                try:
+                    win.addstr(row + 1, 1, left + name, attr)
+                    win.addstr(row + 1, 1 + text_width(left + name), self.slice_by_width(right, width - 2 - text_width(left + name)), right_attr)
+                except curses.error:
+                    # Последняя клетка окна
+                    pass
+
+            if tab.error:
+                status = f" ошибка: {tab.error} "
+            elif tab.loading:
+                status = " загрузка... "
+            elif not tab.items and tab.exhausted:
+                status = " ничего нет "
+            else:
+                status = f" {len(tab.items)}{'' if tab.exhausted else '+'} "
+            hint = " Enter - открыть/загрузить, g - к сообщению, Tab - тип, Esc - закрыть "
+            status_width = text_width(status)
+            try:
+                win.addstr(height - 1, 2, self.slice_by_width(hint, max(0, width - status_width - 5)))
+                win.addstr(height - 1, max(2, width - status_width - 2), status)
+            except curses.error:
+                pass
+            win.noutrefresh()
+
+        try:
+            while True:
+                gallery.prefetch()
+                draw()
+                curses.doupdate()
+
+                key = win.getch()
+                if key == -1:
+                    # Пока ждем клавишу, идут загрузки страниц и файлов
+                    await asyncio.sleep(0.05)
+                    continue
+
+                tab = gallery.tab
+                if key in (27, ord('q')):
+                    return None
+                elif key in (ord('j'), curses.KEY_DOWN):
+                    tab.selected = min(tab.selected + 1, max(0, len(tab.items) - 1))
+                elif key in (ord('k'), curses.KEY_UP):
+                    tab.selected = max(tab.selected - 1, 0)
+                elif key == curses.KEY_NPAGE:
+                    tab.selected = min(tab.selected + rows, max(0, len(tab.items) - 1))
+                elif key == curses.KEY_PPAGE:
+                    tab.selected = max(tab.selected - rows, 0)
+                elif key in (9, ord('l'), curses.KEY_RIGHT):
+                    gallery.switch(1)
+                elif key in (curses.KEY_BTAB, ord('h'), curses.KEY_LEFT):
+                    gallery.switch(-1)
+                elif key in (10, 13, curses.KEY_ENTER):
+                    if tab.items:
+                        gallery.activate(tab.items[tab.selected])
+                elif key == ord('g'):
+                    if tab.items:
+                        return tab.items[tab.selected].id
+        finally:
+            # Под окном остались части основного экрана, которые нужно перерисовать целиком
+            self.stdscr.touchwin()
+
     def show_download_progress(self, current, total):
         progress_height = 3
         progress_width = min(self.msg_win_width - 4, 50)
@@ -844,10 +1038,117 @@ class TelegramView:
             curses.doupdate()
 
     @staticmethod
-    async def prepare_message_blocks(messages, max_width, model=None, chat_title=None, selected_msg_id=None, downloaded_msg_id=None):
-        """Форматирует сообщения для отображения с рамками и цветовой разметкой"""
+    async def prepare_message_content(msg, model=None, chat_title=None):
+        """Собирает данные сообщения, не зависящие от ширины окна: заголовок, абзацы, строку о файле"""
+        # Определение отправителя
+        sender_name = msg.sender_name or "Unknown"
+
+        # Форматирование времени и заголовка
+        time_str = msg.date.strftime('%H:%M')
+        sender_with_time = f"{sender_name} [{time_str}]"
+        # Сообщение из очереди исходящих, еще не подтвержденное сервером
+        if msg.status:
+            sender_with_time += f" ({OUTGOING_STATUS_LABELS[msg.status]})"
+        text = msg.text if msg.text else ""
+
+        # Превью по миниатюре, если она уже загружена
+        preview = None
+        if msg.media and msg.media.thumb and model and model.thumbs.enabled:
+            image = model.thumbs.image(msg.media.thumb)
+            if image is not None:
+                preview = (image, model.thumbs.columns)
+
+        # Обработка файлов
+        file_info = None
+        status_color = None
+        if msg.media and model and chat_title:
+            # Создаем заглушку для файла
+            path = await model.download_media(msg.media, chat_title, msg.id, force_download=False)
+
+            # Проверяем размер файла - если > 1KB, считаем загруженным
+            if os.path.exists(path) and os.path.getsize(path) > 1000:
+                file_info = "Открыть файл (Enter) | Копировать (y)"
+                status_color = 3  # Зеленый
+            else:
+                file_info = "Нажмите Enter для загрузки файла"
+                status_color = 4  # Красный
+
+            # Используем относительный путь
+            file_path = f"file://{os.path.abspath(path)}"
+            text += f"\n{file_info}\n{file_path}\n"
+
+        return {
+            'id': msg.id,
+            'out': msg.out,
+            'header': sender_with_time,
+            'paragraphs': text.split('\n'),
+            'file_info': file_info,
+            'status_color': status_color,
+            'preview': preview
+        }
+
+    @staticmethod
+    def layout_message(content, max_width, selected=False):
+        """Раскладывает сообщение в строки с рамкой под заданную ширину"""
+        # Перенос текста сообщения по ширине в колонках
+        wrapped = []
+        for paragraph in content['paragraphs']:
+            if not paragraph.strip():
+                wrapped.append(('', 0))  # Сохраняем пустые строки
+            else:
+                wrapped.extend(textwidth.wrap(paragraph, max_width - 4))
+
+        # Превью из полублоков над текстом, не шире рамки
+        preview_rows = []
+        if content.get('preview'):
+            image, columns = content['preview']
+            preview_rows = thumbs.preview_lines(image, min(columns, max_width - 4))
+
+        # Гарантируем хотя бы одну строку для пустых сообщений
+        if not wrapped and not preview_rows:
+            wrapped.append(('', 0))
+
+        # Определение стиля рамки
+        border_style = 2 if selected else 1
+        border_width = max([line_width for _, line_width in wrapped] + [len(text) for text, _ in preview_rows])
+        sender_with_time = content['header']
+
+        # Исходящие сообщения прижимаются к правому краю
+        if content['out']:
+            indent = " " * max(0, max_width - border_width - 2)
+            header = " " * max(0, max_width - text_width(sender_with_time)) + sender_with_time
+        else:
+            indent = ""
+            header = sender_with_time
+
+        block = [header, (f"{indent}╭{'─' * border_width}╮", border_style, [])]
+        content_start = len(indent) + 1
+        for text, ranges in preview_rows:
+            row = f"{indent}│{text}{' ' * (border_width - len(text))}│"
+            block.append((row, border_style, [(content_start + start, content_start + end, colors) for start, end, colors in ranges]))
+        for line, line_width in wrapped:
+            row = f"{indent}│{line}{' ' * (border_width - line_width)}│"
+            if content['file_info'] and line == content['file_info']:
+                # Строку со статусом файла подсвечиваем цветом статуса
+                content_start = len(indent) + 1
+                block.append((row, border_style, [(content_start, content_start + len(line), content['status_color'])]))
+            else:
+                block.append((row, border_style, []))
+        block.append((f"{indent}╰{'─' * border_width}╯", border_style, []))
+        return block
+
+    @staticmethod
+    async def prepare_message_blocks(messages, max_width, model=None, chat_title=None, selected_msg_id=None, downloaded_msg_id=None, cache=None, reflow_ids=None, last_date=None):
+        """Форматирует сообщения для отображения с рамками и цветовой разметкой
+
+        Args:
+            last_date: дата последнего уже показанного сообщения при дописывании в конец,
+                чтобы не повторять разделитель даты
+            cache: MessageLayoutCache для повторного использования уже разложенных сообщений
+            reflow_ids: если задан, под новую ширину раскладываются только эти сообщения,
+                остальные берутся из кэша как есть
+        """
         blocks = []
-        last_date = None
 
         for msg in messages:
             try:
@@ -863,127 +1164,14 @@ class TelegramView:
                     blocks.append((f"-- {date_str} --", 1, "date_separator"))
                     last_date = message_date
 
-                # Определение отправителя
-                sender_name = "Unknown"
-                try:
-                    if msg.sender:
-                        if hasattr(msg.sender, 'first_name') and msg.sender.first_name:
-                            sender_name = msg.sender.first_name
-                        elif hasattr(msg.sender, 'title') and msg.sender.title:
-                            sender_name = msg.sender.title
-                        elif hasattr(msg.sender, 'username') and msg.sender.username:
-                            sender_name = msg.sender.username
-                except Exception:
-                    pass
-
-                # Форматирование времени и заголовка
-                time_str = msg.date.strftime('%H:%M')
-                sender_with_time = f"{sender_name} [{time_str}]"
-                text = msg.text if msg.text else ""
-                
-                # Обработка файлов
-                color_ranges = []  # Для хранения цветовых диапазонов текста
-                if hasattr(msg, 'file') and msg.file and model and chat_title:
-                    # Создаем заглушку для файла
-                    path = await model.download_media(msg.media, chat_title, msg.id, force_download=False)
-                    
-                    # Проверяем, действительно ли файл был загружен по размеру
-                    file_exists = os.path.exists(path) and os.path.getsize(path) > 1
-                    
-                    # Определяем статус и цвет
-                    if file_exists:
-                        # Проверяем размер файла - если > 1KB, считаем загруженным
-                        if os.path.getsize(path) > 1000:
-                            file_info = "Открыть файл (Enter) | Копировать (y)"
-                            status_color = 3  # Зеленый
-                        else:
-                            file_info = "Нажмите Enter для загрузки файла"
-                            status_color = 4  # Красный
-                    else:
-                        file_info = "Нажмите Enter для загрузки файла"
-                        status_color = 4  # Красный
-                    
-                    # Используем относительный путь 
-                    file_path = f"file://{os.path.abspath(path)}"
-                    text_addition = f"\n{file_info}\n{file_path}\n"
-                    
-                    # Сохраняем информацию о цветном тексте
-                    current_len = len(text)
-                    status_start = current_len + 1  # +1 для символа новой строки
-                    status_end = status_start + len(file_info)
-                    color_ranges.append((status_start, status_end, status_color))
-                    
-                    text += text_addition
-
-                # Перенос текста сообщения
-                wrapped = []
-                for paragraph in text.split('\n'):
-                    if not paragraph.strip():
-                        wrapped.append('')  # Сохраняем пустые строки
-                    else:
-                        wrapped.extend(textwrap.wrap(
-                            paragraph,
-                            width=max_width - 4,
-                            replace_whitespace=False,
-                            drop_whitespace=False
-                        ))
-
-                # Гарантируем хотя бы одну строку для пустых сообщений
-                if not wrapped:
-                    wrapped.append('')
-
-                # Определение стиля рамки
-                border_style = 2 if msg.id == selected_msg_id else 1
-                border_width = max((wcswidth(line) for line in wrapped), default=0)
-
-                # Форматирование исходящих сообщений (справа)
-                if getattr(msg, 'out', False):
-                    block = [
-                        sender_with_time.rjust(max_width),  # Выравнивание по правому краю
-                        f"╭{'─' * border_width}╮".rjust(max_width)  # Выравнивание рамки по правому краю
-                    ]
-                    for line in wrapped:
-                        block.append(f"│{line.ljust(border_width)}│".rjust(max_width))  # Выравнивание содержимого по правому краю
-                    block.append(f"╰{'─' * border_width}╯".rjust(max_width))  # Выравнивание нижней рамки по правому краю
+                selected = msg.id == selected_msg_id
+                if cache is None:
+                    content = await TelegramView.prepare_message_content(msg, model, chat_title)
+                    block = TelegramView.layout_message(content, max_width, selected)
                 else:
-                    # Форматирование входящих сообщений (слева)
-                    block = [
-                        sender_with_time,
-                        f"╭{'─' * border_width}╮"
-                    ]
-                    for line in wrapped:
-                        block.append(f"│{line.ljust(border_width)}│")
-                    block.append(f"╰{'─' * border_width}╯")
-
-                # Добавление цветовых диапазонов
-                formatted_block = []
-                for idx, line in enumerate(block):
-                    if idx == 0:
-                        formatted_block.append(line)  # Строка с отправителем без стиля
-                    else:
-                        # Для рамки используем только border_style без дополнительных цветов
-                        if idx == 2 or idx == 3:  # Строки с содержимым сообщения (предполагая файл на 3й строке)
-                            # Проверяем, соответствует ли эта строка строке с file_info
-                            if "Открыть файл" in line or "Нажмите Enter для загрузки" in line:
-                                # Для строки с file_info создаем цветовой диапазон
-                                content_start = line.find('│') + 1
-                                content_end = line.rfind('│')
-                                content = line[content_start:content_end].strip()
-                                
-                                # Только текст внутри строки
-                                formatted_block.append((
-                                    line,
-                                    border_style,
-                                    [(content_start, content_start + len(content), status_color)]
-                                ))
-                            else:
-                                # Для остальных строк без цветовых диапазонов
-                                formatted_block.append((line, border_style, []))
-                        else:
-                            # Для рамок без цветовых диапазонов
-                            formatted_block.append((line, border_style, []))
+                    block = await cache.get_block(msg, max_width, selected, model, chat_title, reflow_ids)
 
-                blocks.append((formatted_block, msg.id))
+                blocks.append((block, msg.id))
                 blocks.append('\n')  # Разделитель между сообщениями
             except Exception as e:
                 # При любой ошибке с сообщением просто пропускаем его
@@ -1019,3 +1207,40 @@ class TelegramView:
                 line_idx += 1
 
         return lines, message_map
+
+
+class MessageLayoutCache:
+    """Кэш раскладки сообщений открытого чата
+
+    Хранит данные сообщений, не зависящие от ширины, и готовые блоки под последнюю ширину,
+    чтобы при смене выделения или размера окна раскладывать заново только нужные сообщения.
+    """
+    def __init__(self):
+        self.contents = {}
+        self.blocks = {}
+
+    async def get_block(self, msg, max_width, selected, model=None, chat_title=None, reflow_ids=None):
+        cached = self.blocks.get(msg.id)
+        if cached and cached[1] == selected:
+            width, _, block = cached
+            if width == max_width or (reflow_ids is not None and msg.id not in reflow_ids):
+                return block
+
+        content = self.contents.get(msg.id)
+        if content is None:
+            content = await TelegramView.prepare_message_content(msg, model, chat_title)
+            self.contents[msg.id] = content
+
+        block = TelegramView.layout_message(content, max_width, selected)
+        self.blocks[msg.id] = (max_width, selected, block)
+        return block
+
+    def is_stale(self, msg_id, max_width):
+        """Разложено ли сообщение под другую ширину"""
+        cached = self.blocks.get(msg_id)
+        return cached is not None and cached[0] != max_width
+
+    def invalidate(self, msg_id):
+        """Сбрасывает кэш сообщения, например после загрузки файла"""
+        self.contents.pop(msg_id, None)
+        self.blocks.pop(msg_id, None)
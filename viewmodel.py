@@ -1,6 +1,49 @@
 import asyncio
+import contextlib
+import curses
 import os
+import time
+from collections import OrderedDict
 from telethon import events
+from messages import MessageRecord, MessageStore
+from metrics import metrics
+from tracing import tracer
+from scheduler import priority, INTERACTIVE, BACKGROUND, RequestDropped
+from connection import RECONNECTING, ONLINE
+from outbox import Outbox
+from streaming import player_command, is_streamable
+from export import ChatExport
+from bulk import BulkDownload, DOWNLOAD_KINDS, DOWNLOAD_WORKERS
+from gallery import MediaGallery
+from snapshot import load_snapshot, save_snapshot
+from view import MessageLayoutCache
+
+# Сколько диалогов подгружать за одну фоновую страницу
+DIALOG_PAGE_SIZE = 100
+
+# Сколько сообщений загружать за одну страницу истории
+MESSAGE_PAGE_SIZE = 20
+
+# Сколько сообщений раскладывать за один шаг фоновой переразметки
+REFLOW_CHUNK = 50
+
+# Сколько ждать накопления пачки обновлений перед обработкой (один кадр)
+UPDATE_BATCH_DELAY = 0.05
+
+# Команда в окне ввода для отправки файла: ":attach <путь> [| подпись]"
+ATTACH_COMMAND = ':attach '
+# Сколько секунд показывать в заголовке ошибку фоновой отправки файла
+UPLOAD_ERROR_SHOWN = 5
+
+# Сколько миниатюр видимых сообщений загружать одновременно
+THUMB_CONCURRENCY = 4
+
+# Предзагрузка последних сообщений: сколько запросов одновременно,
+# сколько курсор должен простоять на чате и сколько чатов держать в памяти
+PREFETCH_CONCURRENCY = 2
+PREFETCH_REST_DELAY = 0.3
+HISTORY_CACHE_DIALOGS = 50
+HISTORY_CACHE_MESSAGES = 50
 
 class TelegramViewModel:
     def __init__(self, model, view):
@@ -10,7 +53,7 @@ class TelegramViewModel:
         self.focus = "chat"
         self.selected_chat = 0
         self.chat_offset = 0
-        self.messages = []
+        self.messages = MessageStore()
         self.message_blocks = []
         self.flat_lines = []
         self.line_offset = 0
@@ -18,13 +61,246 @@ class TelegramViewModel:
         self.selected_msg_id = None
         self.downloaded_msg_id = None
         self.message_line_map = {}
+        self.layout_cache = MessageLayoutCache()
+        self.reflow_ids = None
+        self.reflow_task = None
+        self.open_chat_id = None
+        self.is_live = False
+        self.connection_error = None
+        self.snapshot_chat_id = None
+        self.snapshot_tail = []
+        self.sync_task = None
+        self.connection_task = None
+        # Файлы, которые загружаются в фоне: имя, прогресс, скорость, ошибка
+        self.uploads = []
+        # Видео и аудио, которые сейчас загружаются с показом в плеере (MediaStream)
+        self.streams = []
+        # Фоновые задачи по всему чату: экспорт (e, ChatExport) и загрузка всех файлов (D, BulkDownload)
+        self.jobs = []
+        # Галерея файлов открытого чата (f); загруженные страницы живут, пока открыт тот же чат
+        self.gallery = None
+        # Исходящие сообщения до подтверждения сервером, в том числе с прошлых запусков
+        self.outbox = Outbox(self.model.outbox_file)
+        self.outbox_task = None
+        # Миниатюры, которые загружаются сейчас, и те, что загрузить не удалось (id медиа)
+        self.thumbs_loading = set()
+        self.thumbs_failed = set()
+        self.update_queue = asyncio.Queue()
+        # id входящих непрочитанных сообщений и упоминаний, пришедших за эту сессию, по чатам
+        self.unread_ids = {}
+        self.mention_ids = {}
+        self.update_task = None
+        self.dialog_iter = None
+        self.dialogs_exhausted = False
+        self.dialog_page_task = None
+        self.show_archive = False
+        self.default_folder = self.parse_folder(self.model.config['Settings'].get('DialogFolder', ''))
+
+        # Теплый кэш последних сообщений чатов и фоновая предзагрузка
+        self.history_cache = OrderedDict()
+        self.prefetching = set()
+        self.prefetch_dialogs = self.int_setting('PrefetchDialogs', 5)
+        self.prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        self.interactive_requests = 0
+        self.interactive_idle = asyncio.Event()
+        self.interactive_idle.set()
+        self.cursor_chat = None
+        self.cursor_rest_since = 0
+        self.open_sync_task = None
+
+        # Окно истории в памяти, в страницах; дальние страницы выгружаются
+        self.history_pages = max(2, self.int_setting('HistoryPages', 10))
+        self.has_newer = False
+
+        # Оверлей метрик производительности
+        self.show_metrics = False
+        metrics.gauge('queued_updates', self.update_queue.qsize, 'очередь')
+        metrics.gauge('messages', lambda: len(self.messages), 'сообщений')
+        metrics.gauge('cached_chats', lambda: len(self.history_cache), 'чатов в кэше')
+
+    def int_setting(self, name, default):
+        """Читает целочисленную настройку из конфига"""
+        try:
+            return int(self.model.config['Settings'].get(name, str(default)))
+        except ValueError:
+            return default
+
+    @staticmethod
+    def parse_folder(value):
+        """Преобразует значение DialogFolder из конфига в номер папки"""
+        value = value.strip()
+        return int(value) if value.isdigit() else None
+
+    @property
+    def dialog_folder(self):
+        return 1 if self.show_archive else self.default_folder
 
     async def initialize(self):
-        await self.model.connect()
-        self.chat_list = await self.model.get_dialogs()
+        with tracer.cause('startup'):
+            # Если есть снимок прошлой сессии, сразу показываем его и подключаемся в фоне
+            if self.load_snapshot():
+                self.sync_task = asyncio.create_task(self.connect_and_sync())
+            else:
+                await self.connect_and_sync()
+
+    async def connect_and_sync(self):
+        """Подключается к серверу и сверяет снимок с актуальными данными"""
+        # Обработчики регистрируем до подключения: сразу после него сервер пришлет
+        # пропущенное с прошлого запуска, и оно должно пройти обычным путем событий
         self.model.add_event_handler(self.new_message_handler, events.NewMessage)
+        self.model.add_event_handler(self.edited_message_handler, events.MessageEdited)
+        self.model.add_event_handler(self.deleted_message_handler, events.MessageDeleted)
+        self.model.add_event_handler(self.read_inbox_handler, events.MessageRead(inbox=True))
+
+        async def attempt():
+            await self.model.connect()
+            # Первая страница покрывает экран и чат, выбранный в снимке
+            await self.start_dialog_stream(max(self.view.chat_win_height, self.selected_chat + 1))
+
+        try:
+            await attempt()
+        except Exception as e:
+            if not self.chat_list:
+                raise
+            # Снимок уже на экране: пробуем снова с той же паузой, что и при обрыве соединения
+            def failed(error):
+                self.connection_error = str(error)
+
+            failed(e)
+            if not await self.model.connection.retry(attempt, failed):
+                return
+            self.connection_error = None
+
+        self.update_task = asyncio.create_task(self.process_updates())
+        # При обрыве переподключаемся и догружаем только пропущенные события
+        self.connection_task = asyncio.create_task(self.model.connection.watch())
+        self.is_live = True
+
+        # Очередь исходящих отправляется в фоне; после переподключения - сразу, не дожидаясь паузы
+        self.model.connection.listeners.append(lambda state: state == ONLINE and self.outbox.wake.set())
+        self.outbox_task = asyncio.create_task(self.outbox.run(self.deliver_outgoing, self.outgoing_sent, self.outgoing_changed))
+
+        # Прогреваем кэш последних сообщений верхних чатов
+        with tracer.cause('prefetch'):
+            for dialog in self.chat_list[:self.prefetch_dialogs]:
+                asyncio.create_task(self.prefetch_dialog(dialog))
+
+        # Заменяем сообщения из снимка живыми данными
+        if self.focus == "msg":
+            selected = self.chat_list[self.selected_chat] if self.selected_chat < len(self.chat_list) else None
+            if selected is not None and self.model.get_dialog_id(selected) == self.open_chat_id:
+                await self.open_chat()
+            else:
+                self.focus = "chat"
+                self.reset_cursor()
+
+    def load_snapshot(self):
+        """Загружает снимок интерфейса прошлой сессии"""
+        if self.model.config['Settings'].get('SaveSnapshotOnExit', '1') != '1':
+            return False
+        snapshot = load_snapshot()
+        if not snapshot:
+            return False
+
+        dialogs, self.snapshot_chat_id, self.snapshot_tail = snapshot
+        if not dialogs:
+            return False
+
+        self.chat_list = dialogs
+        # Ставим курсор на последний открытый чат
+        for idx, dialog in enumerate(dialogs):
+            if self.model.get_dialog_id(dialog) == self.snapshot_chat_id:
+                self.selected_chat = idx
+                break
+        return True
+
+    def save_snapshot(self):
+        """Сохраняет снимок списка диалогов и хвоста открытого чата"""
+        if self.model.config['Settings'].get('SaveSnapshotOnExit', '1') != '1' or not self.chat_list:
+            return
+        try:
+            save_snapshot(self.chat_list, self.model.get_dialog_id, self.open_chat_id, self.messages)
+        except Exception:
+            pass
+
+    async def start_dialog_stream(self, first_page=None):
+        """Начинает потоковую загрузку диалогов: сначала один экран, остальное по мере прокрутки"""
+        if self.dialog_page_task and not self.dialog_page_task.done():
+            self.dialog_page_task.cancel()
+
+        self.dialog_iter = self.model.iter_dialogs(folder=self.dialog_folder)
+        dialogs, self.dialogs_exhausted = await self.model.next_dialogs(
+            self.dialog_iter,
+            first_page or self.view.chat_win_height
+        )
+        self.reconcile_dialogs(dialogs)
+
+    def maybe_load_more_dialogs(self):
+        """Запускает фоновую подгрузку диалогов, когда курсор приближается к концу списка"""
+        if not self.dialog_iter or self.dialogs_exhausted:
+            return
+        if self.dialog_page_task and not self.dialog_page_task.done():
+            return
+        if self.selected_chat >= len(self.chat_list) - self.view.chat_win_height:
+            with tracer.cause('dialog_page'):
+                self.dialog_page_task = asyncio.create_task(self.load_more_dialogs())
+
+    async def load_more_dialogs(self):
+        """Подгружает следующую страницу диалогов в конец списка"""
+        dialog_iter = self.dialog_iter
+        try:
+            with priority(BACKGROUND):
+                dialogs, exhausted = await self.model.next_dialogs(dialog_iter, DIALOG_PAGE_SIZE)
+        except Exception:
+            return
+
+        # Пока грузили, список могли переключить на другую папку
+        if dialog_iter is not self.dialog_iter:
+            return
+
+        self.dialogs_exhausted = exhausted
+        known_ids = {self.model.get_dialog_id(dialog) for dialog in self.chat_list}
+        self.chat_list.extend(
+            dialog for dialog in dialogs
+            if self.model.get_dialog_id(dialog) not in known_ids
+        )
+
+    async def refresh_dialog_head(self):
+        """Обновляет верх списка диалогов, не трогая уже подгруженные страницы"""
+        head = await self.model.get_dialogs(limit=self.view.chat_win_height, folder=self.dialog_folder)
+        head_ids = {self.model.get_dialog_id(dialog) for dialog in head}
+        rest = [dialog for dialog in self.chat_list if self.model.get_dialog_id(dialog) not in head_ids]
+        self.reconcile_dialogs(list(head) + rest)
+
+    async def toggle_archive(self):
+        """Переключает список между архивом и основными чатами"""
+        self.show_archive = not self.show_archive
+        self.chat_list = []
+        self.selected_chat = 0
+        self.chat_offset = 0
+        await self.start_dialog_stream()
+
+    def reconcile_dialogs(self, dialogs):
+        """Заменяет список диалогов, сохраняя выделение на том же чате"""
+        current_dialog = self.chat_list[self.selected_chat] if self.selected_chat < len(self.chat_list) else None
+        current_dialog_id = self.model.get_dialog_id(current_dialog) if current_dialog else None
+
+        self.chat_list = dialogs
+
+        if current_dialog_id is not None:
+            for idx, dialog in enumerate(dialogs):
+                if self.model.get_dialog_id(dialog) == current_dialog_id:
+                    self.selected_chat = idx
+                    return
+
+        if self.selected_chat >= len(dialogs):
+            self.selected_chat = max(0, len(dialogs) - 1)
 
     async def run(self, check_exit=None):
+        frame_start = time.perf_counter()
+        self.maybe_load_more_dialogs()
+        self.maybe_prefetch_selected()
+
         if self.selected_chat < self.chat_offset:
             self.chat_offset = self.selected_chat
         elif self.selected_chat >= self.chat_offset + self.view.chat_win_height:
@@ -34,19 +310,29 @@ class TelegramViewModel:
 
         if self.focus == "msg" and self.flat_lines:
             self.ensure_cursor_visible()
+            self.request_visible_thumbs()
             sender_name = self.chat_list[self.selected_chat].title or "No Name"
             
             # Обновляем заголовок с именем чата
-            self.view.set_dialog_title(sender_name)
+            self.view.set_dialog_title(self.title_with_status(sender_name))
             self.view.draw_message_lines(self.flat_lines, self.line_offset, self.message_line_map)
             self.view.draw_msg_border()
         else:
             self.view.msg_win.erase()
             self.view.msg_win.noutrefresh()
             self.view.draw_msg_border()
-            self.view.set_dialog_title("No messages")
+            if self.is_live:
+                self.view.set_dialog_title(self.title_with_status("Архив" if self.show_archive else "No messages"))
+            elif self.connection_error:
+                self.view.set_dialog_title(f"Нет соединения: {self.connection_error}")
+            else:
+                self.view.set_dialog_title("Подключение...")
+
+        if self.show_metrics:
+            self.view.draw_metrics_overlay(metrics.overlay_lines())
 
         self.view.refresh()
+        metrics.frame_painted(time.perf_counter() - frame_start)
 
         if check_exit and check_exit():
             return True
@@ -56,15 +342,49 @@ class TelegramViewModel:
             await asyncio.sleep(0.05)
             return False
 
-        if self.focus == "chat":
-            return await self.handle_chat_focus_keys(key)
-        elif self.focus == "msg":
-            return await self.handle_message_focus_keys(key)
+        if key == curses.KEY_RESIZE:
+            # При перетаскивании края окна события идут пачкой - обрабатываем только последнее
+            key = self.view.get_key()
+            while key == curses.KEY_RESIZE:
+                key = self.view.get_key()
+            if key != -1:
+                curses.ungetch(key)
+            await self.handle_resize()
+            return False
+
+        # Запросы к серверу, вызванные клавишей, учитываются в журнале под ее именем
+        # и идут в очереди раньше фоновых
+        with tracer.cause(f"key:{self.focus}:{chr(key) if 32 <= key < 127 else key}"), priority(INTERACTIVE):
+            try:
+                if self.focus == "chat":
+                    return await self.handle_chat_focus_keys(key)
+                elif self.focus == "msg":
+                    return await self.handle_message_focus_keys(key)
+            except ConnectionError:
+                # Соединение восстанавливается в фоне, заголовок показывает переподключение
+                return False
 
         return False
 
+    def title_with_status(self, title):
+        """Дописывает к заголовку переподключение, паузу после FloodWait или ход фоновой отправки файлов"""
+        if self.model.connection.state == RECONNECTING:
+            return f"{title} (переподключение...)"
+        blocked = self.model.scheduler.blocked_for()
+        if blocked:
+            return f"{title} (FloodWait: {int(blocked) + 1} с)"
+        upload = self.upload_status()
+        if upload:
+            return f"{title} ({upload})"
+        stream = self.stream_status()
+        if stream:
+            return f"{title} ({stream})"
+        job = self.job_status()
+        if job:
+            return f"{title} ({job})"
+        return title
+
     async def handle_chat_focus_keys(self, key):
-        import curses
         if key in (ord('j'), curses.KEY_DOWN):
             if self.selected_chat < len(self.chat_list) - 1:
                 self.selected_chat += 1
@@ -75,13 +395,17 @@ class TelegramViewModel:
             await self.open_chat()
         elif key == ord('/'):
             return await self.search_chats()
+        elif key == ord('a'):
+            if self.is_live:
+                await self.toggle_archive()
+        elif key in (ord('P'), ord('M')):
+            self.handle_metrics_key(key)
         elif key in (ord('q'), 27):
             await self.cleanup()
             return True
         return False
 
     async def handle_message_focus_keys(self, key):
-        import curses
         import inspect
         
         if key == 27:  # Escape
@@ -89,6 +413,10 @@ class TelegramViewModel:
             return False
         elif key == ord('i'):
             # Ввод сообщения
+            # До подключения к серверу писать некуда
+            if not self.is_live:
+                return False
+
             # Двойная проверка - сначала через наш метод
             can_send = self.can_send_messages()
             
@@ -110,7 +438,7 @@ class TelegramViewModel:
             return False
         elif key == ord('r'):
             # Ответ на сообщение
-            if not self.selected_msg_id:
+            if not self.selected_msg_id or not self.is_live:
                 return False
                 
             # Та же двойная проверка
@@ -149,6 +477,18 @@ class TelegramViewModel:
             await self.search_messages()
         elif key in (10, curses.KEY_ENTER):
             await self.handle_enter_on_message()
+        elif key == ord('d'):
+            await self.discard_outgoing()
+        elif key == ord('p'):
+            await self.toggle_previews()
+        elif key == ord('e'):
+            self.start_export()
+        elif key == ord('D'):
+            self.start_bulk_download()
+        elif key == ord('f'):
+            await self.open_gallery()
+        elif key in (ord('P'), ord('M')):
+            self.handle_metrics_key(key)
         elif key in (ord('h'), 27):
             self.focus = "chat"
             self.reset_cursor()
@@ -157,21 +497,232 @@ class TelegramViewModel:
             self.reset_cursor()
         return False
 
+    def request_visible_thumbs(self):
+        """Запускает загрузку миниатюр для медиа в видимой части чата"""
+        if not self.model.thumbs.enabled or not self.is_live:
+            return
+        lines, _ = self.flat_lines
+        last_line = min(len(lines), self.line_offset + self.view.msg_win_height)
+        previous_id = None
+        for i in range(self.line_offset, last_line):
+            if len(self.thumbs_loading) >= THUMB_CONCURRENCY:
+                return
+            msg_id = self.message_line_map.get(i)
+            if msg_id is None or msg_id == previous_id:
+                continue
+            previous_id = msg_id
+            msg = self.messages.get(msg_id)
+            thumb = msg.media.thumb if msg and msg.media else None
+            if thumb is None or thumb.id in self.thumbs_loading or thumb.id in self.thumbs_failed:
+                continue
+            if self.model.thumbs.image(thumb) is None:
+                self.thumbs_loading.add(thumb.id)
+                asyncio.create_task(self.load_thumb(self.chat_list[self.selected_chat], msg))
+
+    async def load_thumb(self, dialog, msg):
+        """Загружает миниатюру в фоне и перерисовывает сообщение с превью"""
+        thumb = msg.media.thumb
+        try:
+            with tracer.cause('thumbs'), priority(BACKGROUND):
+                await self.model.load_thumb(dialog.entity, msg.id, thumb)
+        except (RequestDropped, ConnectionError):
+            # Очередь занята или нет связи - попробуем снова, когда сообщение будет на экране
+            return
+        except Exception:
+            self.thumbs_failed.add(thumb.id)
+            return
+        finally:
+            self.thumbs_loading.discard(thumb.id)
+
+        if self.focus != "msg" or self.open_chat_id != msg.chat_id or msg.id not in self.messages:
+            return
+        anchor = self.capture_anchor()
+        self.layout_cache.invalidate(msg.id)
+        await self.refresh_message_blocks()
+        self.restore_anchor(anchor)
+
+    async def toggle_previews(self):
+        """p - показать или скрыть превью медиа в чате"""
+        self.model.thumbs.enabled = not self.model.thumbs.enabled
+        anchor = self.capture_anchor()
+        self.layout_cache = MessageLayoutCache()
+        await self.refresh_message_blocks()
+        self.restore_anchor(anchor)
+
+    def handle_metrics_key(self, key):
+        """P - показать или скрыть оверлей метрик, M - сохранить метрики в JSON"""
+        if key == ord('P'):
+            self.show_metrics = not self.show_metrics
+        else:
+            self.dump_metrics()
+
+    def dump_metrics(self):
+        """Сохраняет текущие метрики в JSON-файл в рабочей папке"""
+        try:
+            path = metrics.dump()
+            self.view.set_dialog_title(f"Метрики сохранены в {path}")
+        except OSError as e:
+            self.view.set_dialog_title(f"Не удалось сохранить метрики: {e}")
+
     async def open_chat(self):
-        await self.model.send_read_acknowledge(self.chat_list[self.selected_chat].entity)
-        self.chat_list = await self.model.get_dialogs()
-        latest_messages = await self.model.get_messages(self.chat_list[self.selected_chat], limit=20)
-        self.messages = latest_messages.copy() if latest_messages else []
+        if not self.chat_list:
+            return
+
+        # До подключения показываем только сохранённый хвост последнего чата
+        if not self.is_live:
+            await self.open_snapshot_chat()
+            return
+
+        # Хвост покидаемого чата оставляем в кэше, чтобы вернуться к нему мгновенно
+        self.remember_history()
+
+        dialog = self.chat_list[self.selected_chat]
+        dialog_id = self.model.get_dialog_id(dialog)
+        if self.open_sync_task and not self.open_sync_task.done():
+            self.open_sync_task.cancel()
+
+        cached = self.history_cache.get(dialog_id)
+        if cached:
+            # Показываем чат из памяти, а прочтение и сверку с сервером делаем в фоне
+            self.history_cache.move_to_end(dialog_id)
+            self.open_chat_id = dialog_id
+            self.mark_dialog_read(dialog)
+            await self.display_messages(list(cached))
+            self.open_sync_task = asyncio.create_task(self.sync_open_chat(dialog))
+            return
+
+        async with self.interactive():
+            await self.model.send_read_acknowledge(dialog.entity)
+            self.mark_dialog_read(dialog)
+            latest_messages = await self.model.get_messages(dialog, limit=MESSAGE_PAGE_SIZE)
+        self.open_chat_id = dialog_id
+        await self.display_messages(latest_messages.copy() if latest_messages else [])
+
+    async def sync_open_chat(self, dialog):
+        """Подтверждает прочтение и дописывает сообщения, которых не было в кэше"""
+        dialog_id = self.model.get_dialog_id(dialog)
+        try:
+            with priority(BACKGROUND):
+                await self.model.send_read_acknowledge(dialog.entity)
+                latest_messages = await self.model.get_messages(dialog, limit=MESSAGE_PAGE_SIZE)
+        except Exception:
+            return
+
+        if self.open_chat_id != dialog_id or self.focus != "msg":
+            return
+        last_msg = self.last_server_message()
+        last_id = last_msg.id if last_msg else 0
+        new_messages = [msg for msg in latest_messages if msg.id > last_id and msg.id not in self.messages]
+        if new_messages and not self.has_newer:
+            await self.append_messages(new_messages)
+            self.messages.add(new_messages)
+            self.cache_messages(dialog_id, new_messages)
+            await self.trim_history()
+
+    @contextlib.asynccontextmanager
+    async def interactive(self):
+        """Помечает интерактивный запрос: фоновая предзагрузка ждет его завершения"""
+        self.interactive_requests += 1
+        self.interactive_idle.clear()
+        try:
+            yield
+        finally:
+            self.interactive_requests -= 1
+            if not self.interactive_requests:
+                self.interactive_idle.set()
+
+    async def prefetch_dialog(self, dialog):
+        """Фоново загружает последнюю страницу сообщений чата в кэш"""
+        dialog_id = self.model.get_dialog_id(dialog)
+        if dialog_id is None or dialog_id in self.history_cache or dialog_id in self.prefetching:
+            return
+
+        self.prefetching.add(dialog_id)
+        try:
+            async with self.prefetch_semaphore:
+                # Уступаем интерактивным запросам
+                await self.interactive_idle.wait()
+                if dialog_id in self.history_cache:
+                    return
+                with priority(BACKGROUND):
+                    messages = await self.model.get_messages(dialog, limit=MESSAGE_PAGE_SIZE)
+                self.cache_messages(dialog_id, messages)
+        except Exception:
+            pass
+        finally:
+            self.prefetching.discard(dialog_id)
+
+    def maybe_prefetch_selected(self):
+        """Предзагружает чат, на котором курсор в списке задержался дольше PREFETCH_REST_DELAY"""
+        if not self.is_live or self.focus != "chat" or self.selected_chat >= len(self.chat_list):
+            return
+
+        dialog = self.chat_list[self.selected_chat]
+        now = asyncio.get_running_loop().time()
+        if dialog is not self.cursor_chat:
+            self.cursor_chat = dialog
+            self.cursor_rest_since = now
+            return
+        if now - self.cursor_rest_since >= PREFETCH_REST_DELAY:
+            with tracer.cause('prefetch'):
+                asyncio.create_task(self.prefetch_dialog(dialog))
+            # Повторно для этого чата не запускаем, пока курсор не сдвинется
+            self.cursor_rest_since = float('inf')
+
+    def cache_messages(self, dialog_id, messages):
+        """Дописывает сообщения в теплый кэш чата, ограничивая его размер"""
+        if not messages and dialog_id not in self.history_cache:
+            return
+        cached = self.history_cache.setdefault(dialog_id, [])
+        known_ids = {msg.id for msg in cached}
+        cached.extend(msg for msg in messages if msg.id not in known_ids)
+        cached.sort(key=lambda msg: msg.id)
+        del cached[:-HISTORY_CACHE_MESSAGES]
+        self.history_cache.move_to_end(dialog_id)
+        while len(self.history_cache) > HISTORY_CACHE_DIALOGS:
+            self.history_cache.popitem(last=False)
+
+    def remember_history(self):
+        """Сохраняет хвост открытого чата в теплый кэш"""
+        # Если конец чата выгружен, в памяти не хвост, а середина истории
+        if self.open_chat_id is None or not self.messages or not self.is_live or self.has_newer:
+            return
+        # Неотправленные берутся из очереди исходящих при каждом открытии чата
+        self.history_cache[self.open_chat_id] = [msg for msg in self.messages[-HISTORY_CACHE_MESSAGES:] if not msg.status]
+        self.history_cache.move_to_end(self.open_chat_id)
+
+    async def open_snapshot_chat(self):
+        """Открывает чат по данным снимка, пока нет соединения"""
+        dialog_id = self.model.get_dialog_id(self.chat_list[self.selected_chat])
+        if dialog_id != self.snapshot_chat_id or not self.snapshot_tail:
+            return
+
+        self.open_chat_id = dialog_id
+        await self.display_messages(list(self.snapshot_tail))
+
+    async def display_messages(self, messages):
+        """Показывает список сообщений с курсором на последнем"""
+        if self.chat_list:
+            # Неподтвержденные исходящие этого чата - в конце, как черновики
+            dialog_id = self.model.get_dialog_id(self.chat_list[self.selected_chat])
+            sender_name = self.own_name(messages)
+            messages = list(messages) + [self.outbox.record(entry, sender_name) for entry in self.outbox.for_chat(dialog_id)]
+        self.messages = MessageStore(messages)
+        self.has_newer = False
         self.reset_cursor()
         self.downloaded_msg_id = None
+        self.cancel_reflow()
+        self.layout_cache = MessageLayoutCache()
 
-        chat_title = self.chat_list[self.selected_chat].title or "No_Title"
-        self.message_blocks = await self.view.prepare_message_blocks(
-            self.messages,
-            self.view.msg_win_width,
-            self.model,
-            chat_title
-        )
+        chat_title = self.open_chat_title()
+        with metrics.timer('layout'):
+            self.message_blocks = await self.view.prepare_message_blocks(
+                self.messages,
+                self.view.msg_win_width,
+                self.model,
+                chat_title,
+                cache=self.layout_cache
+            )
         self.flat_lines = self.view.flatten_blocks(self.message_blocks)
         self.message_line_map = self.flat_lines[1]
 
@@ -189,43 +740,255 @@ class TelegramViewModel:
         await self.refresh_message_blocks()
 
     async def send_message(self, text, reply_to=None):
-        """Отправляет сообщение в текущий чат"""
+        """Ставит сообщение в очередь исходящих и сразу показывает его в текущем чате"""
+        if text.startswith(ATTACH_COMMAND):
+            self.attach_file(text[len(ATTACH_COMMAND):], reply_to=reply_to)
+            return
+
+        dialog = self.chat_list[self.selected_chat]
         try:
-            sent_msg = await self.model.send_message(
-                self.chat_list[self.selected_chat].entity, 
-                text,
-                reply_to=reply_to
-            )
-            
-            # Если сообщение не удалось отправить, выходим
-            if not sent_msg or not hasattr(sent_msg, 'id'):
-                self.view.set_dialog_title(f"{self.chat_list[self.selected_chat].title} (не удалось отправить)")
+            peer = self.model.get_input_peer(dialog.entity)
+        except Exception:
+            self.view.set_dialog_title(f"{dialog.title} (не удалось отправить)")
+            return
+
+        entry = self.outbox.add(self.model.get_dialog_id(dialog), peer, text, reply_to)
+        if self.has_newer:
+            # Последняя страница загрузится вместе с черновиком из очереди
+            await self.jump_to_latest_messages()
+            return
+        await self.show_sent_message(self.outbox.record(entry, self.own_name(self.messages)))
+
+    async def deliver_outgoing(self, entry):
+        """Отправляет сообщение из очереди; его ждет пользователь, поэтому вне очереди фоновых запросов"""
+        with priority(INTERACTIVE):
+            return await self.model.send_message(entry.peer, entry.text, entry.random_id, reply_to=entry.reply_to)
+
+    async def outgoing_sent(self, entry, msg_id, date):
+        """Заменяет черновик в чате подтвержденным сообщением"""
+        if self.open_chat_id != entry.chat_id or self.focus != "msg":
+            return
+
+        removed = self.messages.remove([entry.local_id])
+        self.layout_cache.invalidate(entry.local_id)
+        if msg_id is None:
+            # Сообщение дошло при прошлой попытке - настоящее подтянет сверка с сервером
+            dialog = self.find_dialog(entry.chat_id)
+            if dialog is not None:
+                asyncio.create_task(self.sync_open_chat(dialog))
+        elif removed and msg_id not in self.messages and not self.has_newer:
+            self.messages.add([MessageRecord(
+                msg_id, entry.chat_id, date,
+                sender_name=self.own_name(self.messages), text=entry.text, out=True, reply_to=entry.reply_to
+            )])
+        if not removed:
+            return
+
+        if self.selected_msg_id == entry.local_id:
+            self.selected_msg_id = msg_id if msg_id in self.messages else None
+        await self.refresh_message_blocks()
+        if self.selected_msg_id is not None:
+            self.selected_msg_idx = self.find_message_line(self.selected_msg_id)
+
+    async def outgoing_changed(self, entry):
+        """Обновляет черновик после неудачной попытки: повтор или окончательная ошибка"""
+        if self.open_chat_id != entry.chat_id or self.focus != "msg":
+            return
+
+        record = self.outbox.record(entry, self.own_name(self.messages))
+        if not self.messages.replace(record):
+            # Черновик заменило эхо с тем же текстом, но отправка не удалась - показываем его снова
+            if not entry.failed or self.has_newer:
                 return
-                
-            chat_title = self.chat_list[self.selected_chat].title or "No_Title"
-            new_block = await self.view.prepare_message_blocks(
-                [sent_msg],
-                self.view.msg_win_width,
-                self.model,
-                chat_title,
-                self.selected_msg_id,
-                self.downloaded_msg_id
-            )
-            new_flat_lines, new_map = self.view.flatten_blocks(new_block)
-            old_lines, old_map = self.flat_lines
-            offset = len(old_lines)
-            updated_map = old_map.copy()
-            for idx, msg_id in new_map.items():
-                updated_map[idx + offset] = msg_id
-            old_lines.extend(new_flat_lines)
-            self.flat_lines = (old_lines, updated_map)
-            self.message_line_map = updated_map
-            self.messages.append(sent_msg)
-            self.line_offset = max(0, len(old_lines) - self.view.msg_win_height + 1)  # +1 для предпоследнего сообщения
+            self.messages.add([record])
+        self.layout_cache.invalidate(entry.local_id)
+        await self.refresh_message_blocks()
+
+    async def retry_outgoing(self, local_id):
+        """Повторяет отправку неотправленного сообщения сейчас же"""
+        entry = self.outbox.get(local_id)
+        if entry is None:
+            return
+        self.outbox.retry(entry)
+        await self.outgoing_changed(entry)
+
+    async def discard_outgoing(self):
+        """Удаляет выбранное неотправленное сообщение из очереди и из чата"""
+        selected = self.messages.get(self.selected_msg_id)
+        if not selected or selected.status != 'failed':
+            return
+        entry = self.outbox.get(selected.id)
+        if entry is not None:
+            self.outbox.remove(entry)
+        self.messages.remove([selected.id])
+        self.layout_cache.invalidate(selected.id)
+        last_msg = self.messages[-1] if self.messages else None
+        self.selected_msg_id = last_msg.id if last_msg else None
+        await self.refresh_message_blocks()
+        self.selected_msg_idx = self.find_message_line(self.selected_msg_id) if last_msg else -1
+
+    def own_name(self, messages):
+        """Имя, которым подписаны наши сообщения в чате (для черновиков из очереди)"""
+        for i in range(len(messages) - 1, -1, -1):
+            msg = messages[i]
+            if msg.out and msg.sender_name:
+                return msg.sender_name
+        return "Я"
+
+    def last_server_message(self):
+        """Последнее сообщение с сервера, без черновиков из очереди исходящих"""
+        for i in range(len(self.messages) - 1, -1, -1):
+            if not self.messages[i].status:
+                return self.messages[i]
+        return None
+
+    async def show_sent_message(self, sent_msg):
+        """Дописывает отправленное нами сообщение в конец открытого чата"""
+        # Эхо этого сообщения может прийти событием раньше ответа сервера
+        if sent_msg.id in self.messages:
+            return
+
+        # Конец истории выгружен - показываем последнюю страницу вместе с отправленным
+        if self.has_newer:
+            await self.jump_to_latest_messages()
+            return
+
+        if self.messages and self.messages[-1].status and not sent_msg.status:
+            # Черновики из очереди остаются в конце, новое сообщение встает перед ними
+            self.messages.add([sent_msg])
             await self.refresh_message_blocks()
+        else:
+            await self.append_messages([sent_msg])
+            self.messages.add([sent_msg])
+        await self.trim_history()
+        lines, _ = self.flat_lines
+        self.line_offset = max(0, len(lines) - self.view.msg_win_height + 1)  # +1 для предпоследнего сообщения
+
+    def attach_file(self, argument, reply_to=None):
+        """Запускает фоновую загрузку и отправку файла в текущий чат
+
+        Args:
+            argument: Текст после :attach - путь к файлу и, через "|", подпись
+        """
+        path, _, caption = argument.partition('|')
+        path = os.path.expanduser(path.strip())
+        dialog = self.chat_list[self.selected_chat]
+        upload = {
+            'name': os.path.basename(path) or path,
+            'sent': 0,
+            'total': 0,
+            'started': time.monotonic(),
+            'error': None,
+            'failed_at': None
+        }
+        self.uploads.append(upload)
+        asyncio.create_task(self.upload_file(dialog, path, caption.strip(), reply_to, upload))
+
+    async def upload_file(self, dialog, path, caption, reply_to, upload):
+        """Загружает файл, не блокируя интерфейс, и показывает отправленное сообщение"""
+        def progress(sent, total):
+            upload['sent'] = sent
+            upload['total'] = total
+
+        try:
+            sent_msg = await self.model.send_file(dialog.entity, path, caption, reply_to=reply_to, progress_callback=progress)
         except Exception as e:
-            # В случае ошибки уведомляем пользователя
-            self.view.set_dialog_title(f"{self.chat_list[self.selected_chat].title} (ошибка отправки)")
+            upload['error'] = str(e) or type(e).__name__
+            upload['failed_at'] = time.monotonic()
+            return
+        self.uploads.remove(upload)
+
+        # Пока файл загружался, могли открыть другой чат
+        if self.focus == "msg" and self.open_chat_id == self.model.get_dialog_id(dialog):
+            await self.show_sent_message(sent_msg)
+
+    def upload_status(self):
+        """Строка о фоновых загрузках для заголовка: прогресс первой и число остальных"""
+        now = time.monotonic()
+        self.uploads = [
+            upload for upload in self.uploads
+            if upload['failed_at'] is None or now - upload['failed_at'] < UPLOAD_ERROR_SHOWN
+        ]
+        if not self.uploads:
+            return None
+
+        upload = self.uploads[0]
+        if upload['error']:
+            status = f"не удалось отправить {upload['name']}: {upload['error']}"
+        else:
+            percent = int(upload['sent'] * 100 / upload['total']) if upload['total'] else 0
+            speed = upload['sent'] / max(now - upload['started'], 1e-3) / (1024 * 1024)
+            status = f"отправка {upload['name']}: {percent}%, {speed:.1f} МБ/с"
+        if len(self.uploads) > 1:
+            status += f" и еще {len(self.uploads) - 1}"
+        return status
+
+    def stream_status(self):
+        """Строка о загрузке файла, который смотрят в плеере: прогресс первого и число остальных"""
+        now = time.monotonic()
+        self.streams = [
+            stream for stream in self.streams
+            if not stream.done and (stream.finished_at is None or now - stream.finished_at < UPLOAD_ERROR_SHOWN)
+        ]
+        if not self.streams:
+            return None
+        status = self.streams[0].status()
+        if len(self.streams) > 1:
+            status += f" и еще {len(self.streams) - 1}"
+        return status
+
+    def start_export(self):
+        """e - экспорт истории открытого чата в фоне; формат и загрузка файлов задаются в конфиге"""
+        dialog = self.chat_list[self.selected_chat]
+        settings = self.model.config['Settings']
+        try:
+            export = ChatExport(
+                self.model, dialog.entity, dialog.title or "No_Title",
+                fmt=settings.get('ExportFormat', 'jsonl'),
+                media=settings.get('ExportMedia', '0') == '1',
+                takeout=settings.get('ExportTakeout', '0') == '1'
+            )
+        except ValueError as e:
+            self.view.set_dialog_title(f"{dialog.title} ({e})")
+            return
+        if any(isinstance(job, ChatExport) and job.path == export.path and job.finished_at is None for job in self.jobs):
+            return
+        self.start_job(export)
+
+    def start_bulk_download(self):
+        """D - загрузка всех файлов открытого чата в фоне; типы файлов задаются в конфиге"""
+        dialog = self.chat_list[self.selected_chat]
+        settings = self.model.config['Settings']
+        kinds = [kind.strip() for kind in settings.get('DownloadKinds', ','.join(DOWNLOAD_KINDS)).split(',')]
+        try:
+            workers = max(1, int(settings.get('DownloadWorkers', str(DOWNLOAD_WORKERS))))
+        except ValueError:
+            workers = DOWNLOAD_WORKERS
+        download = BulkDownload(
+            self.model, dialog.entity, dialog.title or "No_Title",
+            kinds=[kind for kind in kinds if kind in DOWNLOAD_KINDS], workers=workers
+        )
+        if any(isinstance(job, BulkDownload) and job.directory == download.directory and job.finished_at is None for job in self.jobs):
+            return
+        self.start_job(download)
+
+    def start_job(self, job):
+        self.jobs.append(job)
+        asyncio.create_task(job.run())
+
+    def job_status(self):
+        """Строка о фоновых задачах по чату для заголовка: ход первой и число остальных"""
+        now = time.monotonic()
+        self.jobs = [
+            job for job in self.jobs
+            if job.finished_at is None or now - job.finished_at < UPLOAD_ERROR_SHOWN
+        ]
+        if not self.jobs:
+            return None
+        status = self.jobs[0].status()
+        if len(self.jobs) > 1:
+            status += f" и еще {len(self.jobs) - 1}"
+        return status
 
     async def reply_to_message(self, text):
         """Отправляет сообщение как ответ на выбранное сообщение"""
@@ -241,76 +1004,399 @@ class TelegramViewModel:
         # Отправляем сообщение с указанием reply_to
         await self.send_message(text, reply_to=self.selected_msg_id)
 
+    async def append_messages(self, messages):
+        """Раскладывает новые сообщения и дописывает их строки в конец плоского списка
+
+        Returns:
+            Номер первой добавленной строки
+        """
+        chat_title = self.open_chat_title()
+        last_date = self.messages[-1].date.date() if self.messages else None
+        with metrics.timer('layout'):
+            new_blocks = await self.view.prepare_message_blocks(
+                messages,
+                self.view.msg_win_width,
+                self.model,
+                chat_title,
+                self.selected_msg_id,
+                self.downloaded_msg_id,
+                cache=self.layout_cache,
+                last_date=last_date
+            )
+
+        new_lines, new_map = self.view.flatten_blocks(new_blocks)
+        lines, line_map = self.flat_lines if self.flat_lines else ([], {})
+        offset = len(lines)
+        for idx, msg_id in new_map.items():
+            line_map[idx + offset] = msg_id
+        lines.extend(new_lines)
+        self.flat_lines = (lines, line_map)
+        self.message_line_map = line_map
+        return offset
+
     async def new_message_handler(self, event):
-        """Обработчик новых сообщений"""
-        current_dialog = self.chat_list[self.selected_chat] if self.selected_chat < len(self.chat_list) else None
-        current_dialog_id = self.model.get_dialog_id(current_dialog) if current_dialog else None
-        
-        # Обновляем список диалогов
-        new_dialogs = await self.model.get_dialogs()
-        new_selected = None
+        """Обработчик новых сообщений: только ставит событие в очередь"""
+        metrics.event_received()
+        self.update_queue.put_nowait(('new', MessageRecord.from_message(event.message)))
+
+    async def edited_message_handler(self, event):
+        """Обработчик редактирования сообщений"""
+        metrics.event_received()
+        self.update_queue.put_nowait(('edit', MessageRecord.from_message(event.message)))
+
+    async def deleted_message_handler(self, event):
+        """Обработчик удаления сообщений"""
+        # Для личных чатов и групп сервер не сообщает чат, id сообщений там уникальны
+        chat_id = self.model.unmark_peer_id(event.chat_id) if event.chat_id is not None else None
+        metrics.event_received()
+        self.update_queue.put_nowait(('delete', (chat_id, event.deleted_ids)))
+
+    async def read_inbox_handler(self, event):
+        """Обработчик прочтения входящих, в том числе с других устройств"""
+        chat_id = self.model.unmark_peer_id(event.chat_id) if event.chat_id is not None else None
+        metrics.event_received()
+        if event.contents:
+            # Прочитано содержимое (например, упоминание) - без max_id
+            self.update_queue.put_nowait(('read_contents', (chat_id, event.message_ids)))
+        else:
+            self.update_queue.put_nowait(('read', (chat_id, event.max_id)))
+
+    async def process_updates(self):
+        """Единственный потребитель очереди обновлений
+
+        Забирает события пачками, чтобы всплеск из сотни сообщений стоил
+        одной раскладки, одного обновления списка чатов и одной отрисовки.
+        """
+        while True:
+            batch = [await self.update_queue.get()]
+            # Даем пачке накопиться в пределах одного кадра
+            await asyncio.sleep(UPDATE_BATCH_DELAY)
+            while not self.update_queue.empty():
+                batch.append(self.update_queue.get_nowait())
+            metrics.events_taken()
 
-        if current_dialog_id:
-            for idx, dialog in enumerate(new_dialogs):
-                if self.model.get_dialog_id(dialog) == current_dialog_id:
-                    new_selected = idx
-                    break
+            try:
+                with tracer.cause('updates'):
+                    await self.apply_updates(batch)
+            except Exception:
+                # Ошибка в одной пачке не должна останавливать обработку обновлений
+                pass
+
+    async def apply_updates(self, batch):
+        """Применяет пачку обновлений: сначала все новые сообщения, затем правки и удаления по порядку"""
+        new_messages = [payload for kind, payload in batch if kind == 'new']
+        if new_messages:
+            await self.apply_new_messages(new_messages)
+
+        for kind, payload in batch:
+            if kind == 'edit':
+                await self.apply_edited_message(payload)
+            elif kind == 'delete':
+                chat_id, deleted_ids = payload
+                await self.apply_deleted_messages(chat_id, deleted_ids)
+            elif kind == 'read':
+                chat_id, max_id = payload
+                self.apply_read_inbox(chat_id, max_id)
+            elif kind == 'read_contents':
+                chat_id, message_ids = payload
+                self.apply_read_contents(chat_id, message_ids)
+
+    async def apply_new_messages(self, messages):
+        """Применяет пачку новых сообщений к списку чатов и открытому чату"""
+        # Порядок чатов по последнему сообщению: самый свежий - первым
+        touched = []
+        for msg in messages:
+            peer_id = msg.chat_id
+            if peer_id in touched:
+                touched.remove(peer_id)
+            touched.append(peer_id)
+        touched.reverse()
+
+        dialogs_by_id = {self.model.get_dialog_id(dialog): dialog for dialog in self.chat_list}
+        if any(peer_id not in dialogs_by_id for peer_id in touched):
+            # Появился чат, которого нет в загруженном списке - перезапрашиваем верх списка
+            try:
+                with priority(BACKGROUND):
+                    await self.refresh_dialog_head()
+            except Exception:
+                # Под ограничениями сервера поднимаем хотя бы известные чаты, новый появится позже
+                self.bump_dialogs([peer_id for peer_id in touched if peer_id in dialogs_by_id])
+            dialogs_by_id = {self.model.get_dialog_id(dialog): dialog for dialog in self.chat_list}
+        else:
+            self.bump_dialogs(touched)
+
+        is_open = self.focus == "msg" and self.open_chat_id is not None
+        for msg in messages:
+            peer_id = msg.chat_id
+            if peer_id in self.history_cache:
+                self.cache_messages(peer_id, [msg])
+            dialog = dialogs_by_id.get(peer_id)
+            if dialog is None:
+                continue
+            dialog.message = msg
+            if not msg.out and not (is_open and peer_id == self.open_chat_id):
+                dialog.unread_count = (getattr(dialog, 'unread_count', 0) or 0) + 1
+                self.unread_ids.setdefault(peer_id, []).append(msg.id)
+                if msg.mentioned:
+                    dialog.unread_mentions_count = (getattr(dialog, 'unread_mentions_count', 0) or 0) + 1
+                    self.mention_ids.setdefault(peer_id, []).append(msg.id)
+
+        # Пока конец истории выгружен из памяти, новые сообщения подтянутся при прокрутке вниз
+        if not is_open or self.has_newer:
+            return
 
-        if new_selected is not None:
-            self.chat_list = new_dialogs
-            self.selected_chat = new_selected
+        # Новые сообщения открытого чата, без дублей (например, эха отправленных нами)
+        new_messages = []
+        known_ids = set()
+        for msg in messages:
+            if msg.chat_id == self.open_chat_id and msg.id not in self.messages and msg.id not in known_ids:
+                known_ids.add(msg.id)
+                new_messages.append(msg)
+        if not new_messages:
+            return
+
+        # Эхо наших сообщений заменяет их черновики из очереди исходящих
+        echoed = []
+        for msg in new_messages:
+            if msg.out:
+                entry = self.outbox.match_echo(msg.chat_id, msg.text)
+                if entry is not None and entry.local_id in self.messages:
+                    echoed.append(entry.local_id)
+                    if self.selected_msg_id == entry.local_id:
+                        self.selected_msg_id = msg.id
+
+        if echoed or (self.messages and self.messages[-1].status):
+            # Черновики всегда в конце чата, поэтому новые строки нельзя просто дописать
+            self.messages.remove(echoed)
+            for local_id in echoed:
+                self.layout_cache.invalidate(local_id)
+            self.messages.add(new_messages)
+            await self.refresh_message_blocks()
         else:
-            self.chat_list = new_dialogs
+            await self.append_messages(new_messages)
+            self.messages.add(new_messages)
+        await self.trim_history()
+
+        # Прокручиваем к новым сообщениям
+        total_lines = len(self.flat_lines[0])
+        self.line_offset = max(0, total_lines - self.view.msg_win_height + 1)  # +1 для предпоследнего сообщения
+
+        # Если среди них есть исходящее, выбираем последнее из них
+        outgoing = [msg for msg in new_messages if msg.out]
+        if outgoing:
+            self.selected_msg_id = outgoing[-1].id
+            await self.refresh_message_blocks()
+            self.selected_msg_idx = self.find_message_line(self.selected_msg_id)
 
-        # Проверяем, соответствует ли сообщение текущему открытому диалогу
-        msg_peer_id = self.model.get_message_peer_id(event.message)
-        current_open_dialog_id = self.model.get_dialog_id(self.chat_list[self.selected_chat]) if self.selected_chat < len(self.chat_list) else None
+        # Обновляем курсор и помечаем сообщения как прочитанные одним запросом
+        self.ensure_cursor_visible()
+        if any(not msg.out for msg in new_messages):
+            open_dialog = dialogs_by_id.get(self.open_chat_id)
+            if open_dialog is not None:
+                self.mark_dialog_read(open_dialog)
+                try:
+                    # Во время паузы FloodWait не задерживаем обновления: прочтение подтвердится со следующим сообщением
+                    with priority(BACKGROUND):
+                        await self.model.send_read_acknowledge(open_dialog.entity)
+                except Exception:
+                    pass
 
-        # Если сообщение относится к текущему открытому диалогу, добавляем его
-        if self.focus == "msg" and msg_peer_id == current_open_dialog_id:
-            chat_title = self.chat_list[self.selected_chat].title or "No_Title"
-            
-            # Создаем блок для нового сообщения
-            new_block = await self.view.prepare_message_blocks(
-                [event.message],
-                self.view.msg_win_width,
-                self.model,
-                chat_title,
-                self.selected_msg_id,
-                self.downloaded_msg_id
-            )
-            
-            # Добавляем новое сообщение к существующим
-            new_flat_lines, new_map = self.view.flatten_blocks(new_block)
-            old_lines, old_map = self.flat_lines
-            offset = len(old_lines)
-            updated_map = old_map.copy()
-            for idx, msg_id in new_map.items():
-                updated_map[idx + offset] = msg_id
-            old_lines.extend(new_flat_lines)
-            self.flat_lines = (old_lines, updated_map)
-            self.message_line_map = updated_map
-            self.messages.append(event.message)
-
-            # Прокручиваем к новому сообщению
-            total_lines = len(self.flat_lines[0])
-            visible_height = self.view.msg_win_height
-            self.line_offset = max(0, total_lines - visible_height + 1)  # +1 для предпоследнего сообщения
-
-            # Если это исходящее сообщение, убеждаемся, что оно видно
-            if event.message.out:
-                self.line_offset = max(0, total_lines - visible_height + 1)
-                # Выбираем новое сообщение
-                self.selected_msg_id = event.message.id
-                self.selected_msg_idx = offset  # Начальная позиция нового сообщения
-
-            # Обновляем курсор и помечаем сообщения как прочитанные
-            self.ensure_cursor_visible()
-            await self.model.send_read_acknowledge(self.chat_list[self.selected_chat].entity)
-            
-            # Обновляем списки диалогов
-            self.chat_list = await self.model.get_dialogs()
+    def mark_dialog_read(self, dialog):
+        """Сбрасывает локальные счетчики чата после нашего подтверждения прочтения"""
+        dialog.unread_count = 0
+        dialog.unread_mentions_count = 0
+        dialog_id = self.model.get_dialog_id(dialog)
+        self.unread_ids.pop(dialog_id, None)
+        self.mention_ids.pop(dialog_id, None)
+
+    def apply_read_inbox(self, chat_id, max_id):
+        """Корректирует счетчики по прочтению, пришедшему с сервера (например, с другого устройства)"""
+        dialog = self.find_dialog(chat_id)
+        if dialog is None or max_id is None:
+            return
+
+        top_message = getattr(dialog, 'message', None)
+        if top_message is not None and top_message.id <= max_id:
+            # Прочитано все, включая последнее сообщение
+            self.mark_dialog_read(dialog)
+            return
+
+        # Иначе точно знаем только про сообщения, пришедшие за эту сессию
+        unread = self.unread_ids.get(chat_id)
+        if unread and max_id >= unread[0]:
+            self.unread_ids[chat_id] = [msg_id for msg_id in unread if msg_id > max_id]
+            dialog.unread_count = len(self.unread_ids[chat_id])
+        mentions = self.mention_ids.get(chat_id)
+        if mentions and max_id >= mentions[0]:
+            self.mention_ids[chat_id] = [msg_id for msg_id in mentions if msg_id > max_id]
+            dialog.unread_mentions_count = len(self.mention_ids[chat_id])
+
+    def apply_read_contents(self, chat_id, message_ids):
+        """Уменьшает счетчик упоминаний, когда упоминание прочитано"""
+        read = set(message_ids)
+        chat_ids = [chat_id] if chat_id is not None else list(self.mention_ids)
+        for dialog_chat_id in chat_ids:
+            mentions = self.mention_ids.get(dialog_chat_id)
+            if not mentions or not read.intersection(mentions):
+                continue
+            self.mention_ids[dialog_chat_id] = [msg_id for msg_id in mentions if msg_id not in read]
+            dialog = self.find_dialog(dialog_chat_id)
+            if dialog is not None:
+                dialog.unread_mentions_count = max(
+                    0,
+                    (getattr(dialog, 'unread_mentions_count', 0) or 0) - (len(mentions) - len(self.mention_ids[dialog_chat_id]))
+                )
+
+    def open_chat_title(self):
+        """Название открытого чата для имен файлов: курсор в списке чатов может стоять на другом"""
+        dialog = self.find_dialog(self.open_chat_id) if self.open_chat_id is not None else None
+        if dialog is None and self.selected_chat < len(self.chat_list):
+            dialog = self.chat_list[self.selected_chat]
+        return (dialog.title if dialog else None) or "No_Title"
+
+    def find_dialog(self, dialog_id):
+        """Ищет диалог по id среди загруженных"""
+        for dialog in self.chat_list:
+            if self.model.get_dialog_id(dialog) == dialog_id:
+                return dialog
+        return None
+
+    async def apply_edited_message(self, msg):
+        """Заменяет отредактированное сообщение и переразмечает только его"""
+        cached = self.history_cache.get(msg.chat_id)
+        if cached:
+            for i, old_msg in enumerate(cached):
+                if old_msg.id == msg.id:
+                    cached[i] = msg
+                    break
+
+        if self.open_chat_id is None or msg.chat_id != self.open_chat_id:
+            return
+
+        if not self.messages.replace(msg):
+            return
+
+        self.layout_cache.invalidate(msg.id)
+        start = self.find_message_line(msg.id)
+        if start is None:
+            return
+
+        chat_title = self.open_chat_title()
+        block = await self.layout_cache.get_block(
+            msg,
+            self.view.msg_win_width,
+            msg.id == self.selected_msg_id,
+            self.model,
+            chat_title
+        )
+        new_lines, _ = self.view.flatten_blocks([(block, msg.id)])
+        self.splice_lines(start, self.message_end_line(start), new_lines, msg.id)
+
+    async def apply_deleted_messages(self, chat_id, deleted_ids):
+        """Убирает удаленные сообщения из открытого чата без повторной загрузки истории"""
+        for cached_chat_id, cached in self.history_cache.items():
+            if chat_id is None or cached_chat_id == chat_id:
+                cached[:] = [msg for msg in cached if msg.id not in deleted_ids]
+
+        if self.open_chat_id is None or (chat_id is not None and chat_id != self.open_chat_id):
+            return
+
+        deleted = {msg_id for msg_id in deleted_ids if msg_id in self.messages}
+        if not deleted:
+            return
+        positions = sorted(self.messages.index(msg_id) for msg_id in deleted)
+
+        # Курсор переносим на соседнее сообщение
+        selection_moved = self.selected_msg_id in deleted
+        if selection_moved:
+            neighbours = [msg.id for msg in self.messages[positions[-1] + 1:] if msg.id not in deleted]
+            neighbours += [msg.id for msg in reversed(self.messages[:positions[0]]) if msg.id not in deleted]
+            self.selected_msg_id = neighbours[0] if neighbours else None
+
+        if len(positions) == 1:
+            msg_id = self.messages[positions[0]].id
+            self.messages.remove([msg_id])
+            self.layout_cache.invalidate(msg_id)
+            self.remove_message_lines(msg_id)
+        else:
+            # Много удалений сразу: пересобираем строки из кэша раскладки
+            anchor = self.capture_anchor()
+            self.messages.remove(deleted)
+            for msg_id in deleted:
+                self.layout_cache.invalidate(msg_id)
             await self.refresh_message_blocks()
+            self.restore_anchor(anchor)
+
+        if self.selected_msg_id is None:
+            self.selected_msg_idx = -1
+        elif selection_moved:
+            # Переразмечаем новое выделенное сообщение
+            await self.refresh_message_blocks()
+            start = self.find_message_line(self.selected_msg_id)
+            self.selected_msg_idx = start if start is not None else -1
+
+    def message_end_line(self, start):
+        """Возвращает номер строки, следующей за последней строкой сообщения"""
+        msg_id = self.message_line_map.get(start)
+        end = start
+        while self.message_line_map.get(end) == msg_id:
+            end += 1
+        return end
+
+    def remove_message_lines(self, msg_id):
+        """Удаляет строки сообщения вместе с разделителем и осиротевшей датой"""
+        start = self.find_message_line(msg_id)
+        if start is None:
+            return
+        lines, _ = self.flat_lines
+        stop = self.message_end_line(start)
+        if stop < len(lines) and lines[stop] == '\n':
+            stop += 1
+
+        def is_date_separator(line):
+            return isinstance(line, tuple) and len(line) == 3 and line[2] == "date_separator"
+
+        if start > 0 and is_date_separator(lines[start - 1]) and (stop >= len(lines) or is_date_separator(lines[stop])):
+            start -= 1
+        self.splice_lines(start, stop, [], None)
+
+    def splice_lines(self, start, stop, new_lines, msg_id):
+        """Заменяет строки [start, stop) новыми строками сообщения msg_id, сдвигая карту строк"""
+        lines, line_map = self.flat_lines
+        lines[start:stop] = new_lines
+        delta = len(new_lines) - (stop - start)
+
+        if delta:
+            # Карту строк собираем в порядке возрастания номеров строк
+            updated_map = {i: line_msg_id for i, line_msg_id in line_map.items() if i < start}
+            for i in range(len(new_lines)):
+                updated_map[start + i] = msg_id
+            for i, line_msg_id in line_map.items():
+                if i >= stop:
+                    updated_map[i + delta] = line_msg_id
+            line_map = updated_map
+            if self.line_offset >= stop:
+                self.line_offset = max(0, self.line_offset + delta)
+
+        self.flat_lines = (lines, line_map)
+        self.message_line_map = line_map
+        if self.selected_msg_id is not None:
+            selected_start = self.find_message_line(self.selected_msg_id)
+            self.selected_msg_idx = selected_start if selected_start is not None else -1
+
+    def bump_dialogs(self, dialog_ids):
+        """Поднимает чаты с новыми сообщениями наверх списка (под закрепленные)"""
+        bumped = set(dialog_ids)
+        pinned = [dialog for dialog in self.chat_list if getattr(dialog, 'pinned', False)]
+        pinned_ids = {self.model.get_dialog_id(dialog) for dialog in pinned}
+        dialogs_by_id = {self.model.get_dialog_id(dialog): dialog for dialog in self.chat_list}
+
+        moved = [dialogs_by_id[dialog_id] for dialog_id in dialog_ids if dialog_id not in pinned_ids]
+        rest = [
+            dialog for dialog in self.chat_list
+            if self.model.get_dialog_id(dialog) not in bumped and self.model.get_dialog_id(dialog) not in pinned_ids
+        ]
+        self.reconcile_dialogs(pinned + moved + rest)
 
     def ensure_cursor_visible(self):
         """Убеждается, что курсор видим на экране и корректирует смещение при необходимости"""
@@ -365,11 +1451,18 @@ class TelegramViewModel:
             self.line_offset = max_offset
 
         # Специальная обработка для последнего сообщения
-        if current_msg_id == self.messages[-1].id:
+        if self.messages and current_msg_id == self.messages[-1].id:
             self.line_offset = max(0, len(lines) - visible_height + 1)
 
     async def jump_to_latest_messages(self):
         """Переход к последним сообщениям, как в vim с помощью G"""
+        if self.has_newer and self.is_live:
+            # Конец истории выгружен - загружаем последнюю страницу заново
+            async with self.interactive():
+                latest_messages = await self.model.get_messages(self.chat_list[self.selected_chat], limit=MESSAGE_PAGE_SIZE)
+            await self.display_messages(latest_messages.copy() if latest_messages else [])
+            return
+
         if self.messages:
             # Устанавливаем курсор на последнее сообщение в списке
             last_msg = self.messages[-1]
@@ -398,7 +1491,10 @@ class TelegramViewModel:
                     await task
                 except asyncio.CancelledError:
                     pass
-        
+
+        # Запоминаем состояние интерфейса для мгновенного старта
+        self.save_snapshot()
+
         try:
             await self.model.disconnect()
         except Exception:
@@ -428,16 +1524,7 @@ class TelegramViewModel:
             return
 
         # Ищем следующее сообщение после текущего выбранного
-        current_msg_id = self.selected_msg_id
-        next_msg_id = None
-        found_current = False
-
-        for msg in self.messages:
-            if found_current:
-                next_msg_id = msg.id
-                break
-            if msg.id == current_msg_id:
-                found_current = True
+        next_msg_id = self.messages.neighbour(self.selected_msg_id, 1)
 
         if next_msg_id:
             # Ищем строку с этим сообщением
@@ -451,6 +1538,12 @@ class TelegramViewModel:
 
                     await self.refresh_message_blocks()
                     break
+        elif self.has_newer:
+            # Дошли до конца загруженного окна - подгружаем более новые сообщения
+            # и сразу переходим на первое из них, не дожидаясь повторного нажатия
+            await self.scroll_messages_down()
+            if self.messages.neighbour(self.selected_msg_id, 1):
+                await self.move_cursor_down()
 
     async def move_cursor_up(self):
         """Перемещает курсор вверх"""
@@ -467,13 +1560,7 @@ class TelegramViewModel:
             return
 
         # Ищем предыдущее сообщение перед текущим выбранным
-        current_msg_id = self.selected_msg_id
-        prev_msg_id = None
-
-        for i in range(len(self.messages) - 1, -1, -1):
-            if self.messages[i].id == current_msg_id and i > 0:
-                prev_msg_id = self.messages[i-1].id
-                break
+        prev_msg_id = self.messages.neighbour(self.selected_msg_id, -1)
 
         if prev_msg_id:
             # Ищем строку с этим сообщением
@@ -489,21 +1576,24 @@ class TelegramViewModel:
                     break
         else:
             # Если мы в начале списка, пробуем загрузить более старые сообщения
+            # и переходим на последнее из них
             await self.scroll_messages_up()
+            if self.messages.neighbour(self.selected_msg_id, -1):
+                await self.move_cursor_up()
 
     async def handle_enter_on_message(self):
         """Обрабатывает нажатие Enter на выбранном сообщении"""
         if not self.selected_msg_id:
             return
 
-        # Ищем выбранное сообщение
-        selected_message = None
-        for msg in self.messages:
-            if msg.id == self.selected_msg_id:
-                selected_message = msg
-                break
+        selected_message = self.messages.get(self.selected_msg_id)
 
-        if selected_message and selected_message.file:
+        if selected_message and selected_message.status:
+            # Черновик из очереди исходящих - отправляем еще раз
+            await self.retry_outgoing(selected_message.id)
+            return
+
+        if selected_message and selected_message.media:
             # Получаем информацию о файле
             chat_title = self.chat_list[self.selected_chat].title
 
@@ -519,9 +1609,24 @@ class TelegramViewModel:
             file_fully_downloaded = os.path.exists(path) and os.path.getsize(path) > 1000
 
             if not file_fully_downloaded:
+                # Для загрузки нужен полный объект сообщения - запрашиваем его только сейчас
+                full_message = await self.model.get_full_message(
+                    self.chat_list[self.selected_chat].entity,
+                    selected_message.id
+                )
+                if not full_message or not full_message.media:
+                    return
+
+                # Видео и аудио начинаем показывать сразу, не дожидаясь конца загрузки
+                if self.model.config['Settings'].get('StreamMedia', '1') == '1' and is_streamable(selected_message.media):
+                    command = player_command(self.model.config['Settings'].get('Player', ''))
+                    if command:
+                        await self.stream_media(command, full_message.media, selected_message, chat_title)
+                        return
+
                 # Файл не скачан или слишком маленький, загружаем его
                 real_path = await self.model.download_media(
-                    selected_message.media,
+                    full_message.media,
                     chat_title,
                     selected_message.id,
                     force_download=True,
@@ -530,6 +1635,7 @@ class TelegramViewModel:
 
                 # Отмечаем сообщение как загруженное
                 self.downloaded_msg_id = selected_message.id
+                self.layout_cache.invalidate(selected_message.id)
 
                 # Скрываем прогресс-бар
                 self.view.hide_progress_bar()
@@ -540,23 +1646,142 @@ class TelegramViewModel:
                 # Файл уже скачан, открываем его
                 os.system(f'xdg-open "{path}" >/dev/null 2>&1 &')
 
+    async def stream_media(self, command, media, msg, chat_title):
+        """Запускает плеер на адрес потока; файл тем временем докачивается в папку загрузок"""
+        stream = await self.model.stream_media(media, chat_title, msg.id, msg.media.size)
+        self.streams.append(stream)
+        try:
+            player = await asyncio.create_subprocess_exec(
+                *command, stream.url,
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            stream.error = f"не удалось запустить плеер: {e}"
+            player = None
+        asyncio.create_task(self.finish_stream(stream, player, msg))
+
+    async def finish_stream(self, stream, player, msg):
+        """Отмечает файл загруженным, когда поток докачан, и закрывает сервер после выхода из плеера"""
+        try:
+            await stream.task
+        except Exception:
+            # Ошибку показывает заголовок; плеер доиграет то, что успело загрузиться
+            pass
+        else:
+            self.layout_cache.invalidate(msg.id)
+            if self.focus == "msg" and msg.id in self.messages:
+                self.downloaded_msg_id = msg.id
+                await self.refresh_message_blocks()
+        finally:
+            if player is not None:
+                await player.wait()
+            stream.close()
+
     async def refresh_message_blocks(self):
         """Обновляет блоки сообщений с учетом выделения"""
         # Получаем название чата для именования файлов
-        chat_title = self.chat_list[self.selected_chat].title if self.chat_list[self.selected_chat].title else "No_Title"
+        chat_title = self.open_chat_title()
 
-        # Пересоздаем блоки сообщений с новыми параметрами выделения
-        self.message_blocks = await self.view.prepare_message_blocks(
-            self.messages,
-            self.view.msg_win_width,
-            self.model,
-            chat_title,
-            self.selected_msg_id,
-            self.downloaded_msg_id
-        )
+        # Пересоздаем блоки сообщений с новыми параметрами выделения;
+        # неизменившиеся сообщения берутся из кэша раскладки
+        with metrics.timer('layout'):
+            self.message_blocks = await self.view.prepare_message_blocks(
+                self.messages,
+                self.view.msg_win_width,
+                self.model,
+                chat_title,
+                self.selected_msg_id,
+                self.downloaded_msg_id,
+                cache=self.layout_cache,
+                reflow_ids=self.reflow_ids
+            )
         self.flat_lines = self.view.flatten_blocks(self.message_blocks)
         self.message_line_map = self.flat_lines[1]  # Получаем карту сообщений
 
+    def find_message_line(self, msg_id):
+        """Возвращает номер первой строки сообщения в плоском списке строк"""
+        for i, line_msg_id in self.message_line_map.items():
+            if line_msg_id == msg_id:
+                return i
+        return None
+
+    def capture_anchor(self):
+        """Запоминает сообщение, относительно которого нужно сохранить положение экрана"""
+        anchor_id = self.selected_msg_id
+        if anchor_id is None:
+            lines, _ = self.flat_lines if self.flat_lines else ([], {})
+            for i in range(self.line_offset, len(lines)):
+                if i in self.message_line_map:
+                    anchor_id = self.message_line_map[i]
+                    break
+        if anchor_id is None:
+            return None
+        start = self.find_message_line(anchor_id)
+        return anchor_id, (self.line_offset - start) if start is not None else 0
+
+    def restore_anchor(self, anchor):
+        """Восстанавливает положение экрана и курсора после перестройки строк"""
+        if self.selected_msg_id is not None:
+            start = self.find_message_line(self.selected_msg_id)
+            self.selected_msg_idx = start if start is not None else -1
+            if start is None:
+                self.selected_msg_id = None
+        if anchor:
+            anchor_id, delta = anchor
+            start = self.find_message_line(anchor_id)
+            if start is not None:
+                self.line_offset = max(0, start + delta)
+        lines, _ = self.flat_lines
+        self.line_offset = min(self.line_offset, max(0, len(lines) - self.view.msg_win_height))
+
+    async def handle_resize(self):
+        """Пересоздает окна и переразмечает сообщения под новую ширину"""
+        self.view.resize()
+        self.cancel_reflow()
+        # Открытый чат виден и при фокусе на списке чатов, поэтому переразмечаем его всегда
+        if not self.messages:
+            return
+
+        anchor = self.capture_anchor()
+
+        # Сразу раскладываем только сообщения вокруг видимой области, остальное - в фоне
+        anchor_idx = self.messages.index(anchor[0]) if anchor else None
+        if anchor_idx is None:
+            anchor_idx = len(self.messages) - 1
+        around = self.view.msg_win_height
+        self.reflow_ids = {
+            msg.id for msg in self.messages[max(0, anchor_idx - around):anchor_idx + around]
+        }
+
+        await self.refresh_message_blocks()
+        self.restore_anchor(anchor)
+        self.reflow_task = asyncio.create_task(self.reflow_remaining())
+
+    async def reflow_remaining(self):
+        """Фоново раскладывает под новую ширину сообщения за пределами экрана"""
+        cache = self.layout_cache
+        width = self.view.msg_win_width
+        chat_title = self.open_chat_title()
+        stale = [msg for msg in self.messages if cache.is_stale(msg.id, width)]
+
+        for i in range(0, len(stale), REFLOW_CHUNK):
+            for msg in stale[i:i + REFLOW_CHUNK]:
+                await cache.get_block(msg, width, msg.id == self.selected_msg_id, self.model, chat_title)
+            # Отдаем управление циклу, чтобы интерфейс оставался отзывчивым
+            await asyncio.sleep(0)
+
+        self.reflow_ids = None
+        anchor = self.capture_anchor()
+        await self.refresh_message_blocks()
+        self.restore_anchor(anchor)
+
+    def cancel_reflow(self):
+        """Останавливает фоновую переразметку"""
+        if self.reflow_task and not self.reflow_task.done():
+            self.reflow_task.cancel()
+        self.reflow_task = None
+        self.reflow_ids = None
+
     def can_send_messages(self):
         """Проверяет, можно ли отправлять сообщения в текущий чат"""
         try:
@@ -603,17 +1828,12 @@ class TelegramViewModel:
         if not self.selected_msg_id:
             return
 
-        # Ищем выбранное сообщение
-        selected_message = None
-        for msg in self.messages:
-            if msg.id == self.selected_msg_id:
-                selected_message = msg
-                break
+        selected_message = self.messages.get(self.selected_msg_id)
 
         if selected_message:
             try:
                 # Если у сообщения есть файл, копируем путь к файлу
-                if selected_message.file:
+                if selected_message.media:
                     chat_title = self.chat_list[self.selected_chat].title
                     path = await self.model.download_media(
                         selected_message.media,
@@ -690,17 +1910,22 @@ class TelegramViewModel:
         if self.focus != "msg" or not self.messages:
             return False
 
+        # Окно поиска держит свою копию списка и дописывает в ее начало старые страницы
+        searched = self.messages[:]
+
         # Создаем функцию для загрузки дополнительных сообщений
         async def load_more_messages(offset_id):
-            older_messages = await self.model.get_messages(
-                self.chat_list[self.selected_chat],
-                limit=20,
-                offset_id=offset_id
-            )
+            with priority(BACKGROUND):
+                older_messages = await self.model.get_messages(
+                    self.chat_list[self.selected_chat],
+                    limit=MESSAGE_PAGE_SIZE,
+                    offset_id=offset_id
+                )
+            searched[:0] = older_messages
             return older_messages
 
         message_idx = await self.view.message_search_window(
-            self.messages,
+            self.messages[:],
             load_more_callback=load_more_messages,
             model=self.model,
             chat_title=self.chat_list[self.selected_chat].title or "No_Title"
@@ -708,22 +1933,71 @@ class TelegramViewModel:
 
         if message_idx is not None:
             # Пользователь выбрал сообщение
-            selected_message = self.messages[message_idx]
+            selected_message = searched[message_idx]
+            if selected_message.id not in self.messages:
+                # Сообщение из подгруженных поиском страниц - добавляем их в историю
+                self.messages.add(searched[message_idx:])
+                self.selected_msg_id = selected_message.id
+                await self.refresh_message_blocks()
+                # Страницы поиска могли выйти за окно истории: выгружаем дальний от курсора край
+                await self.trim_history()
             self.selected_msg_id = selected_message.id
 
             # Находим строку для этого сообщения
-            for i, msg_id in self.message_line_map.items():
-                if msg_id == selected_message.id:
-                    self.selected_msg_idx = i
+            start = self.find_message_line(selected_message.id)
+            if start is not None:
+                self.selected_msg_idx = start
 
-                    # Обеспечиваем видимость курсора на экране
-                    self.ensure_cursor_visible()
+                # Обеспечиваем видимость курсора на экране
+                self.ensure_cursor_visible()
 
-                    await self.refresh_message_blocks()
-                    break
+                await self.refresh_message_blocks()
 
         return False
 
+    async def open_gallery(self):
+        """Открывает окно с файлами и ссылками чата; g в нем переходит к сообщению"""
+        dialog = self.chat_list[self.selected_chat]
+        if self.gallery is None or self.gallery.chat_id != self.open_chat_id:
+            self.gallery = MediaGallery(self.model, dialog, dialog.title or "No_Title")
+
+        msg_id = await self.view.media_gallery_window(self.gallery)
+
+        # Файлы, загруженные из галереи, в чате должны показываться загруженными
+        for downloaded_id in self.gallery.downloaded_ids:
+            self.layout_cache.invalidate(downloaded_id)
+        self.gallery.downloaded_ids.clear()
+
+        if msg_id is not None:
+            await self.go_to_message(msg_id)
+        else:
+            await self.refresh_message_blocks()
+
+    async def go_to_message(self, msg_id):
+        """Ставит курсор на сообщение; если его нет в памяти, загружает страницы до и после него"""
+        if msg_id not in self.messages:
+            dialog = self.chat_list[self.selected_chat]
+            async with self.interactive():
+                older = await self.model.get_messages(dialog, limit=MESSAGE_PAGE_SIZE, offset_id=msg_id + 1)
+                newer = await self.model.get_newer_messages(dialog, limit=MESSAGE_PAGE_SIZE, min_id=msg_id)
+            await self.display_messages(older + newer)
+            if len(newer) == MESSAGE_PAGE_SIZE:
+                # Конец истории не загружен - черновики из очереди покажет переход к последним сообщениям
+                self.messages.remove([msg.id for msg in self.messages if msg.status])
+                self.has_newer = True
+            if msg_id not in self.messages:
+                await self.refresh_message_blocks()
+                return
+
+        self.selected_msg_id = msg_id
+        await self.refresh_message_blocks()
+        await self.trim_history()
+        start = self.find_message_line(msg_id)
+        if start is not None:
+            self.selected_msg_idx = start
+            self.ensure_cursor_visible()
+            await self.refresh_message_blocks()
+
     async def scroll_messages_up(self):
         """Загружает более старые сообщения при прокрутке вверх"""
         if not self.messages:
@@ -732,29 +2006,91 @@ class TelegramViewModel:
         # Получаем ID первого сообщения в текущем списке
         first_msg_id = self.messages[0].id
 
-        # Загружаем более старые сообщения
-        older_messages = await self.model.get_messages(
-            self.chat_list[self.selected_chat],
-            limit=20,
-            offset_id=first_msg_id
-        )
+        # Выгруженные сообщения сначала ищем в теплом кэше, затем загружаем с сервера
+        cached = self.cached_history()
+        if cached and cached[0].id < first_msg_id <= cached[-1].id:
+            older_messages = [msg for msg in cached if msg.id < first_msg_id][-MESSAGE_PAGE_SIZE:]
+        else:
+            older_messages = await self.model.get_messages(
+                self.chat_list[self.selected_chat],
+                limit=MESSAGE_PAGE_SIZE,
+                offset_id=first_msg_id
+            )
 
         if older_messages:
+            anchor = self.capture_anchor()
+
             # Добавляем старые сообщения в начало списка
-            self.messages = older_messages + self.messages
+            self.messages.add(older_messages)
 
-            # Обновляем блоки сообщений
-            chat_title = self.chat_list[self.selected_chat].title or "No_Title"
-            self.message_blocks = await self.view.prepare_message_blocks(
-                self.messages,
-                self.view.msg_win_width,
-                self.model,
-                chat_title,
-                self.selected_msg_id,
-                self.downloaded_msg_id
+            # Обновляем отображение, сохраняя положение экрана и курсора
+            await self.refresh_message_blocks()
+            self.restore_anchor(anchor)
+            await self.trim_history()
+
+    async def scroll_messages_down(self):
+        """Загружает более новые сообщения, выгруженные ранее из памяти"""
+        if not self.messages or not self.is_live:
+            return
+
+        last_id = self.messages[-1].id
+        cached = self.cached_history()
+        if cached and cached[0].id <= last_id < cached[-1].id:
+            newer_messages = [msg for msg in cached if msg.id > last_id][:MESSAGE_PAGE_SIZE]
+            # Кэш - конец чата: дошли до последнего сообщения
+            if newer_messages[-1].id == cached[-1].id:
+                self.has_newer = False
+        else:
+            newer_messages = await self.model.get_newer_messages(
+                self.chat_list[self.selected_chat],
+                limit=MESSAGE_PAGE_SIZE,
+                min_id=last_id
             )
-            self.flat_lines = self.view.flatten_blocks(self.message_blocks)
-            self.message_line_map = self.flat_lines[1]
+            if len(newer_messages) < MESSAGE_PAGE_SIZE:
+                self.has_newer = False
+        if not newer_messages:
+            return
 
-            # Обновляем отображение
-            await self.refresh_message_blocks()
+        newer_messages = [msg for msg in newer_messages if msg.id not in self.messages]
+        await self.append_messages(newer_messages)
+        self.messages.add(newer_messages)
+        await self.trim_history()
+
+    def cached_history(self):
+        """Хвост открытого чата из теплого кэша: сообщения в нем идут подряд, без пропусков"""
+        cached = self.history_cache.get(self.open_chat_id)
+        if not cached:
+            return None
+        self.history_cache.move_to_end(self.open_chat_id)
+        return cached
+
+    async def trim_history(self):
+        """Выгружает из памяти сообщения за пределами окна истории
+
+        Выгружается край, дальний от курсора (или от видимой области): при прокрутке
+        вверх - самые новые сообщения, при чтении конца чата - самые старые.
+        Выгруженные сообщения при прокрутке к ним берутся из теплого кэша, если он
+        их покрывает, иначе загружаются с сервера снова.
+        """
+        limit = self.history_pages * MESSAGE_PAGE_SIZE
+        excess = len(self.messages) - limit
+        if excess <= 0:
+            return
+
+        anchor = self.capture_anchor()
+        anchor_idx = self.messages.index(anchor[0]) if anchor else None
+        if anchor_idx is None:
+            anchor_idx = len(self.messages) - 1
+
+        if anchor_idx < len(self.messages) // 2:
+            # Конец чата еще в памяти: сохраняем его в кэш, чтобы вернуться к нему без запроса
+            self.remember_history()
+            evicted = self.messages.drop_last(excess)
+            self.has_newer = True
+        else:
+            evicted = self.messages.drop_first(excess)
+
+        for msg_id in evicted:
+            self.layout_cache.invalidate(msg_id)
+        await self.refresh_message_blocks()
+        self.restore_anchor(anchor)